@@ -0,0 +1,26 @@
+import os
+import sys
+from typing import List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, "data")
+
+# The project isn't installed as a package, its modules are imported the same way main.py does
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+
+def menu_files(directory: str = DATA_DIR) -> List[str]:
+    """Returns the OCR JSON files in the directory, sorted by name."""
+    return [
+        os.path.join(directory, file)
+        for file in sorted(os.listdir(directory))
+        if file.endswith(".json")
+    ]
+
+
+def format_bytes(size: float) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
@@ -0,0 +1,82 @@
+"""
+Benchmarks the filters of calculate_confindences on the menus in the data folder, without the GPT filter.
+
+For every menu it reports the time of the LineFilter running every filter on every line in the given order, with the
+line-wise filters fused into single passes over the lines, with the filters ordered by cost and pruning the lines below
+the threshold as by default, and with both. It checks they all select the same lines.
+
+    poetry run python bench/filters.py [data folder]
+"""
+import sys
+import time
+
+import _common
+
+from file_handler import load_ocr_data
+from filters import LineFilter, default_filters
+from filters.gpt_filter import MakeAIDoTheFiltering
+
+CONF_THRESHOLD = 0.75
+REPEATS = 20
+
+
+def offline_filters():
+    return [
+        filter
+        for filter in default_filters(CONF_THRESHOLD)
+        if not isinstance(filter, MakeAIDoTheFiltering)
+    ]
+
+
+def time_filter(path: str, line_filter: LineFilter):
+    """Returns the best time of the filter over fresh copies of the menu and the lines it selected."""
+    best = float("inf")
+    for _ in range(REPEATS):
+        menu = load_ocr_data(path)
+        start = time.perf_counter()
+        lines = line_filter.get_possible_categories(menu, CONF_THRESHOLD)
+        best = min(best, time.perf_counter() - start)
+    return best, [line.position for line in lines]
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else _common.DATA_DIR
+    configurations = {
+        "separate": LineFilter(
+            *offline_filters(), fuse=False, prune=False, order_by_cost=False
+        ),
+        "fused": LineFilter(
+            *offline_filters(), fuse=True, prune=False, order_by_cost=False
+        ),
+        "pruned": LineFilter(*offline_filters()),
+        "both": LineFilter(*offline_filters(), fuse=True),
+    }
+
+    print(
+        f"{'menu':<16}{'lines':>7}" + "".join(f"{name:>12}" for name in configurations)
+    )
+    totals = dict.fromkeys(configurations, 0.0)
+    for path in _common.menu_files(directory):
+        times = {}
+        selected = []
+        for name, line_filter in configurations.items():
+            times[name], lines = time_filter(path, line_filter)
+            totals[name] += times[name]
+            selected.append(lines)
+        assert all(lines == selected[0] for lines in selected), path
+
+        name = path.rsplit("/", 1)[-1]
+        lines = len(load_ocr_data(path).lines)
+        print(
+            f"{name:<16}{lines:>7}"
+            + "".join(f"{t * 1000:>9.2f} ms" for t in times.values())
+        )
+
+    print(
+        f"{'total':<16}{'':>7}"
+        + "".join(f"{t * 1000:>9.2f} ms" for t in totals.values())
+    )
+
+
+if __name__ == "__main__":
+    main()
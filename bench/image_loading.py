@@ -0,0 +1,95 @@
+"""
+Benchmarks loading the source images of menus into PDF documents.
+
+Compares the old img_to_fitz, which converted the image to a temporary PDF file with PIL and opened it again, with
+the in-memory img_to_fitz, as is and downscaled. For every image in the data folder it reports the best time of
+loading the image and serializing the document, the peak RSS above the baseline of a fresh process and the size of
+the PDF.
+
+    poetry run python bench/image_loading.py [data folder] [downscaled size]
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import _common
+
+REPEATS = 5
+
+
+def load_temp_file(path: str, max_size: int):
+    """The old implementation, with a temporary PDF file."""
+    import fitz
+    from PIL import Image
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as temp:
+        Image.open(path).save(temp.name, "PDF", resolution=72.0)
+        return fitz.Document(temp.name)
+
+
+def load_in_memory(path: str, max_size: int):
+    from img2pdf import img_to_fitz
+
+    return img_to_fitz(path, max_size=max_size)
+
+
+METHODS = {
+    "temp file": (load_temp_file, 0),
+    "in memory": (load_in_memory, 0),
+    "downscaled": (load_in_memory, None),
+}
+
+
+def measure(method: str, path: str, max_size: int, queue: multiprocessing.Queue):
+    """Runs in a fresh process, so the peak RSS is only that of the method."""
+    import fitz  # noqa: F401 - imported before the baseline is taken
+    import img2pdf  # noqa: F401
+
+    load, size = METHODS[method]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        doc = load(path, max_size if size is None else size)
+        pdf = doc.tobytes()
+        doc.close()
+        best = min(best, time.perf_counter() - start)
+
+    # ru_maxrss is in KiB on Linux
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024
+    queue.put((best, peak, len(pdf)))
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else _common.DATA_DIR
+    max_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    context = multiprocessing.get_context("spawn")
+
+    images = [
+        os.path.join(directory, file)
+        for file in sorted(os.listdir(directory))
+        if file.lower().endswith((".jpg", ".jpeg", ".png"))
+    ]
+
+    print(f"{'image':<14}{'method':<12}{'time':>12}{'peak RSS':>14}{'PDF size':>14}")
+    for path in images:
+        for method in METHODS:
+            queue = context.Queue()
+            process = context.Process(
+                target=measure, args=(method, path, max_size, queue)
+            )
+            process.start()
+            duration, peak, size = queue.get()
+            process.join()
+            print(
+                f"{os.path.basename(path):<14}{method:<12}{duration * 1000:>9.1f} ms"
+                f"{_common.format_bytes(peak):>14}{_common.format_bytes(size):>14}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmarks loading the OCR data with the eager and the lazy loader.
+
+Every file is loaded with both loaders and the filters are applied, like a normal run does. Reports the best time
+out of 3 to parse the file, the memory retained by the loaded menu and the peak memory allocated while parsing and
+while filtering, as measured by tracemalloc in a separate run, because tracing slows the parsing down.
+
+    poetry run python bench/ocr_loading.py [directory with OCR data]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+from _common import DATA_DIR, format_bytes, menu_files
+
+from conf import CONF_THRESHOLD
+from file_handler import load_ocr_data
+from filters import calculate_confindences
+
+LOADERS = ["eager", "lazy"]
+
+
+def measure(path: str, loader: str):
+    parse_time = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        load_ocr_data(path, loader)
+        parse_time = min(parse_time, time.perf_counter() - start)
+
+    tracemalloc.start()
+    menu = load_ocr_data(path, loader)
+    retained, parse_peak = tracemalloc.get_traced_memory()
+
+    calculate_confindences(menu, CONF_THRESHOLD)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return parse_time, retained, parse_peak, peak
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else DATA_DIR
+
+    print(
+        f"{'file':<12}{'size':>12}"
+        + "".join(
+            f"{loader + ' parse':>14}{'retained':>12}{'parse peak':>12}{'total peak':>12}"
+            for loader in LOADERS
+        )
+    )
+    for path in menu_files(directory):
+        results = [measure(path, loader) for loader in LOADERS]
+        print(
+            f"{os.path.splitext(os.path.basename(path))[0]:<12}{format_bytes(os.path.getsize(path)):>12}"
+            + "".join(
+                f"{parse_time * 1000:>11.1f} ms{format_bytes(retained):>12}{format_bytes(parse_peak):>12}{format_bytes(peak):>12}"
+                for parse_time, retained, parse_peak, peak in results
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
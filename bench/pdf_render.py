@@ -0,0 +1,131 @@
+"""
+Benchmarks rendering the highlighted PDFs.
+
+Compares saving the document after every highlighted line, which is how save_pdf used to work, with the
+single save of every PDF_SAVE_MODE. Reports the time and the number of bytes written for every file, and how many
+of its pages have highlights.
+
+The sample menus have categories on almost every page, so the modes are also compared on a synthetic catalog: the
+largest sample PDF repeated until it has over 100 pages, with categories only on its first two pages.
+
+    poetry run python bench/pdf_render.py [directory with OCR data]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from _common import DATA_DIR, format_bytes, menu_files
+
+from conf import CONF_THRESHOLD
+from filters import calculate_confindences
+import fitz
+from file_handler import (
+    get_source_file,
+    load_ocr_data,
+    load_source_image,
+    save_pdf,
+)
+
+MODES = ["full", "compact", "incremental", "pages"]
+
+
+def save_pdf_per_line(lines, filename, json_file, output_dir) -> int:
+    """The old implementation, which saved the whole document after every highlighted line."""
+    doc = load_source_image(get_source_file(json_file))
+    output_path = os.path.join(output_dir, filename + ".pdf")
+    written = 0
+    for line in lines:
+        page = doc[line.page.page_num - 1]
+        line.bounding_box.draw(page, line.page.unit)
+        doc.save(output_path)
+        written += os.path.getsize(output_path)
+    return written
+
+
+def make_catalog(directory: str, output_dir: str, min_pages: int = 100) -> str:
+    """Creates the synthetic catalog from the largest PDF in the directory, returns the path of its OCR data."""
+    sources = [
+        (os.path.getsize(source), path, source)
+        for path in menu_files(directory)
+        if (source := get_source_file(path)) and source.upper().endswith(".PDF")
+    ]
+    _, json_file, source_file = max(sources)
+
+    catalog = fitz.Document()
+    with fitz.Document(source_file) as source:
+        while len(catalog) < min_pages:
+            catalog.insert_pdf(source)
+    catalog_dir = os.path.join(output_dir, "catalog")
+    os.makedirs(catalog_dir, exist_ok=True)
+    catalog.save(os.path.join(catalog_dir, "catalog.pdf"), garbage=3)
+    catalog.close()
+
+    # The OCR data only covers the first copy, which is all the highlighted lines need
+    shutil.copyfile(json_file, os.path.join(catalog_dir, "catalog.json"))
+    return os.path.join(catalog_dir, "catalog.json")
+
+
+def bench_catalog(directory: str, output_dir: str):
+    json_file = make_catalog(directory, output_dir)
+    menu = load_ocr_data(json_file)
+    lines = [
+        line
+        for line in calculate_confindences(menu, CONF_THRESHOLD)
+        if line.page_index < 2
+    ]
+    size = os.path.getsize(get_source_file(json_file))
+    print(f"\nSynthetic catalog, {format_bytes(size)}, {len(lines)} highlighted lines")
+    print(f"{'mode':<14}{'pages':>10}{'time':>12}{'written':>12}{'copied':>12}")
+    for mode in MODES:
+        start = time.perf_counter()
+        stats = save_pdf(lines, "catalog", json_file, output_dir, mode)
+        duration = time.perf_counter() - start
+        print(
+            f"{mode:<14}{stats.pages_touched:>5}/{stats.pages_total:<4}{duration * 1000:>9.1f} ms"
+            f"{format_bytes(stats.bytes_written):>12}{format_bytes(stats.bytes_copied):>12}"
+        )
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else DATA_DIR
+    output_dir = tempfile.mkdtemp()
+
+    print(
+        f"{'file':<12}{'lines':>6}{'pages':>8}"
+        + "".join(f"{mode:>26}" for mode in ["per line"] + MODES)
+    )
+    for path in menu_files(directory):
+        if not get_source_file(path):
+            continue
+        filename = os.path.splitext(os.path.basename(path))[0]
+        menu = load_ocr_data(path)
+        lines = calculate_confindences(menu, CONF_THRESHOLD)
+
+        results = []
+        start = time.perf_counter()
+        written = save_pdf_per_line(lines, filename, path, output_dir)
+        results.append((time.perf_counter() - start, written))
+
+        for mode in MODES:
+            start = time.perf_counter()
+            stats = save_pdf(lines, filename, path, output_dir, mode)
+            duration = time.perf_counter() - start
+            # The copy of the source in the incremental mode is a plain file copy, only the appended part is counted
+            results.append((duration, stats.bytes_written if stats else 0))
+
+        pages = f"{stats.pages_touched}/{stats.pages_total}" if stats else "-"
+        print(
+            f"{filename:<12}{len(lines):>6}{pages:>8}"
+            + "".join(
+                f"{duration * 1000:>10.1f} ms {format_bytes(written):>12}"
+                for duration, written in results
+            )
+        )
+
+    bench_catalog(directory, output_dir)
+
+
+if __name__ == "__main__":
+    main()
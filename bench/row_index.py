@@ -0,0 +1,70 @@
+"""
+Benchmarks the RowIndex that counts the row-mates of the lines for the features of the classifier, on synthetic pages.
+
+Every page is made of rows of 1 to 6 lines (a dish, dots, a price, allergens...) with some jitter in their heights.
+For growing page sizes it reports the time to count the row-mates of every line by comparing all pairs of lines,
+and the time to build the RowIndex and count them with it.
+
+    poetry run python bench/row_index.py [largest page size]
+"""
+import sys
+import time
+
+import numpy as np
+
+import _common  # noqa: F401 - puts src on the path
+
+from geometry import RowIndex
+
+# All pairs needs n² memory and time, so it is only run up to this size
+MAX_ALL_PAIRS = 20000
+
+
+def synthetic_page(size: int, rng: np.random.Generator):
+    """Returns the tops, bottoms and centers of `size` lines laid out in rows."""
+    rows = np.repeat(np.arange(size), rng.integers(1, 7, size))[:size]
+    tops = rows * 1.5 + rng.normal(0, 0.1, size)
+    bottoms = tops + 1 + rng.normal(0, 0.05, size)
+    return tops, bottoms, (tops + bottoms) / 2
+
+
+def count_all_pairs(tops, bottoms, centers) -> np.ndarray:
+    counts = np.zeros(len(centers), dtype=np.int64)
+    for start in range(0, len(centers), 1000):
+        y = centers[start : start + 1000, None]
+        counts[start : start + 1000] = ((tops < y) & (y < bottoms)).sum(axis=1)
+    return counts
+
+
+def main():
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = np.random.default_rng(0)
+
+    print(f"{'lines':>8}{'all pairs':>14}{'index build':>14}{'index count':>14}")
+    size = 1000
+    while size <= largest:
+        tops, bottoms, centers = synthetic_page(size, rng)
+
+        if size <= MAX_ALL_PAIRS:
+            start = time.perf_counter()
+            expected = count_all_pairs(tops, bottoms, centers)
+            all_pairs = f"{(time.perf_counter() - start) * 1000:>11.1f} ms"
+        else:
+            expected = None
+            all_pairs = f"{'-':>14}"
+
+        start = time.perf_counter()
+        index = RowIndex(tops, bottoms)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        counts = index.count(centers)
+        count = time.perf_counter() - start
+        assert expected is None or np.array_equal(counts, expected)
+
+        print(f"{size:>8}{all_pairs}{build * 1000:>11.1f} ms{count * 1000:>11.1f} ms")
+        size *= 10 if size < 10000 else 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmarks finding the source files of the OCR data in large directories.
+
+For growing numbers of menus it creates a directory with an empty OCR file and a source file for every one of them,
+a third PDFs, a third JPGs and a third both, and reports the time to find the sources of all the menus by globbing
+for every OCR file, as get_source_file used to, and with the SourceIndex, including listing the directory once.
+
+    poetry run python bench/source_lookup.py [largest number of menus]
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import _common  # noqa: F401 - puts src on the path
+
+from conf import SOURCE_EXTENSIONS
+from file_handler import SourceIndex
+
+# Globbing for every file is quadratic, so it is only run up to this size
+MAX_GLOB = 2000
+
+
+def glob_source_file(json_path: str):
+    """The lookup get_source_file did before the SourceIndex, a glob over the whole directory per OCR file."""
+    base = os.path.splitext(json_path)[0]
+    source_file = None
+    for file in glob.glob(base + ".*"):
+        for extension in SOURCE_EXTENSIONS:
+            if file.upper().endswith("." + extension.upper()):
+                source_file = file
+                break
+    return source_file
+
+
+def create_directory(directory: str, size: int):
+    for i in range(size):
+        names = [f"menu-{i}.json"]
+        if i % 3 != 1:
+            names.append(f"menu-{i}.pdf")
+        if i % 3 != 0:
+            names.append(f"menu-{i}.jpg")
+        for name in names:
+            open(os.path.join(directory, name), "w").close()
+
+
+def main():
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    print(f"{'menus':>8}{'glob':>14}{'index':>14}{'per menu':>12}")
+    for size in [500, 1000, 2000, 5000, 10000, 20000, 50000, 100000]:
+        if size > largest:
+            break
+        with tempfile.TemporaryDirectory() as directory:
+            create_directory(directory, size)
+            json_files = [
+                os.path.join(directory, f"menu-{i}.json") for i in range(size)
+            ]
+
+            if size <= MAX_GLOB:
+                start = time.perf_counter()
+                for json_file in json_files:
+                    glob_source_file(json_file)
+                globbing = f"{(time.perf_counter() - start) * 1000:>11.1f} ms"
+            else:
+                globbing = f"{'-':>14}"
+
+            start = time.perf_counter()
+            index = SourceIndex()
+            sources = [index.get(json_file) for json_file in json_files]
+            indexed = time.perf_counter() - start
+            # PDFs are preferred over the images
+            assert all(source.endswith(".pdf") for source in sources[::3])
+
+            print(
+                f"{size:>8}{globbing}{indexed * 1000:>11.1f} ms{indexed / size * 1e6:>9.1f} µs"
+            )
+
+
+if __name__ == "__main__":
+    main()
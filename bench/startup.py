@@ -0,0 +1,137 @@
+"""
+Benchmarks the startup of the CLI and checks that the heavy dependencies stay out of its core path.
+
+Runs fresh interpreters with `-X importtime`, once only importing main and once processing a menu with only the CSV
+output and without an OpenAI key, which is the core path: loading the OCR data, running the heuristic filters and
+writing the categories. For both it reports the best wall time, the total import time and the slowest top level
+imports, and it exits with 1 if a module that is only imported on first use (fitz, PIL, openai, ...) was imported.
+
+    poetry run python bench/startup.py [menu] [--repeat N]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import _common
+
+SRC_DIR = os.path.join(_common.ROOT, "src")
+
+# Only needed for the PDF output, GPT, profiling, worker processes or a .env file
+DEFERRED = [
+    "fitz",
+    "pymupdf",
+    "PIL",
+    "openai",
+    "aiohttp",
+    "tiktoken",
+    "pyinstrument",
+    "cProfile",
+    "dotenv",
+    "multiprocessing",
+]
+
+RE_IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def parse_import_times(stderr: str) -> List[Tuple[str, int, int]]:
+    """Returns the name, cumulative time in µs and nesting depth of every module imported."""
+    modules = []
+    for line in stderr.splitlines():
+        match = RE_IMPORT_TIME.match(line)
+        if match:
+            _, cumulative, indent, name = match.groups()
+            modules.append((name, int(cumulative), len(indent) // 2))
+    return modules
+
+
+def run(arguments: List[str], cwd: str, env: Dict[str, str]) -> Tuple[float, str]:
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", *arguments],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    duration = time.perf_counter() - start
+    if process.returncode != 0:
+        raise SystemExit(f"{' '.join(arguments)} failed:\n{process.stderr[-2000:]}")
+    return duration, process.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "menu",
+        nargs="?",
+        default=os.path.join(_common.DATA_DIR, "menu-2.json"),
+        help="The OCR data processed on the core path. Default is data/menu-2.json",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Every time is the best of this many runs. Default is 5",
+    )
+    args = parser.parse_args()
+
+    # Without a key GPT is skipped, and without a .env file in the working directory dotenv isn't needed
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith("OPEN_AI_")
+    }
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        scenarios = {
+            "import main": [
+                "-c",
+                f"import sys; sys.path.insert(0, {SRC_DIR!r}); import main",
+            ],
+            "core path": [
+                os.path.join(SRC_DIR, "main.py"),
+                os.path.abspath(args.menu),
+                "-o",
+                "csv",
+                "--output-dir",
+                os.path.join(cwd, "output"),
+            ],
+        }
+
+        for scenario, arguments in scenarios.items():
+            best, stderr = min(run(arguments, cwd, env) for _ in range(args.repeat))
+            modules = parse_import_times(stderr)
+            top_level = sorted(
+                (
+                    (name, cumulative)
+                    for name, cumulative, depth in modules
+                    if depth == 0
+                ),
+                key=lambda module: -module[1],
+            )
+            total = sum(cumulative for _, cumulative in top_level)
+            print(
+                f"{scenario}: {best * 1000:.0f} ms, {total / 1000:.0f} ms importing {len(modules)} modules"
+            )
+            for name, cumulative in top_level[:8]:
+                print(f"  {cumulative / 1000:>8.1f} ms  {name}")
+
+            imported = {name.split(".")[0] for name, _, _ in modules}
+            deferred = [name for name in DEFERRED if name in imported]
+            if deferred:
+                failed = True
+                print(
+                    f"  imported modules that should be deferred: {', '.join(deferred)}"
+                )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+Benchmark and accuracy regression suite over the menus in the data folder.
+
+For every menu it times parsing the OCR data, every stage of the filters, the GPT filter, rendering the highlighted
+PDF and the whole process_ocr pipeline with the CSV and PDF outputs, measures the peak memory of the pipeline and
+checks the categories it found against the golden files in bench/golden. The results are written as JSON, so runs
+of different commits can be compared.
+
+    # Runs the suite, exits with 1 if the categories of a menu differ from its golden file
+    poetry run python bench/suite.py run --output results.json
+
+    # Rewrites the golden files after an intended change of the results
+    poetry run python bench/suite.py run --update-golden
+
+    # Reports the stages that got slower and the menus whose categories changed between two runs
+    poetry run python bench/suite.py compare base.json results.json
+
+The GPT filter is only run with --gpt, its answers aren't deterministic, so the golden files are made without it.
+Peak memory is measured by tracemalloc, which sees the allocations of Python but not those made inside MuPDF.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import attr
+
+import _common
+
+from conf import CONF_THRESHOLD, PDF_SAVE_MODE
+from file_handler import load_ocr_data
+from filters import LineFilter, default_filters
+from filters.gpt_filter import MakeAIDoTheFiltering
+from main import process_ocr
+from output import CsvSink, PdfBytesSink, PdfSink, ProcessResult
+
+PDF_SAVE_MODES = ["full", "compact", "incremental", "pages"]
+
+GOLDEN_DIR = os.path.join(_common.ROOT, "bench", "golden")
+
+# Confidences are compared and stored rounded, so float noise of reordered multiplications doesn't show up
+CONFIDENCE_DIGITS = 6
+
+
+def create_line_filter(gpt: bool) -> LineFilter:
+    return LineFilter(
+        *(
+            filter
+            for filter in default_filters(CONF_THRESHOLD)
+            if gpt or not isinstance(filter, MakeAIDoTheFiltering)
+        )
+    )
+
+
+def filter_names(line_filter: LineFilter) -> List[str]:
+    return [
+        filter.__class__.__name__
+        for stage in line_filter.stages
+        for filter in (stage if isinstance(stage, tuple) else (stage,))
+    ]
+
+
+def categories_json(result: ProcessResult) -> List[list]:
+    return [
+        [
+            line.page_index,
+            line.line_index,
+            line.text,
+            round(line.analysis.category_confidence, CONFIDENCE_DIGITS),
+        ]
+        for line in result.categories
+    ]
+
+
+def golden_path(name: str) -> str:
+    return os.path.join(GOLDEN_DIR, name + ".json")
+
+
+def check_golden(name: str, categories: List[list]) -> dict:
+    """
+    Compares the categories with the golden file of the menu.
+
+    Only a different set of category lines is a mismatch, the largest difference of their confidences is reported
+    so small changes of the scoring are visible too.
+    """
+    path = golden_path(name)
+    if not os.path.exists(path):
+        return {"status": "missing"}
+
+    with open(path, "r") as f:
+        golden = json.load(f)
+    expected = {
+        (page, line): (text, conf) for page, line, text, conf in golden["categories"]
+    }
+    found = {(page, line): (text, conf) for page, line, text, conf in categories}
+
+    common = expected.keys() & found.keys()
+    return {
+        "status": "match" if expected.keys() == found.keys() else "mismatch",
+        "missing": [
+            [*position, expected[position][0]]
+            for position in sorted(expected.keys() - found.keys())
+        ],
+        "unexpected": [
+            [*position, found[position][0]]
+            for position in sorted(found.keys() - expected.keys())
+        ],
+        "max_confidence_delta": max(
+            (abs(expected[position][1] - found[position][1]) for position in common),
+            default=0.0,
+        ),
+        "golden_filters": golden["filters"],
+    }
+
+
+def write_golden(name: str, categories: List[list], filters: List[str]):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    # One category per line, so the changes of the golden files are readable in diffs
+    rows = ",\n".join(
+        "  " + json.dumps(category, ensure_ascii=False) for category in categories
+    )
+    with open(golden_path(name), "w") as f:
+        f.write(
+            f'{{"filters": {json.dumps(filters)},\n'
+            f' "threshold": {CONF_THRESHOLD},\n'
+            f' "categories": [\n{rows}\n ]}}\n'
+        )
+
+
+def best_of(repeat: int, function):
+    """Returns the best time of the function and what it returned the last time."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        best = min(best, time.perf_counter() - start)
+    return best, value
+
+
+def measure_menu(
+    path: str, line_filter: LineFilter, repeat: int, pdf_mode: str, output_dir: str
+) -> dict:
+    """Times the stages of processing one menu, every time is the best of `repeat` runs, in seconds."""
+    gpt_stages = {
+        LineFilter._stage_name(stage)
+        for stage in line_filter.stages
+        if isinstance(stage, MakeAIDoTheFiltering)
+    }
+
+    parse, menu = best_of(repeat, lambda: load_ocr_data(path))
+
+    # The filters change the confidences of the lines, so every run gets a fresh menu
+    stages: Dict[str, float] = {}
+    filter_total = float("inf")
+    result = None
+    for _ in range(repeat):
+        menu = load_ocr_data(path)
+        start = time.perf_counter()
+        categories = line_filter.get_possible_categories(menu, CONF_THRESHOLD)
+        filter_total = min(filter_total, time.perf_counter() - start)
+        for stage, duration in line_filter.timings.items():
+            stages[stage] = min(stages.get(stage, float("inf")), duration)
+        result = ProcessResult(path, menu, categories)
+
+    render_sink = PdfBytesSink(pdf_mode)
+    render, pdf = best_of(repeat, lambda: render_sink.render(result))
+
+    sinks = [CsvSink(output_dir), PdfSink(output_dir, pdf_mode)]
+    pipeline, _ = best_of(repeat, lambda: process_ocr(path, sinks, line_filter))
+
+    # A separate run, tracing the allocations slows everything down
+    tracemalloc.start()
+    process_ocr(path, sinks, line_filter)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "lines": len(menu.lines),
+        "time": {
+            "parse": parse,
+            "filters": filter_total,
+            "stages": {name: t for name, t in stages.items() if name not in gpt_stages},
+            "gpt": sum(stages.get(name, 0.0) for name in gpt_stages),
+            "pdf_render": render if pdf is not None else None,
+            "pipeline": pipeline,
+        },
+        "peak_memory": peak,
+        "pdf": attr.asdict(result.pdf_stats) if result.pdf_stats else None,
+        "categories": categories_json(result),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=_common.ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_ms(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.2f} ms"
+
+
+def run(args: argparse.Namespace) -> int:
+    line_filter = create_line_filter(args.gpt)
+    filters = filter_names(line_filter)
+    menus: Dict[str, dict] = {}
+
+    print(
+        f"{'menu':<12}{'lines':>6}{'parse':>12}{'filters':>12}{'gpt':>12}{'pdf':>12}{'pipeline':>12}"
+        f"{'peak mem':>12}  golden"
+    )
+    with tempfile.TemporaryDirectory() as output_dir:
+        for path in _common.menu_files(args.directory):
+            name = os.path.splitext(os.path.basename(path))[0]
+            menu = measure_menu(
+                path, line_filter, args.repeat, args.pdf_mode, output_dir
+            )
+
+            if args.update_golden:
+                write_golden(name, menu["categories"], filters)
+            menu["golden"] = check_golden(name, menu["categories"])
+            menus[name] = menu
+
+            times = menu["time"]
+            print(
+                f"{name:<12}{menu['lines']:>6}{format_ms(times['parse']):>12}{format_ms(times['filters']):>12}"
+                f"{format_ms(times['gpt']):>12}{format_ms(times['pdf_render']):>12}"
+                f"{format_ms(times['pipeline']):>12}{_common.format_bytes(menu['peak_memory']):>12}"
+                f"  {menu['golden']['status']}"
+            )
+
+    totals = {
+        key: sum(menu["time"][key] or 0.0 for menu in menus.values())
+        for key in ["parse", "filters", "gpt", "pdf_render", "pipeline"]
+    }
+    stages: Dict[str, float] = {}
+    for menu in menus.values():
+        for stage, duration in menu["time"]["stages"].items():
+            stages[stage] = stages.get(stage, 0.0) + duration
+
+    print(
+        f"{'total':<12}{'':>6}"
+        + "".join(f"{format_ms(totals[key]):>12}" for key in totals)
+    )
+    for stage, duration in stages.items():
+        print(f"{format_ms(duration):>12}  {stage}")
+
+    mismatches = [
+        name for name, menu in menus.items() if menu["golden"]["status"] == "mismatch"
+    ]
+    for name in mismatches:
+        golden = menus[name]["golden"]
+        print(f"{name}: missing {golden['missing']}, unexpected {golden['unexpected']}")
+        if golden["golden_filters"] != filters:
+            print(
+                f"  the golden file was made with the filters {', '.join(golden['golden_filters'])}"
+            )
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "config": {
+            "repeat": args.repeat,
+            "gpt": args.gpt,
+            "pdf_mode": args.pdf_mode,
+            "conf_threshold": CONF_THRESHOLD,
+            "filters": filters,
+        },
+        "menus": menus,
+        "totals": {"time": totals, "stages": stages},
+        # ru_maxrss is in KiB on Linux, it includes MuPDF, unlike the peaks of the menus
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "golden_mismatches": mismatches,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        print(f"Wrote {args.output}")
+
+    return 1 if mismatches else 0
+
+
+def compare(args: argparse.Namespace) -> int:
+    with open(args.base, "r") as f:
+        base = json.load(f)
+    with open(args.new, "r") as f:
+        new = json.load(f)
+    print(f"{base['commit'] or args.base} -> {new['commit'] or args.new}")
+
+    def compare_time(
+        label: str, before: Optional[float], after: Optional[float]
+    ) -> bool:
+        if not before or after is None:
+            return False
+        change = after / before - 1
+        slower = change > args.tolerance
+        if slower or change < -args.tolerance:
+            print(
+                f"{format_ms(before):>12}{format_ms(after):>12}{change:>+7.0%}  {label}"
+            )
+        return slower
+
+    slower = False
+    for key, before in base["totals"]["time"].items():
+        slower |= compare_time(key, before, new["totals"]["time"].get(key))
+    for stage, before in base["totals"]["stages"].items():
+        slower |= compare_time(stage, before, new["totals"]["stages"].get(stage))
+
+    changed = False
+    for name, menu in new["menus"].items():
+        before = base["menus"].get(name)
+        if before is None:
+            print(f"  {name} is new")
+        elif before["categories"] != menu["categories"]:
+            changed = True
+            print(
+                f"  {name}: the categories changed, golden status {before['golden']['status']} -> {menu['golden']['status']}"
+            )
+        if menu["peak_memory"] > (before or menu)["peak_memory"] * (1 + args.tolerance):
+            print(
+                f"  {name}: peak memory {_common.format_bytes(before['peak_memory'])} -> "
+                f"{_common.format_bytes(menu['peak_memory'])}"
+            )
+
+    if not slower and not changed:
+        print(f"No changes beyond the tolerance of {args.tolerance:.0%}")
+    return 1 if changed or (slower and args.fail_on_slowdown) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(required=True)
+
+    running = subparsers.add_parser("run", help="Runs the suite over the menus")
+    running.set_defaults(function=run)
+    running.add_argument(
+        "directory", nargs="?", default=_common.DATA_DIR, help="Default is data"
+    )
+    running.add_argument("--output", help="Where the JSON results are written to")
+    running.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Every time is the best of this many runs. Default is 5",
+    )
+    running.add_argument(
+        "--gpt",
+        action="store_true",
+        help="Include the GPT filter, it needs OPEN_AI_API_KEY",
+    )
+    running.add_argument(
+        "--pdf-mode",
+        default=PDF_SAVE_MODE,
+        choices=PDF_SAVE_MODES,
+        help="How the PDFs are saved. Default is conf.PDF_SAVE_MODE",
+    )
+    running.add_argument(
+        "--update-golden",
+        action="store_true",
+        help="Write the categories found to the golden files",
+    )
+
+    comparing = subparsers.add_parser(
+        "compare", help="Compares the results of two runs"
+    )
+    comparing.set_defaults(function=compare)
+    comparing.add_argument("base", help="The JSON results of the base run")
+    comparing.add_argument("new", help="The JSON results of the new run")
+    comparing.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative changes of the times below this are ignored. Default is 0.1",
+    )
+    comparing.add_argument(
+        "--fail-on-slowdown",
+        action="store_true",
+        help="Exit with 1 if anything got slower, not only if the categories changed",
+    )
+
+    args = parser.parse_args()
+    # The pipeline logs every menu it processes
+    logging.disable(logging.INFO)
+    sys.exit(args.function(args))
+
+
+if __name__ == "__main__":
+    main()
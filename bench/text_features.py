@@ -0,0 +1,157 @@
+"""
+Benchmarks the text filters on the largest menus in the data folder.
+
+For every menu it reports the time of the text filters of default_filters reading the TextFeatures the shared
+TextMatcher extracts once per line, and of the same filters scanning the text of every line themselves, as they did
+before the matcher. It checks both give every line the same confidence.
+
+    poetry run python bench/text_features.py [number of menus] [data folder]
+"""
+import re
+import sys
+import time
+from collections import Counter
+from typing import List
+
+import _common
+
+from file_handler import load_ocr_data
+from filters import LineFilter, default_filters
+from filters.base import Filter, LineWiseFilter
+from filters.filter_classes import (
+    FilterByEnding,
+    FilterContainsNumbers,
+    FilterDuplicateText,
+    FilterNotStartWithCapital,
+    FilterPriceLines,
+    TextFilter,
+)
+from models import Line
+
+CONF_THRESHOLD = 0.75
+REPEATS = 50
+
+
+class RescanPriceLines(LineWiseFilter):
+    def __init__(self, filter: FilterPriceLines):
+        super().__init__(filter.confidence_multiplier)
+        self.currency_signs = filter.currency_signs
+
+    def line_multiplier(self, line: Line) -> float:
+        text = line.text.lower()
+        if any(map(text.__contains__, self.currency_signs)):
+            line.analysis.type = "price"
+            return self.confidence_multiplier
+        return 1
+
+
+class RescanContainsNumbers(LineWiseFilter):
+    def line_multiplier(self, line: Line) -> float:
+        if any(map(str.isdigit, line.text)):
+            return self.confidence_multiplier
+        return 1
+
+
+class RescanNotStartWithCapital(LineWiseFilter):
+    def line_multiplier(self, line: Line) -> float:
+        if not line.text[0].isupper():
+            return self.confidence_multiplier
+        return 1
+
+
+class RescanByEnding(LineWiseFilter):
+    def __init__(self, filter: FilterByEnding):
+        super().__init__(filter.confidence_multiplier)
+        self.unlikely_endings = filter.unlikely_endings
+
+    def line_multiplier(self, line: Line) -> float:
+        if line.text[-1] in self.unlikely_endings:
+            return self.confidence_multiplier
+        return 1
+
+
+class RescanDuplicateText(Filter):
+    needs_all_lines = True
+    cost = 2
+
+    def __init__(self, filter: FilterDuplicateText):
+        super().__init__(filter.confidence_multiplier)
+        self.pattern = filter.pattern
+
+    def apply(self, lines: List[Line]) -> None:
+        regex = re.compile(self.pattern)
+        text_counter = Counter([regex.sub("", line.text) for line in lines])
+        for line in lines:
+            if text_counter[regex.sub("", line.text)] > 1:
+                line.analysis.category_confidence *= self.confidence_multiplier
+
+
+def text_filters() -> List[Filter]:
+    return [
+        filter
+        for filter in default_filters(CONF_THRESHOLD)
+        if isinstance(filter, (TextFilter, FilterDuplicateText))
+    ]
+
+
+def rescanning(filter: Filter) -> Filter:
+    """Returns the filter as it was before the TextMatcher."""
+    if isinstance(filter, FilterPriceLines):
+        return RescanPriceLines(filter)
+    if isinstance(filter, FilterContainsNumbers):
+        return RescanContainsNumbers(filter.confidence_multiplier)
+    if isinstance(filter, FilterNotStartWithCapital):
+        return RescanNotStartWithCapital(filter.confidence_multiplier)
+    if isinstance(filter, FilterByEnding):
+        return RescanByEnding(filter)
+    if isinstance(filter, FilterDuplicateText):
+        return RescanDuplicateText(filter)
+    raise TypeError(f"No rescanning version of {filter.__class__.__name__}")
+
+
+def time_filter(path: str, line_filter: LineFilter):
+    """Returns the best time of the filter over fresh copies of the menu and the confidences of its lines."""
+    best = float("inf")
+    for _ in range(REPEATS):
+        menu = load_ocr_data(path)
+        start = time.perf_counter()
+        line_filter.get_possible_categories(menu, CONF_THRESHOLD)
+        best = min(best, time.perf_counter() - start)
+    return best, [line.analysis.category_confidence for line in menu.lines]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    directory = sys.argv[2] if len(sys.argv) > 2 else _common.DATA_DIR
+    sizes = {
+        path: len(load_ocr_data(path).lines) for path in _common.menu_files(directory)
+    }
+    largest = sorted(sizes, key=sizes.get, reverse=True)[:count]
+
+    # Nothing is pruned, so every filter sees every line
+    matcher = LineFilter(*text_filters(), prune=False)
+    rescan = LineFilter(*map(rescanning, text_filters()), prune=False)
+
+    print(f"{'menu':<16}{'lines':>7}{'rescan':>12}{'matcher':>12}{'speedup':>10}")
+    totals = [0.0, 0.0]
+    for path in largest:
+        rescan_time, rescan_confidences = time_filter(path, rescan)
+        matcher_time, matcher_confidences = time_filter(path, matcher)
+        assert rescan_confidences == matcher_confidences, path
+        totals[0] += rescan_time
+        totals[1] += matcher_time
+
+        name = path.rsplit("/", 1)[-1]
+        print(
+            f"{name:<16}{sizes[path]:>7}{rescan_time * 1000:>9.2f} ms{matcher_time * 1000:>9.2f} ms"
+            f"{rescan_time / matcher_time:>9.2f}x"
+        )
+
+    print(
+        f"{'total':<16}{'':>7}{totals[0] * 1000:>9.2f} ms{totals[1] * 1000:>9.2f} ms"
+        f"{totals[0] / totals[1]:>9.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import os
+import time
+import traceback
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import attr
+
+import conf
+from conf import GPT_BATCH_MENUS, PROFILER
+from logger import get_logger
+from metrics import METRICS, profile
+from models import Menu
+from output import ProcessResult, Sink
+
+logger = get_logger(__name__)
+
+
+@attr.s
+class FileResult:
+    """Outcome of processing a single OCR file in a batch."""
+
+    path: str = attr.ib()
+    ok: bool = attr.ib()
+    categories: int = attr.ib(default=0)
+    duration: float = attr.ib(default=0.0)
+    error: Optional[str] = attr.ib(default=None)
+    # The metrics recorded while processing the file in a worker process, merged into the METRICS of the parent
+    metrics: Optional[dict] = attr.ib(default=None, repr=False)
+
+
+@attr.s
+class BatchSummary:
+    """Aggregated results of a batch run."""
+
+    results: List[FileResult] = attr.ib(factory=list)
+    duration: float = attr.ib(default=0.0)
+    workers: int = attr.ib(default=1)
+
+    @property
+    def failed(self) -> List[FileResult]:
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def succeeded(self) -> List[FileResult]:
+        return [result for result in self.results if result.ok]
+
+    def log(self, slowest: int = 5) -> None:
+        total_categories = sum(result.categories for result in self.succeeded)
+        logger.info(
+            f"Processed {len(self.results)} files in {self.duration:.2f}s using {self.workers} worker(s): "
+            f"{len(self.succeeded)} succeeded, {len(self.failed)} failed, {total_categories} possible categories"
+        )
+
+        for result in sorted(self.succeeded, key=lambda r: r.duration, reverse=True)[
+            :slowest
+        ]:
+            logger.info(f"  {result.duration:.2f}s {result.path}")
+
+        for result in self.failed:
+            logger.error(f"  FAILED {result.path}: {result.error}")
+
+
+def find_ocr_files(directory: str) -> List[str]:
+    """Returns the paths of all the JSON files in the directory, sorted by name."""
+    return [
+        os.path.join(directory, file)
+        for file in sorted(os.listdir(directory))
+        if file.endswith(".json")
+    ]
+
+
+def _init_worker(api_key: Optional[str], rate_limit_share: float = 1.0) -> None:
+    """
+    Sets up the module level state of a worker process.
+
+    Workers started with the "spawn" method re-import every module, so anything the parent
+    decided at runtime has to be passed in explicitly instead of relying on import time defaults.
+    The workers can't share the OpenAI rate limits, each of them stays within `rate_limit_share` of them.
+    """
+    import conf
+    from filters import gpt_client, gpt_filter
+
+    conf.OPEN_AI_API_KEY = api_key
+    gpt_client.RATE_LIMIT_SHARE = rate_limit_share
+    gpt_filter.OPEN_AI_API_KEY = api_key
+    gpt_filter.MakeAIDoTheFiltering.set_openai_api_key()
+
+
+def _run_isolated(process: Callable[[str], ProcessResult], path: str) -> FileResult:
+    """Processes a single file, turning any exception into a failed FileResult."""
+    start = time.perf_counter()
+    try:
+        result = process(path)
+    except Exception as e:
+        logger.debug(traceback.format_exc())
+        return FileResult(
+            path=path,
+            ok=False,
+            duration=time.perf_counter() - start,
+            error=f"{e.__class__.__name__}: {e}",
+        )
+    return FileResult(
+        path=path,
+        ok=True,
+        categories=len(result.categories),
+        duration=time.perf_counter() - start,
+    )
+
+
+def _process_file(
+    path: str,
+    sinks: Sequence[Sink] = (),
+    profiler: Optional[str] = PROFILER,
+    collect_metrics: bool = False,
+) -> FileResult:
+    # imported here so that the worker processes don't need to pickle the function
+    from main import process_ocr
+
+    if collect_metrics:
+        METRICS.reset()
+    name = os.path.splitext(os.path.basename(path))[0]
+    with profile(name, profiler):
+        result = _run_isolated(lambda path: process_ocr(path, sinks), path)
+    if collect_metrics:
+        result.metrics = METRICS.snapshot()
+    return result
+
+
+def _process_group(
+    paths: List[str],
+    sinks: Sequence[Sink] = (),
+    profiler: Optional[str] = PROFILER,
+    collect_metrics: bool = False,
+) -> List[FileResult]:
+    """
+    Processes the files together, so the GPT filter packs the lines of all of them into the same requests.
+
+    The files are loaded and written one at a time, so a file that fails only fails itself. If the filters fail,
+    the files are processed again one by one. The duration of a file includes its share of the filtering time,
+    proportional to its number of lines.
+    """
+    if len(paths) == 1:
+        return [_process_file(paths[0], sinks, profiler, collect_metrics)]
+
+    from file_handler import load_ocr_data
+    from main import process_menus, write_result
+
+    if collect_metrics:
+        METRICS.reset()
+
+    results: Dict[str, FileResult] = {}
+    durations: Dict[str, float] = {}
+    menus: Dict[str, Menu] = {}
+
+    def fail(path: str, start: float, e: Exception):
+        logger.debug(traceback.format_exc())
+        results[path] = FileResult(
+            path=path,
+            ok=False,
+            duration=durations.get(path, 0.0) + time.perf_counter() - start,
+            error=f"{e.__class__.__name__}: {e}",
+        )
+
+    name = os.path.splitext(os.path.basename(paths[0]))[0]
+    with profile(f"{name}+{len(paths) - 1}", profiler):
+        for path in paths:
+            start = time.perf_counter()
+            try:
+                menus[path] = load_ocr_data(path)
+            except Exception as e:
+                fail(path, start, e)
+            durations[path] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            processed = process_menus(list(menus.values()), list(menus))
+        except Exception:
+            logger.debug(traceback.format_exc())
+            logger.warning(
+                f"Filtering {len(menus)} files together failed, processing them one by one"
+            )
+            for path in menus:
+                # Already inside the profiler of the group
+                results[path] = _process_file(path, sinks, None)
+            processed = []
+
+        total_lines = sum(len(menu.lines) for menu in menus.values()) or 1
+        filtering = time.perf_counter() - start
+        for result in processed:
+            durations[result.path] += filtering * len(result.menu.lines) / total_lines
+            start = time.perf_counter()
+            try:
+                write_result(result, sinks)
+            except Exception as e:
+                fail(result.path, start, e)
+                continue
+            results[result.path] = FileResult(
+                path=result.path,
+                ok=True,
+                categories=len(result.categories),
+                duration=durations[result.path] + time.perf_counter() - start,
+            )
+
+    ordered = [results[path] for path in paths]
+    if collect_metrics:
+        # Merged once by the parent, so only one of the results carries them
+        ordered[0].metrics = METRICS.snapshot()
+    return ordered
+
+
+def iter_batch(
+    paths: Iterable[str],
+    workers: int = 1,
+    ordered: bool = True,
+    sinks: Sequence[Sink] = (),
+    profiler: Optional[str] = PROFILER,
+) -> Iterator[FileResult]:
+    """
+    Processes the OCR files and yields a FileResult for each of them.
+
+    When the GPT filter is used, up to conf.GPT_BATCH_MENUS files are filtered together, so their lines are packed
+    into the same requests.
+
+    Args:
+        paths (Iterable[str]): The OCR JSON files to process.
+        workers (int, optional): The number of worker processes. 1 processes the files in the current process. Default is 1.
+        ordered (bool, optional): Whether the results are yielded in the order of `paths` or as soon as they are done. Default is True.
+        sinks (Sequence[Sink], optional): Where the results of every file are written to. Default is nowhere.
+        profiler (str, optional): The profiler run around every file or group of files, see `metrics.profile`. Default is conf.PROFILER.
+    """
+    paths = list(paths)
+
+    # Without GPT nothing is gained by filtering the files together, so every file is reported as soon as it's done
+    group_size = max(1, GPT_BATCH_MENUS) if conf.OPEN_AI_API_KEY else 1
+    # Don't leave workers idle by packing the files into fewer groups than there are workers
+    group_size = min(group_size, max(1, -(-len(paths) // max(1, workers))))
+    groups = [paths[i : i + group_size] for i in range(0, len(paths), group_size)]
+
+    if workers <= 1:
+        for group in groups:
+            yield from _process_group(group, sinks, profiler)
+        return
+
+    # multiprocessing is only imported when it's used
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(conf.OPEN_AI_API_KEY, 1 / workers),
+    ) as executor:
+        futures = [
+            executor.submit(_process_group, group, sinks, profiler, True)
+            for group in groups
+        ]
+        for future in futures if ordered else as_completed(futures):
+            for result in future.result():
+                if result.metrics:
+                    METRICS.merge(result.metrics)
+                yield result
+
+
+def run_batch(
+    paths: Iterable[str],
+    workers: int = 1,
+    ordered: bool = True,
+    sinks: Sequence[Sink] = (),
+    profiler: Optional[str] = PROFILER,
+) -> BatchSummary:
+    """Processes the OCR files in parallel and returns a summary of the run."""
+    start = time.perf_counter()
+    summary = BatchSummary(workers=workers)
+
+    for result in iter_batch(paths, workers, ordered, sinks, profiler):
+        if result.ok:
+            logger.info(
+                f"Done {result.path}: {result.categories} possible categories in {result.duration:.2f}s"
+            )
+        else:
+            logger.error(f"Failed {result.path}: {result.error}")
+        summary.results.append(result)
+
+    summary.duration = time.perf_counter() - start
+    return summary
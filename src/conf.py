@@ -1,7 +1,10 @@
 import os
-from dotenv import load_dotenv
 
-load_dotenv(".env")
+# Loading dotenv takes a few milliseconds, which are saved when there's no .env file
+if os.path.exists(".env"):
+    from dotenv import load_dotenv
+
+    load_dotenv(".env")
 
 # The confidence threshold required for a line to be considered a category, defaults to 0.75
 CONF_THRESHOLD = float(os.getenv("CONF_THRESHOLD", 0.75))
@@ -12,12 +15,98 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 # Key for connecting to OpenAI's API for the AI based filter
 OPEN_AI_API_KEY = os.getenv("OPEN_AI_API_KEY")
 
+# Base URL of the OpenAI API, can be pointed at a local fake endpoint for testing
+OPEN_AI_API_BASE = os.getenv("OPEN_AI_API_BASE") or "https://api.openai.com/v1"
+
+# Maximum number of requests to OpenAI's API that are in flight at the same time, defaults to 4
+OPEN_AI_MAX_CONCURRENCY = int(os.getenv("OPEN_AI_MAX_CONCURRENCY") or 4)
+
+# Rate limits of the OpenAI account, the requests are throttled to stay below them
+OPEN_AI_REQUESTS_PER_MINUTE = int(os.getenv("OPEN_AI_REQUESTS_PER_MINUTE") or 3500)
+OPEN_AI_TOKENS_PER_MINUTE = int(os.getenv("OPEN_AI_TOKENS_PER_MINUTE") or 90000)
+
+# How many times a rate limited or failed request is retried before giving up, defaults to 5
+OPEN_AI_MAX_RETRIES = int(os.getenv("OPEN_AI_MAX_RETRIES") or 5)
+
+# How many menus of a directory are filtered together, so the AI based filter packs their lines into the same
+# requests instead of sending a half-empty request per menu, defaults to 8
+GPT_BATCH_MENUS = int(os.getenv("GPT_BATCH_MENUS") or 8)
+
+# How many times the lines GPT skipped or gave an invalid answer for are asked about again, defaults to 2
+GPT_PARTIAL_RETRIES = int(os.getenv("GPT_PARTIAL_RETRIES") or 2)
+
+# Where the answers of the AI based filter are cached, defaults to .cache/gpt_classifications.sqlite
+GPT_CACHE_PATH = os.getenv("GPT_CACHE_PATH") or ".cache/gpt_classifications.sqlite"
+
+# How many days a cached answer is valid for, defaults to 30
+GPT_CACHE_TTL_DAYS = float(os.getenv("GPT_CACHE_TTL_DAYS") or 30)
+
+# Maximum number of cached answers, the least recently used ones are evicted first, defaults to 100000
+GPT_CACHE_MAX_ENTRIES = int(os.getenv("GPT_CACHE_MAX_ENTRIES") or 100000)
+
+# Where the factors of the filters recorded for every menu by src/sweep.py are cached, defaults to .cache/factors
+FACTOR_CACHE_DIR = os.getenv("FACTOR_CACHE_DIR") or ".cache/factors"
+
+# The model of the classifier filter, trained with src/train_classifier.py. The filter is skipped if it doesn't exist
+CLASSIFIER_MODEL_PATH = (
+    os.getenv("CLASSIFIER_MODEL_PATH") or "models/category_classifier.json"
+)
+
+# How much the classifier filter reduces the confidence of lines it thinks aren't categories, from 0 to 1, defaults to 0.5
+CLASSIFIER_WEIGHT = float(os.getenv("CLASSIFIER_WEIGHT") or 0.5)
+
 # Model used for the AI based filter
 MODEL_ID = "gpt-3.5-turbo"
 
 # Maximum number of tokens per message. limit is 4096 tokens, but we will use 3500 to be safe
 TOKEN_LIMIT = 3500
 
+# How the OCR data is loaded, defaults to "eager"
+# "eager" decodes the whole file at once, "lazy" decodes it page by page and only creates the words when they are used
+OCR_LOADER = os.getenv("OCR_LOADER") or "eager"
+
+# How the highlighted PDFs are saved, defaults to "full"
+# "full" rewrites the whole document, "compact" also removes unused objects and compresses it,
+# "incremental" appends the highlights to a copy of the source PDF without rewriting it
+# "pages" only writes the pages with highlights, for large PDFs where only a few pages have categories
+PDF_SAVE_MODE = os.getenv("PDF_SAVE_MODE") or "full"
+
+# How often the directory watched with --watch is scanned for new files in seconds, defaults to 1
+# With inotify_simple installed it is also scanned as soon as something changes in it
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL") or 1)
+
+# How long a watched file has to be unmodified before it is processed in seconds, defaults to 0.5
+WATCH_SETTLE_SECONDS = float(os.getenv("WATCH_SETTLE_SECONDS") or 0.5)
+
+# How long a watched OCR file waits for its source file before it is processed without it in seconds, defaults to 30
+WATCH_SOURCE_TIMEOUT = float(os.getenv("WATCH_SOURCE_TIMEOUT") or 30)
+
+# Maximum number of watched files waiting for a worker, the directory isn't scanned while it's full, defaults to 32
+WATCH_QUEUE_SIZE = int(os.getenv("WATCH_QUEUE_SIZE") or 32)
+
+# Address the HTTP service listens on, defaults to 127.0.0.1:8080
+SERVER_HOST = os.getenv("SERVER_HOST") or "127.0.0.1"
+SERVER_PORT = int(os.getenv("SERVER_PORT") or 8080)
+
+# Maximum number of menus the HTTP service processes at the same time, defaults to 4
+SERVER_MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY") or 4)
+
+# Maximum number of requests waiting for a free slot, further requests are rejected with 503, defaults to 64
+SERVER_MAX_PENDING = int(os.getenv("SERVER_MAX_PENDING") or 64)
+
+# Maximum size of a request to the HTTP service in MiB, defaults to 50
+SERVER_MAX_UPLOAD_MB = float(os.getenv("SERVER_MAX_UPLOAD_MB") or 50)
+
+# Longest side in pixels of the source images embedded in the highlighted PDFs, larger images are downscaled.
+# The default 0 embeds the images as they are
+SOURCE_IMAGE_MAX_SIZE = int(os.getenv("SOURCE_IMAGE_MAX_SIZE") or 0)
+
+# Profiler run around the processing of every file, "cprofile" or "pyinstrument", defaults to none
+PROFILER = os.getenv("PROFILER") or None
+
+# Where the profiles are saved, one per processed file, defaults to profiles
+PROFILE_DIR = os.getenv("PROFILE_DIR") or "profiles"
+
 # Different possible scales for PDFs and images
 PDF_SCALES = {"inch": 72, "mm": 2.83465, "pixel": 1}
 
@@ -36,5 +125,5 @@ IMG_EXTENSIONS = [
     "PSD",
 ]
 
-# Extensions that can be processed
-SOURCE_EXTENSIONS = IMG_EXTENSIONS + ["PDF"]
+# Extensions that can be processed, in the order they are preferred in when an OCR file has several source files
+SOURCE_EXTENSIONS = ["PDF"] + IMG_EXTENSIONS
@@ -1,106 +1,402 @@
-import glob
+import hashlib
+import mmap
 import os
-import fitz
-from fitz import Document
-import json
-from conf import OPEN_AI_API_KEY, SOURCE_EXTENSIONS
+import shutil
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import attr
+import conf
+from conf import OCR_LOADER, PDF_SAVE_MODE, SOURCE_EXTENSIONS
 
 from models import *
-from img2pdf import img_to_fitz
 from logger import get_logger
+from metrics import METRICS
+
+if TYPE_CHECKING:
+    # fitz and PIL are imported by the functions that need them, runs without PDF output never load them
+    from fitz import Document
 
 logger = get_logger(__name__)
 
-OUTPUT_DIR = "output_ai" if OPEN_AI_API_KEY else "output"
 
+def default_output_dir() -> str:
+    """The folder the results are written to, "output_ai" when the AI based filter is used, "output" otherwise."""
+    # Read at call time, so a key set after the import (e.g. in a batch worker) is taken into account
+    return "output_ai" if conf.OPEN_AI_API_KEY else "output"
+
+
+@attr.s
+class IndexedDirectory:
+    # The modification time of the directory when it was listed, None if it is kept up to date with add and remove
+    mtime_ns: Optional[int] = attr.ib()
+    # The names of the source files by the name of the OCR file they belong to, without its extension
+    sources: Dict[str, Dict[str, str]] = attr.ib(factory=dict)
+
+
+class SourceIndex:
+    """
+    The source files of the OCR data in directories, so finding the source of an OCR file doesn't list its directory.
+
+    A directory is listed once when a source is first looked up in it, and again only when its modification time
+    changed, i.e. files were added to it or removed from it. A watcher that lists the directory anyway reports the
+    changes with `add` and `remove` instead, which stops the checks of the modification time.
+
+    When there are several source files for the same OCR data, the one whose extension comes first in `extensions`
+    is used, so a PDF is preferred over an image.
+
+    Args:
+        extensions (List[str], optional): The extensions of the source files, from the most preferred one, in any
+        case. Default is conf.SOURCE_EXTENSIONS.
+    """
+
+    def __init__(self, extensions: List[str] = SOURCE_EXTENSIONS):
+        self.priority = {
+            extension.upper(): rank for rank, extension in enumerate(extensions)
+        }
+        self.directories: Dict[str, IndexedDirectory] = {}
+        self._lock = threading.Lock()
+
+    def _split(self, name: str) -> Optional[Tuple[str, str]]:
+        """Returns the name without the extension and the extension of a source file, None for other files."""
+        base, extension = os.path.splitext(name)
+        extension = extension[1:].upper()
+        return (base, extension) if extension in self.priority else None
+
+    def index_directory(self, directory: str) -> IndexedDirectory:
+        """Lists the directory and indexes all the source files in it, replacing what was indexed before."""
+        # Taken before listing it, so files added while it is listed cause another listing later
+        mtime_ns = os.stat(directory).st_mtime_ns
+        indexed = IndexedDirectory(mtime_ns)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                split = self._split(entry.name)
+                if split:
+                    indexed.sources.setdefault(split[0], {})[split[1]] = entry.name
+        with self._lock:
+            self.directories[os.path.abspath(directory)] = indexed
+        return indexed
+
+    def add(self, path: str):
+        """Adds a file that was created, other files than source files are ignored."""
+        directory, name = os.path.split(os.path.abspath(path))
+        split = self._split(name)
+        with self._lock:
+            indexed = self.directories.setdefault(directory, IndexedDirectory(None))
+            indexed.mtime_ns = None
+            if split:
+                indexed.sources.setdefault(split[0], {})[split[1]] = name
+
+    def remove(self, path: str):
+        """Removes a file that was deleted."""
+        directory, name = os.path.split(os.path.abspath(path))
+        split = self._split(name)
+        with self._lock:
+            indexed = self.directories.setdefault(directory, IndexedDirectory(None))
+            indexed.mtime_ns = None
+            if not split:
+                return
+            base, extension = split
+            sources = indexed.sources.get(base, {})
+            if sources.get(extension) == name:
+                del sources[extension]
+                if not sources:
+                    del indexed.sources[base]
+
+    def clear(self):
+        with self._lock:
+            self.directories.clear()
+
+    def get(self, json_path: str) -> Optional[str]:
+        """Returns the path to the source file of the OCR data, next to it and with the same name, None if there's none."""
+        directory, name = os.path.split(json_path)
+        key = os.path.abspath(directory)
+        with self._lock:
+            indexed = self.directories.get(key)
+        try:
+            if indexed is None or (
+                indexed.mtime_ns is not None
+                and os.stat(key).st_mtime_ns != indexed.mtime_ns
+            ):
+                indexed = self.index_directory(key)
+        except OSError:
+            return None
 
-def get_source_file(json_path):
-    # Get the base filename without extension
-    base_filename = os.path.splitext(os.path.basename(json_path))[0]
+        with self._lock:
+            sources = dict(indexed.sources.get(os.path.splitext(name)[0], {}))
+        if not sources:
+            return None
+        best = min(sources, key=self.priority.__getitem__)
+        return os.path.join(directory, sources[best])
 
-    # Get the directory name
-    dir_name = os.path.dirname(json_path)
 
-    # Glob for files with the same basename
-    matching_files = glob.glob(os.path.join(dir_name, base_filename + ".*"))
+# Shared by all the lookups of the process, so every directory is only listed once
+SOURCE_INDEX = SourceIndex()
 
-    # Initialize the JSON and SOURCE files to None
-    source_file = None
 
-    # Go through each file and assign it to the appropriate variable based on its extension
-    for file in matching_files:
-        file_upper = file.upper()
-        for ext in SOURCE_EXTENSIONS:
-            if file_upper.endswith("." + ext):
-                source_file = file
-                break
+def get_source_file(json_path, index: SourceIndex = SOURCE_INDEX) -> Optional[str]:
+    """
+    Returns the path to the source file the OCR data was made from, the PDF or image next to it with the same name.
+    If there are several, the one whose extension comes first in conf.SOURCE_EXTENSIONS is used.
+    """
+    return index.get(json_path)
 
-    return source_file
 
+def hash_file(path: str) -> str:
+    """Returns the SHA-256 of the content of the file, read in chunks so large files aren't loaded at once."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-def load_ocr_data(json_file) -> Menu:
-    with open(json_file, "r") as f:
-        return Menu.from_json(json.load(f))
 
+def load_ocr_data(json_file, loader: str = OCR_LOADER) -> Menu:
+    """
+    Loads the OCR data from the JSON file.
 
-def load_source_image(source_file: str) -> Document:
+    Args:
+        json_file (str): The path to the JSON file.
+        loader (str, optional): "eager" decodes the whole file and creates all the objects up front, "lazy" decodes it
+        one page at a time and only creates the words of a line when they are accessed. Default is conf.OCR_LOADER.
+    """
+    with METRICS.timer("load_seconds", loader=loader):
+        if loader == "lazy":
+            with open(json_file, "r") as f:
+                return Menu.from_json_stream(f)
+        return Menu.from_json_file(json_file)
+
+
+def load_source_image(source_file: str) -> "Document":
     # load the PDF or JPEG
     file_type: str = os.path.splitext(source_file)[-1].upper()
 
     if file_type == ".PDF":
-        return fitz.Document(source_file)
+        return open_pdf(source_file)
     else:
+        from img2pdf import img_to_fitz
+
         return img_to_fitz(source_file)
 
 
-def save_csv(lines: List[Line], filename: str):
-    if OPEN_AI_API_KEY:
+def open_pdf(path: str) -> "Document":
+    """
+    Opens the PDF from a memory map of the file.
+
+    MuPDF only parses the objects of the pages that are used, and the OS only reads those parts of the file. The map
+    is shared with other processes reading the same file and is closed once the document is garbage collected.
+    Versions of PyMuPDF that don't accept a memoryview open the path instead.
+    """
+    import fitz
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can't be mapped, let MuPDF report the error
+            return fitz.Document(path)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        return fitz.Document(stream=view, filetype="pdf")
+    except TypeError:
+        # PyMuPDF 1.22 only accepts bytes, MuPDF opening the file itself also only reads the parts that are used
+        view.release()
+        mapped.close()
+        return fitz.Document(path)
+
+
+class InvalidSourceError(ValueError):
+    """A source file received in memory isn't a PDF or an image that can be read."""
+
+
+def load_source_bytes(data: bytes, filename: str) -> "Document":
+    """
+    Loads a PDF or an image that was received in memory, the filename is only used for its extension.
+
+    Raises:
+        InvalidSourceError: If the data can't be decoded.
+    """
+    from PIL import Image
+
+    try:
+        if os.path.splitext(filename)[-1].upper() == ".PDF":
+            import fitz
+
+            return fitz.Document(stream=data, filetype="pdf")
+
+        from img2pdf import img_to_fitz
+
+        return img_to_fitz(data)
+    # MuPDF raises RuntimeErrors, PIL OSErrors for data that isn't an image it knows
+    except (RuntimeError, OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidSourceError(
+            f"Can't read {filename}: {e.__class__.__name__}: {e}"
+        ) from e
+
+
+def save_csv(lines: List[Line], filename: str, output_dir: str):
+    if conf.OPEN_AI_API_KEY:
         logger.info(
             "The AI based filter was applied. This will result in the confindences being bogus because we only reduce the confidence if the for those with a high confidence to save on tokens."
         )
 
-    with open(os.path.join(OUTPUT_DIR, filename + ".csv"), "w") as f:
+    with open(os.path.join(output_dir, filename + ".csv"), "w") as f:
         f.write("text,confidence\n")
         for line in lines:
             f.write(f"{line.text},{line.analysis.category_confidence}\n")
 
 
+def group_lines_by_page(lines: List[Line]) -> Dict[int, List[Line]]:
+    """Groups the lines by the index of their page."""
+    lines_by_page: Dict[int, List[Line]] = defaultdict(list)
+    for line in lines:
+        lines_by_page[line.page_index].append(line)
+    return lines_by_page
+
+
+def highlight_lines(doc: "Document", lines: List[Line]) -> List[int]:
+    """
+    Draws the bounding boxes of the lines on the pages of the source document they come from.
+
+    Returns:
+        List[int]: The sorted indices of the pages that were drawn on, the other pages aren't loaded.
+    """
+    touched = []
+    for page_lines in group_lines_by_page(lines).values():
+        menu_page = page_lines[0].page
+        page = doc[menu_page.page_num - 1]
+        for line in page_lines:
+            line.bounding_box.draw(page, menu_page.unit)
+        touched.append(menu_page.page_num - 1)
+    return sorted(touched)
+
+
+def keep_pages(doc: "Document", pages: List[int]):
+    """Removes all but the given pages from the document, the objects only they used are dropped when it's saved with garbage collection."""
+    if len(pages) < len(doc):
+        doc.select(pages)
+
+
+@attr.s
+class PdfStats:
+    """How much of the source document was touched and written when saving the highlighted PDF."""
+
+    pages_touched: int = attr.ib()
+    pages_total: int = attr.ib()
+    bytes_written: int = attr.ib()
+    # The incremental mode copies the source file before appending to it
+    bytes_copied: int = attr.ib(default=0)
+
+    def __str__(self) -> str:
+        return (
+            f"{self.pages_touched}/{self.pages_total} pages touched, {self.bytes_written} bytes written"
+            + (f", {self.bytes_copied} bytes copied" if self.bytes_copied else "")
+        )
+
+
+def pdf_bytes(doc: "Document", pages: List[int], mode: str = PDF_SAVE_MODE) -> bytes:
+    """
+    Serializes the document in memory, see `write_pdf` for the modes. Documents in memory can't be saved
+    incrementally, so "incremental" serializes the whole document like "full".
+
+    Args:
+        doc (Document): The document to serialize, the other pages are removed from it in the "pages" mode.
+        pages (List[int]): The pages that were drawn on, only they are serialized in the "pages" mode.
+        mode (str, optional): Default is conf.PDF_SAVE_MODE.
+    """
+    if mode == "pages":
+        keep_pages(doc, pages)
+        return doc.tobytes(garbage=3, deflate=True)
+    if mode == "compact":
+        return doc.tobytes(garbage=3, deflate=True)
+    return doc.tobytes()
+
+
+def write_pdf(
+    doc: "Document",
+    output_path: str,
+    mode: str = PDF_SAVE_MODE,
+    pages: Optional[List[int]] = None,
+):
+    """
+    Saves the document to the output path.
+
+    Args:
+        doc (Document): The document to save, the other pages are removed from it in the "pages" mode.
+        output_path (str): Where to save the document.
+        mode (str, optional): "full" rewrites the whole document, "compact" also garbage collects unused objects and
+        compresses the streams, "incremental" appends the changes to a document that was opened from the output path,
+        "pages" only writes the given pages, compacted. Default is conf.PDF_SAVE_MODE.
+        pages (List[int], optional): The pages written in the "pages" mode. Default is all of them.
+    """
+    if mode == "incremental" and doc.name == output_path:
+        if doc.can_save_incrementally():
+            doc.saveIncr()
+            return
+        logger.debug(f"{output_path} can't be saved incrementally, rewriting it")
+        doc.save(output_path + ".tmp")
+        os.replace(output_path + ".tmp", output_path)
+    elif mode == "pages":
+        if pages is not None:
+            keep_pages(doc, pages)
+        doc.save(output_path, garbage=3, deflate=True)
+    elif mode == "compact":
+        doc.save(output_path, garbage=3, deflate=True)
+    else:
+        doc.save(output_path)
+
+
 def save_pdf(
     lines: List[Line],
     filename: str,
-    lines_to_pages: dict[int, int],
-    menu: Menu,
     json_file: str,
-):
+    output_dir: str,
+    mode: str = PDF_SAVE_MODE,
+) -> Optional[PdfStats]:
+    """
+    Saves the source file of the OCR data with the lines highlighted to `<output_dir>/<filename>.pdf`.
+
+    Args:
+        lines (List[Line]): The lines to highlight.
+        filename (str): The name of the output file, without the extension.
+        json_file (str): The path to the OCR data, the source file is looked up next to it.
+        output_dir (str): The folder the PDF is saved to.
+        mode (str, optional): How the PDF is saved, see `write_pdf`. Default is conf.PDF_SAVE_MODE.
+
+    Returns:
+        Optional[PdfStats]: How many pages were touched and bytes written, None if nothing was saved.
+    """
     source_file = get_source_file(json_file)
     if not source_file:
         logger.warning("No source file found, skipping PDF output")
-        return
-    doc = load_source_image(source_file)
-    if doc:
-        for line in lines:
-            page = doc[lines_to_pages[id(line)] - 1]
-            line.bounding_box.draw(page, menu.pages[lines_to_pages[id(line)] - 1].unit)
-            doc.save(os.path.join(OUTPUT_DIR, filename + ".pdf"))
+        return None
+    if not lines:
+        return None
 
+    output_path = os.path.join(output_dir, filename + ".pdf")
+    copied = 0
+    if mode == "incremental" and source_file.upper().endswith(".PDF"):
+        # Only the annotations are appended to a copy of the source instead of rewriting it
+        shutil.copyfile(source_file, output_path)
+        copied = os.path.getsize(output_path)
+        import fitz
 
-def save(
-    menu: Menu,
-    path: str,
-    possible_category_lines: List[Line],
-    lines_to_pages: dict[int, int],
-):
-    if not os.path.isdir(OUTPUT_DIR):
-        os.mkdir(OUTPUT_DIR)
-
-    filename_without_extension = os.path.splitext(os.path.basename(path))[0]
+        doc = fitz.Document(output_path)
+    else:
+        doc = load_source_image(source_file)
 
-    save_csv(possible_category_lines, filename_without_extension)
+    if not doc:
+        return None
 
-    save_pdf(
-        possible_category_lines,
-        filename_without_extension,
-        lines_to_pages,
-        menu,
-        path,
+    pages_total = len(doc)
+    pages = highlight_lines(doc, lines)
+    write_pdf(doc, output_path, mode, pages)
+    stats = PdfStats(
+        pages_touched=len(pages),
+        pages_total=pages_total,
+        bytes_written=os.path.getsize(output_path) - copied,
+        bytes_copied=copied,
     )
+    doc.close()
+
+    logger.debug(f"Saved {output_path}: {stats}")
+    return stats
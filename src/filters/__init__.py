@@ -1,41 +1,74 @@
-from typing import List
+from typing import List, Optional
 
+from conf import CLASSIFIER_MODEL_PATH, CLASSIFIER_WEIGHT
 from models import Line, Menu
 from .filter_classes import *
-from .base import LineFilter
+from .base import Filter, LineFilter
+from .classifier import FilterByClassifier
+from .factors import FactorCache, FactorMatrix, record_factors
 from .gpt_filter import MakeAIDoTheFiltering
+from .text_features import TextMatcher, text_matcher
+
+
+def default_filters(conf_threshold=0.75) -> List[Filter]:
+    """Returns the filters used by `calculate_confindences`, in the order they are applied."""
+    # The lower the number, the the higher the confidence reduction if the filter applies
+    filters = [
+        FilterPriceLines(0.5, currency_signs=["€", "$", "£", "Kč", "kr", "Kc", ",-"]),
+        FilterLongLines(0.8, dropoff_start=5),
+        FilterContainsNumbers(0.85),
+        FilterNotStartWithCapital(0.95),
+        FilterByOCRConfidence(0.8),
+        FilterDuplicateText(0.5),
+        FilterByEnding(
+            0.75, unlikely_endings=[".", ",", ";", "!", "?", ")", "]", "}", "-"]
+        ),
+        FilterFontSize(0.75, percentile=0.75),
+        FilterSameRowAsSomethingelse(0.85),
+        MakeAIDoTheFiltering(1, conf_threshold),
+    ]
+
+    # Only used once a model was trained, its weight works the other way round: the higher, the bigger the reduction
+    classifier = FilterByClassifier.from_file(CLASSIFIER_WEIGHT, CLASSIFIER_MODEL_PATH)
+    if classifier is not None:
+        filters.append(classifier)
+    return filters
 
 
 def calculate_confindences(
     menu: Menu,
-    lines_to_pages: dict[int, int],
     conf_threshold=0.75,  # randomly chosen valueba
+    line_filter: Optional[LineFilter] = None,
 ) -> List[Line]:
     """
     Filters lines from the provided menu and returns lines with a high category confidence.
 
     Args:
         menu (Menu): The menu from which to filter lines.
-        lines_to_pages (dict[int, int]): A mapping from line numbers to page numbers.
         conf_threshold (float, optional): The minimum category confidence required for a line to be returned. Default is 0.75.
+        line_filter (LineFilter, optional): The filter to use, so it can be reused between menus. Default is a new one with the default filters.
 
     Returns:
         List[Line]: A list of lines with category confidence above the provided threshold.
     """
 
-    # The lower the number, the the higher the confidence reduction if the filter applies
-    line_filter = LineFilter(
-        FilterPriceLines(0.5, currency_signs=["€", "$", "£", "Kč", "kr", "Kc", ",-"]),
-        FilterLongLines(0.8, dropoff_start=5),
-        FilterContainsNumbers(0.85),
-        FilterNotStartWithCapital(0.95),
-        FilterByOCRConfidence(0.8),
-        FilterDuplicateText(0.5),
-        FilterByEnding(
-            0.75, unlikely_endings=[".", ",", ";", "!", "?", ")", "]", "}", "-"]
-        ),
-        FilterFontSize(0.75, percentile=0.75),
-        FilterSameRowAsSomethingelse(0.85, lines_to_pages),
-        MakeAIDoTheFiltering(1, conf_threshold),
-    )
+    if line_filter is None:
+        line_filter = LineFilter(*default_filters(conf_threshold))
     return line_filter.get_possible_categories(menu, conf_threshold)
+
+
+def calculate_confindences_many(
+    menus: List[Menu],
+    conf_threshold=0.75,
+    line_filter: Optional[LineFilter] = None,
+) -> List[List[Line]]:
+    """
+    Filters the lines of several menus at once, see `calculate_confindences`. The GPT filter packs the lines of all
+    of them into the same requests.
+
+    Returns:
+        List[List[Line]]: The lines with a high category confidence of every menu, in the order of `menus`.
+    """
+    if line_filter is None:
+        line_filter = LineFilter(*default_filters(conf_threshold))
+    return line_filter.get_possible_categories_many(menus, conf_threshold)
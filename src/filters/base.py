@@ -1,8 +1,14 @@
+import logging
+import time
 from abc import ABC, abstractmethod
-from typing import Tuple
+from typing import Dict, Tuple, Union
+
+import numpy as np
+
 from models import *
 
 from logger import get_logger
+from metrics import METRICS
 
 logger = get_logger(__name__)
 
@@ -11,30 +17,178 @@ class Filter(ABC):
     """
     Abstract base class for filters.
     Each filter must implement an `apply` method which modifies a provided list of lines.
+
+    Filters may only lower the confidence of a line, so once a line is below the threshold it can't come back and
+    the LineFilter stops passing it to the following filters. Filters that compute statistics over the whole menu
+    set `needs_all_lines` to still get every line. The LineFilter runs the filters in the order of their `cost`,
+    so the expensive ones see as few lines as possible.
     """
 
+    # Whether the filter needs all the lines of the menu, not only those still above the threshold
+    needs_all_lines: bool = False
+    # Relative cost of applying the filter to a line, cheaper filters are run first
+    cost: float = 1
+
     def __init__(self, confidence_multiplier: float):
         """Initialize the Filter with a confidence_multiplier parameter."""
         self.confidence_multiplier = confidence_multiplier
 
+    def signature(self) -> str:
+        """
+        Describes the filter and its parameters, factors recorded for a menu are only reused by filters with the
+        same signatures.
+        """
+        parameters = {
+            name: value
+            for name, value in sorted(vars(self).items())
+            if isinstance(value, (bool, int, float, str, list, tuple))
+        }
+        return f"{self.__class__.__name__}{parameters}"
+
+    def prepare(self, menu: Menu):
+        """Called with the menu the lines come from before the filter is applied to them."""
+        pass
+
     @abstractmethod
     def apply(self, lines: List[Line]):
         """Apply the filter on a given list of lines."""
         raise NotImplementedError
 
+    def apply_many(self, menus: List[Menu], line_lists: List[List[Line]]):
+        """
+        Applies the filter to the lines of several menus, `line_lists[i]` are lines of `menus[i]`.
+
+        Filters that can do the work of several menus at once, like sending their lines to GPT in the same requests,
+        override it, the others are prepared and applied one menu at a time.
+        """
+        for menu, lines in zip(menus, line_lists):
+            self.prepare(menu)
+            self.apply(lines)
+
+
+class LineWiseFilter(Filter):
+    """
+    Abstract base class for filters that look at every line on its own, without needing the other lines.
+    They implement `line_multiplier` instead of `apply`, which lets the LineFilter run consecutive line-wise filters
+    in a single pass over the lines.
+    """
+
+    @abstractmethod
+    def line_multiplier(self, line: Line) -> float:
+        """Returns the number the confidence of the line is multiplied by, 1 if the filter doesn't apply to it."""
+        raise NotImplementedError
+
+    def apply(self, lines: List[Line]):
+        for line in lines:
+            multiplier = self.line_multiplier(line)
+            if multiplier != 1:
+                line.analysis.category_confidence *= multiplier
+
+
+# Consecutive line-wise filters are fused into a single stage
+Stage = Union[Filter, Tuple[LineWiseFilter, ...]]
+
+
+def _clamp(line: Line):
+    if 0 < line.analysis.category_confidence > 1:
+        logger.warning(
+            f"Line {line.text} has a category confidence of {line.analysis.category_confidence}"
+        )
+        line.analysis.category_confidence = 1
+
+
+def _confidences(lines: List[Line]) -> np.ndarray:
+    return np.fromiter(
+        (line.analysis.category_confidence for line in lines),
+        dtype=np.float64,
+        count=len(lines),
+    )
+
 
 class LineFilter:
     """
     A filter that applies multiple sub-filters to a list of lines.
 
+    Every filter runs as a stage of its own, or when fusing, consecutive line-wise filters are fused into one stage,
+    which applies all of them to a line before moving on to the next one. After every stage the lines that fell below
+    the threshold are pruned, the next stages only see the remaining ones unless they need all the lines.
+
     Args:
         filters (Filter): The filters to be applied to the lines.
+        fuse (bool, optional): Whether to fuse the line-wise filters, otherwise every filter is a stage. On menus of a
+            few hundred lines the saved loops don't make a measurable difference, see bench/filters.py. Default is False.
+        prune (bool, optional): Whether to stop applying filters to the lines below the threshold. Default is True.
+        order_by_cost (bool, optional): Whether to run the filters from the cheapest to the most expensive one instead
+            of in the given order, filters of the same cost keep their order. Default is True.
+        record (bool, optional): Whether to record the factor every filter multiplied the confidence of every line
+            by into `factors`, see filters.factors. Every filter is then a stage of its own and nothing is pruned,
+            so every line gets a factor from every filter. Default is False.
     """
 
     filters: Tuple[Filter]
+    # How long every stage took in the last call of get_possible_categories(_many), over all its menus, in seconds
+    timings: Dict[str, float]
+    # When recording, the lines × stages matrix of the factors of every menu of the last call, in the order of `menus`
+    factors: List[np.ndarray]
 
-    def __init__(self, *filters: Filter):
+    def __init__(
+        self,
+        *filters: Filter,
+        fuse: bool = False,
+        prune: bool = True,
+        order_by_cost: bool = True,
+        record: bool = False,
+    ):
+        if record:
+            fuse = prune = False
         self.filters = filters
+        self.prune = prune
+        self.record = record
+        self.timings = {}
+        self.factors = []
+        self.stages = []
+        for filter in (
+            sorted(filters, key=lambda f: f.cost) if order_by_cost else filters
+        ):
+            if not fuse or not isinstance(filter, LineWiseFilter):
+                self.stages.append(filter)
+            elif self.stages and isinstance(self.stages[-1], tuple):
+                self.stages[-1] += (filter,)
+            else:
+                self.stages.append((filter,))
+
+    @staticmethod
+    def _apply_fused(filters: Tuple[LineWiseFilter, ...], lines: List[Line]):
+        line_multipliers = [filter.line_multiplier for filter in filters]
+        for line in lines:
+            analysis = line.analysis
+            for line_multiplier in line_multipliers:
+                multiplier = line_multiplier(line)
+                if multiplier != 1:
+                    analysis.category_confidence *= multiplier
+                    if analysis.category_confidence > 1:
+                        _clamp(line)
+
+    @staticmethod
+    def _needs_all_lines(stage: Stage) -> bool:
+        if isinstance(stage, tuple):
+            return any(filter.needs_all_lines for filter in stage)
+        return stage.needs_all_lines
+
+    @staticmethod
+    def _stage_name(stage: Stage) -> str:
+        if isinstance(stage, tuple):
+            return "+".join(filter.__class__.__name__ for filter in stage)
+        return stage.__class__.__name__
+
+    @property
+    def stage_names(self) -> List[str]:
+        """The names of the stages in the order they are run, which are the columns of the recorded factors."""
+        return [self._stage_name(stage) for stage in self.stages]
+
+    def signature(self) -> str:
+        """The signatures of the filters, see `Filter.signature`."""
+        return repr([filter.signature() for filter in self.filters])
 
     def get_possible_categories(self, menu: Menu, conf_threshold=0.76) -> List[Line]:
         """
@@ -47,8 +201,22 @@ class LineFilter:
         Returns:
             List[Line]: A list of lines with category confidence above the provided threshold.
         """
+        return self.get_possible_categories_many([menu], conf_threshold)[0]
 
-        def lines_above_confidence() -> List[Line]:
+    def get_possible_categories_many(
+        self, menus: List[Menu], conf_threshold=0.76
+    ) -> List[List[Line]]:
+        """
+        Filters the lines of several menus, see `get_possible_categories`.
+
+        Every stage is applied to all the menus before the next one, so the GPT filter can pack the remaining lines
+        of all of them into the same requests.
+
+        Returns:
+            List[List[Line]]: The lines above the threshold of every menu, in the order of `menus`.
+        """
+
+        def above_confidence(lines: List[Line]) -> List[Line]:
             return [
                 line
                 for line in lines
@@ -56,18 +224,59 @@ class LineFilter:
             ]
 
         # get all lines
-        lines = [line for page in menu.pages for line in page.lines]
-
-        for filter in self.filters:
-            filter.apply(lines)
-            logger.debug(
-                f"{filter.__class__.__name__} - remaining lines:{len(lines_above_confidence())}"
-            )
-            for line in lines:
-                if 0 < line.analysis.category_confidence > 1:
-                    logger.warning(
-                        f"Line {line.text} has a category confidence of {line.analysis.category_confidence}"
+        lines = [menu.lines for menu in menus]
+        # the lines still above the threshold
+        active = lines
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        self.timings = {}
+        if self.record:
+            self.factors = [
+                np.ones((len(menu_lines), len(self.stages))) for menu_lines in lines
+            ]
+        for column, stage in enumerate(self.stages):
+            if self.record:
+                before = [_confidences(menu_lines) for menu_lines in lines]
+            start = time.perf_counter()
+            targets = lines if self._needs_all_lines(stage) else active
+            if isinstance(stage, tuple):
+                for menu, menu_targets in zip(menus, targets):
+                    for filter in stage:
+                        filter.prepare(menu)
+                    self._apply_fused(stage, menu_targets)
+            else:
+                stage.apply_many(menus, targets)
+                for menu_targets in targets:
+                    for line in menu_targets:
+                        if line.analysis.category_confidence > 1:
+                            _clamp(line)
+
+            if self.prune:
+                active = [above_confidence(menu_active) for menu_active in active]
+            name = self._stage_name(stage)
+            self.timings[name] = time.perf_counter() - start
+            METRICS.observe("filter_seconds", self.timings[name], filter=name)
+            METRICS.inc("filter_lines_total", sum(map(len, targets)), filter=name)
+
+            if self.record:
+                for factors, menu_lines, menu_before in zip(
+                    self.factors, lines, before
+                ):
+                    np.divide(
+                        _confidences(menu_lines),
+                        menu_before,
+                        out=factors[:, column],
+                        where=menu_before > 0,
                     )
-                    line.analysis.category_confidence = 1
 
-        return lines_above_confidence()
+            if self.prune:
+                if debug:
+                    logger.debug(f"{name} - remaining lines:{sum(map(len, active))}")
+            # Counting the remaining lines is a pass over all of them, so it's only done when it is logged
+            elif debug:
+                remaining = sum(
+                    len(above_confidence(menu_lines)) for menu_lines in lines
+                )
+                logger.debug(f"{name} - remaining lines:{remaining}")
+
+        return [above_confidence(menu_active) for menu_active in active]
@@ -0,0 +1,220 @@
+import json
+from typing import List, Optional
+
+import attr
+import numpy as np
+
+from geometry import GeometryStore, centers_x, centers_y, heights, line_indices
+from models import Line
+from .filter_classes import GeometricFilter
+from .text_features import text_matcher
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+UNLIKELY_ENDINGS = ".,;!?)]}-:"
+
+# The columns of the feature matrix, in order
+FEATURES = [
+    "font_size_percentile",
+    "relative_font_size",
+    "contains_digit",
+    "contains_currency",
+    "word_count",
+    "row_mates",
+    "low_ocr_confidence",
+    "starts_with_capital",
+    "uppercase_ratio",
+    "unlikely_ending",
+    "page_position_y",
+    "page_position_x",
+]
+
+
+def line_features(lines: List[Line], geometry: GeometryStore) -> np.ndarray:
+    """
+    Builds the feature matrix of the lines, one row per line with the columns in FEATURES.
+
+    The geometric features are computed for all the lines at once from the GeometryStore, the font size percentile
+    is relative to the other lines passed in, so all the lines of the menu should be passed.
+    """
+    features = np.zeros((len(lines), len(FEATURES)))
+    if not lines:
+        return features
+
+    indices = line_indices(lines)
+    boxes = geometry.take_lines(indices)
+
+    font_sizes = heights(boxes)
+    # Ties share the rank of the first of them
+    order = np.argsort(font_sizes, kind="stable")
+    ranks = np.empty(len(lines))
+    ranks[order] = np.searchsorted(font_sizes[order], font_sizes[order], "left")
+    features[:, 0] = ranks / max(len(lines) - 1, 1)
+    median = np.median(font_sizes)
+    features[:, 1] = font_sizes / median if median > 0 else 1
+
+    features[:, 5] = np.log1p(geometry.count_row_mates(indices))
+
+    page_sizes = np.array(
+        [(line.page.width, line.page.height) if line.page else (1, 1) for line in lines]
+    )
+    features[:, 10] = centers_y(boxes) / np.maximum(page_sizes[:, 1], 1e-9)
+    features[:, 11] = centers_x(boxes) / np.maximum(page_sizes[:, 0], 1e-9)
+
+    matcher = text_matcher()
+    for i, line in enumerate(lines):
+        text = line.text
+        text_features = matcher.features(line)
+        letters = [char for char in text if char.isalpha()]
+        confidences = line.word_confidences()
+
+        features[i, 2] = text_features.digits
+        features[i, 3] = text_features.currency
+        features[i, 4] = np.log1p(len(confidences))
+        features[i, 6] = (
+            sum(confidence == "Low" for confidence in confidences) / len(confidences)
+            if confidences
+            else 0
+        )
+        features[i, 7] = text_features.starts_with_capital
+        features[i, 8] = sum(map(str.isupper, letters)) / len(letters) if letters else 0
+        features[i, 9] = bool(text) and text_features.ending in UNLIKELY_ENDINGS
+
+    return features
+
+
+@attr.s
+class LogisticModel:
+    """
+    A logistic regression over standardized features, small enough to be stored as JSON next to the code.
+
+    Args:
+        features (List[str]): The names of the features the model was trained on, in order.
+        mean (np.ndarray): The means the features are standardized with.
+        scale (np.ndarray): The standard deviations the features are standardized with.
+        weights (np.ndarray): The weight of every standardized feature.
+        bias (float): The intercept.
+    """
+
+    features: List[str] = attr.ib()
+    mean: np.ndarray = attr.ib(converter=np.asarray)
+    scale: np.ndarray = attr.ib(converter=np.asarray)
+    weights: np.ndarray = attr.ib(converter=np.asarray)
+    bias: float = attr.ib(converter=float)
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        """Returns the probability of every row of the feature matrix being a category."""
+        z = ((features - self.mean) / self.scale) @ self.weights + self.bias
+        return 1 / (1 + np.exp(-z))
+
+    @staticmethod
+    def fit(
+        features: np.ndarray,
+        labels: np.ndarray,
+        l2: float = 1.0,
+        balanced: bool = True,
+        iterations: int = 50,
+    ) -> "LogisticModel":
+        """
+        Fits the model with Newton's method.
+
+        Args:
+            features (np.ndarray): The N×F feature matrix.
+            labels (np.ndarray): 1 for the categories, 0 for the other lines.
+            l2 (float, optional): The strength of the L2 regularization of the weights. Default is 1.
+            balanced (bool, optional): Whether to weight the classes inversely to their frequency, categories are
+            only a few percent of the lines. Default is True.
+            iterations (int, optional): The maximum number of Newton steps. Default is 50.
+        """
+        labels = labels.astype(np.float64)
+        mean = features.mean(axis=0)
+        scale = features.std(axis=0)
+        scale[scale == 0] = 1
+        x = np.hstack([(features - mean) / scale, np.ones((len(features), 1))])
+
+        sample_weights = np.ones(len(labels))
+        if balanced and 0 < labels.sum() < len(labels):
+            positives = labels.mean()
+            sample_weights = np.where(
+                labels == 1, 0.5 / positives, 0.5 / (1 - positives)
+            )
+
+        # The intercept isn't regularized
+        penalty = np.full(x.shape[1], l2)
+        penalty[-1] = 0
+
+        beta = np.zeros(x.shape[1])
+        for _ in range(iterations):
+            p = 1 / (1 + np.exp(-(x @ beta)))
+            gradient = x.T @ (sample_weights * (p - labels)) + penalty * beta
+            hessian = (x.T * (sample_weights * p * (1 - p))) @ x + np.diag(penalty)
+            step = np.linalg.solve(hessian + 1e-9 * np.eye(len(beta)), gradient)
+            beta -= step
+            if np.abs(step).max() < 1e-8:
+                break
+
+        return LogisticModel(list(FEATURES), mean, scale, beta[:-1], beta[-1])
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "features": self.features,
+                    "mean": self.mean.tolist(),
+                    "scale": self.scale.tolist(),
+                    "weights": self.weights.tolist(),
+                    "bias": self.bias,
+                },
+                f,
+                indent=2,
+            )
+
+    @staticmethod
+    def load(path: str) -> "LogisticModel":
+        with open(path, "r") as f:
+            model = LogisticModel(**json.load(f))
+        if model.features != FEATURES:
+            raise ValueError(
+                f"The model in {path} was trained on different features, retrain it"
+            )
+        return model
+
+
+class FilterByClassifier(GeometricFilter):
+    """
+    Scores all the lines at once with a LogisticModel trained on labeled menus, see src/train_classifier.py.
+    The confidence of a line is reduced the less likely the model thinks it is a category, scaled by the weight.
+    """
+
+    # The font size percentile is relative to all the lines of the menu
+    needs_all_lines = True
+    cost = 3
+
+    def __init__(self, confidence_multiplier: float, model: LogisticModel):
+        super().__init__(confidence_multiplier)
+        self.model = model
+
+    @staticmethod
+    def from_file(
+        confidence_multiplier: float, path: str
+    ) -> Optional["FilterByClassifier"]:
+        """Loads the model from the path, returns None if it doesn't exist."""
+        try:
+            return FilterByClassifier(confidence_multiplier, LogisticModel.load(path))
+        except FileNotFoundError:
+            return None
+
+    def signature(self) -> str:
+        return f"{super().signature()}{self.model.weights.tolist()}{self.model.bias}"
+
+    def apply(self, lines: List[Line]):
+        if not lines:
+            return
+
+        probabilities = self.model.predict(line_features(lines, self._geometry()))
+        multipliers = 1 - (1 - probabilities) * self.confidence_multiplier
+
+        for line, multiplier in zip(lines, multipliers):
+            line.analysis.category_confidence *= float(multiplier)
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import zipfile
+from typing import Dict, List, Optional, Sequence
+
+import attr
+import numpy as np
+
+from conf import FACTOR_CACHE_DIR, GPT_BATCH_MENUS
+from file_handler import hash_file, load_ocr_data
+from logger import get_logger
+from models import Menu
+from .base import Filter, LineFilter
+
+logger = get_logger(__name__)
+
+# Weights of the filters by name, the filters missing from them are weighted with 1
+Weights = Dict[str, float]
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+@attr.s
+class FactorMatrix:
+    """
+    The factors every filter multiplied the confidence of every line of a menu by, recorded by a LineFilter with
+    `record=True`.
+
+    The confidence of a line is the product of its factors, so the filters can be weighted without running them
+    again: every factor is raised to the weight of its filter, 1 keeps the filter as it was recorded, 0 disables it
+    and 2 applies it twice. For the filters that multiply by a power of their `confidence_multiplier`, e.g.
+    FilterLongLines or FilterSameRowAsSomethingelse, the weight is the same as raising the multiplier to it.
+
+    GPT is only asked about the lines above the threshold when the factors are recorded, lines that a different
+    weighting lifts above it keep a factor of 1 for the AI based filter.
+
+    Args:
+        filters (List[str]): The names of the filters, in the order of the columns.
+        factors (np.ndarray): The lines × filters matrix of the factors.
+        positions (np.ndarray): The (page_index, line_index) of every line, in the order of the rows.
+        texts (List[str]): The text of every line, in the order of the rows.
+    """
+
+    filters: List[str] = attr.ib(converter=list)
+    factors: np.ndarray = attr.ib(converter=np.asarray)
+    positions: np.ndarray = attr.ib(converter=np.asarray)
+    texts: List[str] = attr.ib(converter=list)
+
+    @staticmethod
+    def from_menu(
+        menu: Menu, filters: List[str], factors: np.ndarray
+    ) -> "FactorMatrix":
+        lines = menu.lines
+        return FactorMatrix(
+            filters,
+            factors,
+            np.array([line.position for line in lines], dtype=np.int64).reshape(-1, 2),
+            [line.text for line in lines],
+        )
+
+    def weight_matrix(self, weights: Sequence[Weights]) -> np.ndarray:
+        """Returns the filters × len(weights) matrix of the exponents of the factors."""
+        unknown = set().union(*weights) - set(self.filters)
+        if unknown:
+            raise ValueError(
+                f"Unknown filters {', '.join(sorted(unknown))}, expected any of {', '.join(self.filters)}"
+            )
+        return np.array(
+            [[weight.get(name, 1.0) for weight in weights] for name in self.filters],
+            dtype=np.float64,
+        ).reshape(len(self.filters), len(weights))
+
+    def confidences(self, weights: Sequence[Weights] = ({},)) -> np.ndarray:
+        """
+        Returns the confidences of the lines with every set of weights, as a lines × len(weights) matrix.
+
+        The factors are raised to the weights and multiplied in one pass, with weights of 1 this reproduces the
+        confidences the filters computed.
+        """
+        exponents = self.weight_matrix(weights)
+        confidences = np.prod(self.factors[:, :, np.newaxis] ** exponents, axis=1)
+        return np.minimum(confidences, 1)
+
+    def categories(
+        self, weights: Optional[Weights] = None, conf_threshold=0.75
+    ) -> np.ndarray:
+        """Returns the indices of the rows whose confidence with the weights is above the threshold."""
+        return np.flatnonzero(self.confidences([weights or {}])[:, 0] > conf_threshold)
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path,
+            filters=np.array(self.filters),
+            factors=self.factors,
+            positions=self.positions,
+            texts=np.array(self.texts, dtype=str),
+        )
+
+    @staticmethod
+    def load(path: str) -> "FactorMatrix":
+        with np.load(path) as data:
+            return FactorMatrix(
+                data["filters"].tolist(),
+                data["factors"],
+                data["positions"],
+                data["texts"].tolist(),
+            )
+
+
+class FactorCache:
+    """
+    The FactorMatrix of every menu, saved as a .npz file per menu in a directory.
+
+    The files are named after the hash of the OCR file and the signatures of the filters, so the factors are
+    recorded again when either of them changes, and the OCR data only has to be parsed and GPT only has to be
+    asked for the menus that weren't recorded yet.
+
+    Args:
+        directory (str, optional): Default is conf.FACTOR_CACHE_DIR.
+    """
+
+    def __init__(self, directory: str = FACTOR_CACHE_DIR):
+        self.directory = directory
+
+    def path(self, json_file: str, signature: str) -> str:
+        key = hash_file(json_file)[:32] + "-" + hash_text(signature)
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, json_file: str, signature: str) -> Optional[FactorMatrix]:
+        path = self.path(json_file, signature)
+        if not os.path.exists(path):
+            return None
+        try:
+            return FactorMatrix.load(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logger.warning(f"Ignoring the unreadable cached factors {path}: {e}")
+            return None
+
+    def put(self, json_file: str, signature: str, matrix: FactorMatrix):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(json_file, signature)
+        # Written next to the final file and renamed, so a run that is interrupted doesn't leave half a file
+        temporary = path + ".tmp.npz"
+        matrix.save(temporary)
+        os.replace(temporary, path)
+
+
+def record_factors(
+    json_files: List[str],
+    filters: List[Filter],
+    conf_threshold=0.75,
+    cache: Optional[FactorCache] = None,
+    batch_size: int = GPT_BATCH_MENUS,
+) -> List[FactorMatrix]:
+    """
+    Returns the FactorMatrix of every OCR file, taken from the cache or recorded by running the filters.
+
+    Args:
+        json_files (List[str]): The paths to the OCR data.
+        filters (List[Filter]): The filters whose factors are recorded.
+        conf_threshold (float, optional): The threshold the filters are run with, it decides which lines GPT is
+        asked about. Default is 0.75.
+        cache (FactorCache, optional): Where the matrices are cached, None records all of them. Default is None.
+        batch_size (int, optional): How many menus are filtered together, so GPT is asked about their lines in the
+        same requests. Default is conf.GPT_BATCH_MENUS.
+
+    Returns:
+        List[FactorMatrix]: The matrices in the order of `json_files`.
+    """
+    recorder = LineFilter(*filters, record=True)
+    signature = f"{conf_threshold}:{recorder.signature()}"
+
+    matrices: Dict[str, FactorMatrix] = {}
+    if cache is not None:
+        for json_file in json_files:
+            matrix = cache.get(json_file, signature)
+            if matrix is not None:
+                matrices[json_file] = matrix
+
+    missing = [json_file for json_file in json_files if json_file not in matrices]
+    if json_files:
+        logger.info(
+            f"Recording the factors of {len(missing)} menus, {len(matrices)} are cached"
+        )
+    for start in range(0, len(missing), max(batch_size, 1)):
+        batch = missing[start : start + max(batch_size, 1)]
+        menus = [load_ocr_data(json_file) for json_file in batch]
+        recorder.get_possible_categories_many(menus, conf_threshold)
+        for json_file, menu, factors in zip(batch, menus, recorder.factors):
+            matrix = FactorMatrix.from_menu(menu, recorder.stage_names, factors)
+            matrices[json_file] = matrix
+            if cache is not None:
+                cache.put(json_file, signature, matrix)
+
+    return [matrices[json_file] for json_file in json_files]
@@ -1,16 +1,32 @@
 from collections import Counter
-import re
-from typing import List, Tuple, Dict
+from typing import List, Optional
 
-from models import Line
-from .base import Filter
+import numpy as np
+
+from geometry import GeometryStore, heights, line_indices
+from models import Line, Menu
+from .base import Filter, LineWiseFilter
+from .text_features import DEDUPE_PATTERN, TextMatcher, text_matcher
 
 from logger import get_logger
 
 logger = get_logger(__name__)
 
 
-class FilterPriceLines(Filter):
+class TextFilter(LineWiseFilter):
+    """
+    Base class for line-wise filters that only look at the text of a line. Instead of scanning the text themselves
+    they read the TextFeatures of the line from their matcher, which extracts them once for all the text filters.
+    """
+
+    matcher: TextMatcher
+
+    def __init__(self, confidence_multiplier: float):
+        super().__init__(confidence_multiplier)
+        self.matcher = text_matcher()
+
+
+class FilterPriceLines(TextFilter):
     """Penalizes lines that look like prices."""
 
     currency_signs: List[str]
@@ -18,18 +34,16 @@ class FilterPriceLines(Filter):
     def __init__(self, confidence_multiplier: float, currency_signs: List[str]):
         super().__init__(confidence_multiplier)
         self.currency_signs = [sign.lower() for sign in currency_signs]
+        self.matcher = text_matcher(currency_signs=self.currency_signs)
 
-    def apply(self, lines: List[Line]) -> None:
-        for line in lines:
-            if any(
-                currency_sign in line.text.lower()
-                for currency_sign in self.currency_signs
-            ):
-                line.analysis.type = "price"
-                line.analysis.category_confidence *= self.confidence_multiplier
+    def line_multiplier(self, line: Line) -> float:
+        if self.matcher.features(line).currency:
+            line.analysis.type = "price"
+            return self.confidence_multiplier
+        return 1
 
 
-class FilterLongLines(Filter):
+class FilterLongLines(LineWiseFilter):
     """Filters long lines. Penalizes lines for every word after the dropoff_start."""
 
     def __init__(
@@ -40,138 +54,140 @@ class FilterLongLines(Filter):
         super().__init__(confidence_multiplier)
         self.dropoff_start = dropoff_start
 
-    def apply(self, lines: List[Line]) -> None:
-        for line in lines:
-            length = len(line.words)
-            if len(line.words) > self.dropoff_start:
-                line.analysis.category_confidence *= self.confidence_multiplier ** (
-                    length - self.dropoff_start
-                )
+    def line_multiplier(self, line: Line) -> float:
+        length = len(line.words)
+        if length > self.dropoff_start:
+            return self.confidence_multiplier ** (length - self.dropoff_start)
+        return 1
 
 
-class FilterContainsNumbers(Filter):
+class FilterContainsNumbers(TextFilter):
     """Filters lines containing numbers."""
 
-    def apply(self, lines: List[Line]) -> None:
-        for line in lines:
-            if any(char.isdigit() for char in line.text):
-                line.analysis.category_confidence *= self.confidence_multiplier
+    def line_multiplier(self, line: Line) -> float:
+        if self.matcher.features(line).digits:
+            return self.confidence_multiplier
+        return 1
 
 
-class FilterNotStartWithCapital(Filter):
+class FilterNotStartWithCapital(TextFilter):
     """Penalizes lines that do not start with a capital letter."""
 
-    def apply(self, lines: List[Line]) -> None:
-        for line in lines:
-            if not line.text[0].isupper():
-                line.analysis.category_confidence *= self.confidence_multiplier
+    def line_multiplier(self, line: Line) -> float:
+        if not self.matcher.features(line).starts_with_capital:
+            return self.confidence_multiplier
+        return 1
 
 
-class FilterByOCRConfidence(Filter):
+class FilterByOCRConfidence(LineWiseFilter):
     """Filters lines based on readability. This is decided by checking if the OCR confidence is low."""
 
-    def apply(self, lines: List[Line]) -> None:
-        for line in lines:
-            if any(word.confidence == "Low" for word in line.words):
-                line.analysis.category_confidence *= self.confidence_multiplier
+    def line_multiplier(self, line: Line) -> float:
+        if "Low" in line.word_confidences():
+            return self.confidence_multiplier
+        return 1
 
 
 class FilterDuplicateText(Filter):
     """Filters duplicate lines of text."""
 
-    def __init__(self, confidence_multiplier: float, pattern: str = r"[^a-zA-Z0-9\s]"):
+    # A line is a duplicate even if the other copies were already filtered out
+    needs_all_lines = True
+    cost = 2
+
+    def __init__(self, confidence_multiplier: float, pattern: str = DEDUPE_PATTERN):
         super().__init__(confidence_multiplier)
         self.pattern = pattern
+        self.matcher = text_matcher(dedupe_pattern=pattern)
 
     def apply(self, lines: List[Line]) -> None:
-        regex = re.compile(self.pattern)
-        text_counter = Counter([regex.sub("", line.text) for line in lines])
-        for line in lines:
-            if text_counter[regex.sub("", line.text)] > 1:
+        keys = [self.matcher.features(line).dedupe_key for line in lines]
+        text_counter = Counter(keys)
+        for line, key in zip(lines, keys):
+            if text_counter[key] > 1:
                 line.analysis.category_confidence *= self.confidence_multiplier
 
 
-class FilterByEnding(Filter):
+class FilterByEnding(TextFilter):
     """Filters lines based on their ending."""
 
     def __init__(self, confidence_multiplier: float, unlikely_endings: List[str]):
         super().__init__(confidence_multiplier)
         self.unlikely_endings = unlikely_endings
 
-    def apply(self, lines: List[Line]) -> None:
-        for line in lines:
-            if line.text[-1] in self.unlikely_endings:
-                line.analysis.category_confidence *= self.confidence_multiplier
+    def line_multiplier(self, line: Line) -> float:
+        if self.matcher.features(line).ending in self.unlikely_endings:
+            return self.confidence_multiplier
+        return 1
+
+
+class GeometricFilter(Filter):
+    """Base class for filters that work on the bounding boxes of the lines in the GeometryStore of the menu."""
+
+    geometry: Optional[GeometryStore] = None
+
+    def prepare(self, menu: Menu):
+        self.geometry = menu.geometry
+
+    def _geometry(self) -> GeometryStore:
+        if self.geometry is None:
+            raise RuntimeError(
+                f"{self.__class__.__name__}.prepare must be called before apply"
+            )
+        return self.geometry
+
+    def line_boxes(self, lines: List[Line]) -> np.ndarray:
+        """Returns the N×8 array of the bounding boxes of the lines."""
+        return self._geometry().take_lines(line_indices(lines))
+
+    def row_neighbours(self, lines: List[Line]) -> np.ndarray:
+        """Returns how many of the lines above and below every line are in its row, among all the lines of its page."""
+        return self._geometry().count_row_neighbours(line_indices(lines))
 
 
-class FilterFontSize(Filter):
+class FilterFontSize(GeometricFilter):
     """Filters based on font size. Penalizes lines with font size below the a certain percentile and rewards lines with font size above the percentile."""
 
+    # The percentile is taken over the font sizes of all the lines
+    needs_all_lines = True
+    cost = 2
+
     def __init__(self, confidence_multiplier: float, percentile=0.75):
         super().__init__(confidence_multiplier)
         self.percentile = percentile
 
     def apply(self, lines: List[Line]) -> None:
-        lines_with_font_size: List[Tuple[Line, float]] = []
+        if not lines:
+            return
 
-        heights = []
-        for line in lines:
-            left_height = line.bounding_box.points[3].y - line.bounding_box.points[0].y
-            right_height = line.bounding_box.points[2].y - line.bounding_box.points[1].y
-            font_size = (left_height + right_height) / 2
+        font_sizes = heights(self.line_boxes(lines))
 
-            heights.append(font_size)
-            lines_with_font_size.append((line, font_size))
+        percentile_height = np.sort(font_sizes)[int(len(font_sizes) * self.percentile)]
 
-        heights.sort()
+        relative_distance = np.abs(percentile_height - font_sizes) / percentile_height
+        multipliers = 1 - self.confidence_multiplier * relative_distance
 
-        percentile_height = heights[int(len(heights) * self.percentile)]
+        for i in np.flatnonzero(font_sizes < percentile_height):
+            lines[i].analysis.category_confidence *= float(multipliers[i])
 
-        for line, font_size in lines_with_font_size:
-            relative_distance = abs(percentile_height - font_size) / percentile_height
 
-            if font_size < percentile_height:
-                line.analysis.category_confidence *= (
-                    1 - self.confidence_multiplier * relative_distance
-                )
+class FilterSameRowAsSomethingelse(GeometricFilter):
+    """
+    Filters lines that are in the same row as something else. Penalizes lines once for each of the lines right above
+    and below them in the order of their vertical centers that is in their row.
+    """
 
+    # The neighbours are found among all the lines of the page in the GeometryStore, whatever lines are passed in
+    cost = 3
 
-class FilterSameRowAsSomethingelse(Filter):
-    """Filters lines that are in the same row as something else."""
+    def apply(self, lines: List[Line]):
+        if not lines:
+            return
 
-    def __init__(
-        self,
-        confidence_multiplier: float,
-        lines_to_pages: Dict[int, int],
-    ):
-        super().__init__(confidence_multiplier)
-        self.lines_to_pages = lines_to_pages
-
-    def _in_same_row(self, y: float, other_line: Line) -> bool:
-        other_line_top: float = other_line.bounding_box.points[3].y
-        other_line_bottom = other_line.bounding_box.points[0].y
-        return other_line_top > y > other_line_bottom
-
-    def _calculate_center_y(self, lines: List[Line]) -> List[Tuple[Line, float, int]]:
-        with_center_and_page: List[Tuple[Line, float, int]] = []
-        for line in lines:
-            y = sum(point.y for point in line.bounding_box.points) / 4
-            page_num = self.lines_to_pages[id(line)]
-            with_center_and_page.append((line, y, page_num))
-        return with_center_and_page
-
-    def _adjust_confidence(self, with_center_and_page: List[Tuple[Line, float, int]]):
-        for i, e in enumerate(with_center_and_page):
-            if i != 0:
-                prev_line: Line = with_center_and_page[i - 1][0]
-                if self._in_same_row(e[1], prev_line):
-                    e[0].analysis.category_confidence *= self.confidence_multiplier
-            if i != len(with_center_and_page) - 1:
-                next_line = with_center_and_page[i + 1][0]
-                if self._in_same_row(e[1], next_line):
-                    e[0].analysis.category_confidence *= self.confidence_multiplier
+        # Only the two neighbours count, so headings in multi-column layouts aren't penalized for every column
+        neighbours = self.row_neighbours(lines)
 
-    def apply(self, lines: List[Line]):
-        with_center_and_page = self._calculate_center_y(lines)
-        with_center_and_page.sort(key=lambda x: (x[2], x[1]))
-        self._adjust_confidence(with_center_and_page)
+        for i in np.flatnonzero(neighbours):
+            lines[i].analysis.category_confidence *= float(
+                self.confidence_multiplier ** neighbours[i]
+            )
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, Optional
+
+from conf import (
+    GPT_CACHE_MAX_ENTRIES,
+    GPT_CACHE_PATH,
+    GPT_CACHE_TTL_DAYS,
+    MODEL_ID,
+)
+from logger import get_logger
+
+logger = get_logger("gpt_cache")
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes a line of text so that lines differing only in case or whitespace share a cache entry."""
+    return " ".join(text.split()).casefold()
+
+
+def hash_prompt(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()[:16]
+
+
+class ClassificationCache:
+    """
+    A persistent SQLite cache of the category probabilities returned by GPT.
+
+    Entries are keyed on the normalized line text, the model and a hash of the base prompt, so changing either
+    of them doesn't return stale answers. Entries older than `ttl_days` are dropped and when there are more than
+    `max_entries` of them, the least recently used ones are evicted.
+
+    Args:
+        path (str, optional): The path to the SQLite database. Default is conf.GPT_CACHE_PATH.
+        prompt (str, optional): The base prompt the probabilities were obtained with. Default is "".
+        model (str, optional): The model the probabilities were obtained with. Default is conf.MODEL_ID.
+        ttl_days (float, optional): Default is conf.GPT_CACHE_TTL_DAYS.
+        max_entries (int, optional): Default is conf.GPT_CACHE_MAX_ENTRIES.
+    """
+
+    def __init__(
+        self,
+        path: str = GPT_CACHE_PATH,
+        prompt: str = "",
+        model: str = MODEL_ID,
+        ttl_days: float = GPT_CACHE_TTL_DAYS,
+        max_entries: int = GPT_CACHE_MAX_ENTRIES,
+    ):
+        self.path = path
+        self.namespace = f"{model}:{hash_prompt(prompt)}"
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # The timeout makes concurrent batch workers wait for each other's writes instead of failing.
+            # The cache may be used from different threads of the server, but never from two at the same time
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS classifications (
+                    key TEXT PRIMARY KEY,
+                    probability REAL NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS classifications_last_used ON classifications (last_used)"
+            )
+            self.evict()
+        return self._connection
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(
+            f"{self.namespace}:{normalize_text(text)}".encode()
+        ).hexdigest()
+
+    def get_many(self, texts: Iterable[str]) -> Dict[str, float]:
+        """Returns the cached probabilities of the texts, keyed on the text. Texts that aren't cached are left out."""
+        keys = {self.key(text): text for text in texts}
+        if not keys:
+            return {}
+
+        found: Dict[str, float] = {}
+        key_list = list(keys)
+        now = time.time()
+        with self.connection:
+            # SQLite limits the number of parameters in a query
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i : i + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, probability FROM classifications WHERE key IN ({','.join('?' * len(chunk))}) AND created > ?",
+                    (*chunk, now - self.ttl),
+                ).fetchall()
+                for key, probability in rows:
+                    found[keys[key]] = probability
+
+                # The hits of a chunk are marked as used together, not one statement per hit
+                if rows:
+                    self.connection.execute(
+                        f"UPDATE classifications SET last_used = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        (now, *(key for key, _ in rows)),
+                    )
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, probabilities: Dict[str, float]):
+        """Stores the probabilities, keyed on the text."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO classifications (key, probability, created, last_used) VALUES (?, ?, ?, ?)",
+                [
+                    (self.key(text), probability, now, now)
+                    for text, probability in probabilities.items()
+                ],
+            )
+        self.evict()
+
+    def evict(self):
+        """Removes the expired entries and the least recently used ones above `max_entries`."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM classifications WHERE created <= ?",
+                (time.time() - self.ttl,),
+            )
+            self.connection.execute(
+                """DELETE FROM classifications WHERE key IN (
+                    SELECT key FROM classifications ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,381 @@
+import asyncio
+import collections
+import functools
+import random
+import threading
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple, TypeVar, Union
+
+from conf import (
+    MODEL_ID,
+    OPEN_AI_API_BASE,
+    OPEN_AI_MAX_CONCURRENCY,
+    OPEN_AI_MAX_RETRIES,
+    OPEN_AI_REQUESTS_PER_MINUTE,
+    OPEN_AI_TOKENS_PER_MINUTE,
+)
+from logger import get_logger
+from metrics import METRICS
+
+# openai, aiohttp and tiktoken are imported when the first request is sent, runs without GPT never load them
+logger = get_logger("gpt_client")
+
+# The share of the rate limits and the concurrency of the account this process may use. The worker processes of a
+# batch can't share the limits of the parent, so each of them gets an equal share instead
+RATE_LIMIT_SHARE = 1.0
+
+T = TypeVar("T")
+_limits: Dict[tuple, object] = {}
+_limits_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """The errors after which the request is worth retrying."""
+    import openai
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """1 token is approximately 4 characters"""
+    return len(text) // 4 + 1
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        # tiktoken is optional, the tokens are estimated without it
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        # An unknown model, or the encoding couldn't be downloaded
+        logger.warning(
+            f"Can't load the tokenizer of {model} ({e.__class__.__name__}), estimating the tokens instead"
+        )
+        return None
+
+
+def count_tokens(text: str, model: str = MODEL_ID) -> int:
+    """Counts the tokens of the text with the tokenizer of the model, estimates them if tiktoken isn't installed."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+class TokenBucket:
+    """
+    A token bucket that holds up to `capacity` tokens and refills them evenly over `period` seconds.
+
+    It can be shared by several threads and event loops. A caller takes its tokens out right away, the bucket may
+    go into debt, and then waits until they would have been refilled. Callers are served in the order they came, so
+    a large request can't be starved by small ones.
+
+    Args:
+        capacity (float): The maximum number of tokens, e.g. the requests or tokens allowed per minute.
+        period (float, optional): The number of seconds it takes to refill an empty bucket. Default is 60.
+    """
+
+    def __init__(self, capacity: float, period: float = 60):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float = 1) -> float:
+        """Takes the tokens out of the bucket and returns the number of seconds to wait before using them."""
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self, amount: float = 1):
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def adjust(self, amount: float):
+        """Takes out (or gives back if negative) tokens after the real cost of a request is known."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ConcurrencyLimit:
+    """
+    Limits the number of requests in flight, shared by several threads and event loops.
+
+    The server runs every menu in its own thread with its own event loop, so an asyncio.Semaphore, which belongs to
+    one loop, can't limit all of them. The count is kept under a threading lock instead and every waiting request
+    waits on a future of its own loop, which the request freeing a slot resolves with call_soon_threadsafe. The slot
+    is handed over to the waiters in the order they came.
+
+    Args:
+        limit (int): The maximum number of requests in flight.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters: Deque[
+            Tuple[asyncio.AbstractEventLoop, asyncio.Future]
+        ] = collections.deque()
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                return
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, waiter))
+                except ValueError:
+                    # The slot was already handed over to this request, so it's passed on
+                    self._release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        with self._lock:
+            self._release()
+
+    def _release(self):
+        """Hands the slot over to the first waiting request, or frees it. Must be called with the lock held."""
+        while self._waiters:
+            loop, waiter = self._waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+                return
+            except RuntimeError:
+                # The loop of the request was closed, nobody waits for it anymore
+                continue
+        self.in_flight -= 1
+
+
+def _wake(waiter: asyncio.Future):
+    # A cancelled waiter passes the slot on itself
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _shared(key: tuple, create: Callable[[], T]) -> T:
+    """Returns the limit of the key, shared by all the clients of the process, creating it on first use."""
+    with _limits_lock:
+        if key not in _limits:
+            _limits[key] = create()
+        return _limits[key]  # type: ignore
+
+
+class AsyncChatClient:
+    """
+    Sends prompts to OpenAI's chat completion endpoint concurrently while staying within the rate limits.
+
+    Requests are throttled by a requests per minute and a tokens per minute token bucket and at most
+    `max_concurrency` of them are in flight. The buckets and the concurrency limit are shared by every call and
+    every client of the process with the same API key, base and limits, so sequential calls, partial retries and
+    the concurrent requests of the server all stay within them. Rate limited and failed requests are retried with
+    an exponential backoff with jitter, honoring the Retry-After header if the server sends one.
+
+    Args:
+        model (str, optional): The model to use. Default is conf.MODEL_ID.
+        api_key (str, optional): The OpenAI API key. Default is the key set on the openai module.
+        api_base (str, optional): The base URL of the API, point it at a local server for testing. Default is conf.OPEN_AI_API_BASE.
+        max_concurrency (int, optional): The maximum number of requests in flight. Default is conf.OPEN_AI_MAX_CONCURRENCY.
+        requests_per_minute (int, optional): Default is conf.OPEN_AI_REQUESTS_PER_MINUTE.
+        tokens_per_minute (int, optional): Default is conf.OPEN_AI_TOKENS_PER_MINUTE.
+        max_retries (int, optional): Default is conf.OPEN_AI_MAX_RETRIES.
+        backoff_base (float, optional): The delay before the first retry in seconds, doubled for every retry. Default is 1.
+        backoff_max (float, optional): The maximum delay between retries in seconds. Default is 60.
+    """
+
+    def __init__(
+        self,
+        model: str = MODEL_ID,
+        api_key: Optional[str] = None,
+        api_base: str = OPEN_AI_API_BASE,
+        max_concurrency: int = OPEN_AI_MAX_CONCURRENCY,
+        requests_per_minute: int = OPEN_AI_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = OPEN_AI_TOKENS_PER_MINUTE,
+        max_retries: int = OPEN_AI_MAX_RETRIES,
+        backoff_base: float = 1,
+        backoff_max: float = 60,
+    ):
+        self.model = model
+        self.api_key = api_key
+        self.api_base = api_base
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def limits(self) -> Tuple[ConcurrencyLimit, TokenBucket, TokenBucket]:
+        """
+        Returns the concurrency limit, the requests bucket and the tokens bucket of the client, scaled by
+        RATE_LIMIT_SHARE.
+        """
+        account = (self.api_key, self.api_base)
+        return (
+            _shared(
+                (*account, "concurrency", self.max_concurrency, RATE_LIMIT_SHARE),
+                lambda: ConcurrencyLimit(
+                    max(1, int(self.max_concurrency * RATE_LIMIT_SHARE))
+                ),
+            ),
+            _shared(
+                (*account, "requests", self.requests_per_minute, RATE_LIMIT_SHARE),
+                lambda: TokenBucket(self.requests_per_minute * RATE_LIMIT_SHARE),
+            ),
+            _shared(
+                (*account, "tokens", self.tokens_per_minute, RATE_LIMIT_SHARE),
+                lambda: TokenBucket(self.tokens_per_minute * RATE_LIMIT_SHARE),
+            ),
+        )
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = getattr(error, "headers", {}).get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        # Full jitter, so the retries of concurrent requests don't all hit the server at the same time
+        return random.uniform(0, delay)
+
+    async def _complete(
+        self,
+        prompt: str,
+        concurrency: ConcurrencyLimit,
+        request_bucket: TokenBucket,
+        token_bucket: TokenBucket,
+        function: Optional[dict] = None,
+    ) -> str:
+        import openai
+
+        estimated_tokens = count_tokens(prompt, self.model)
+        function_kwargs = (
+            {"functions": [function], "function_call": {"name": function["name"]}}
+            if function
+            else {}
+        )
+        attempt = 0
+        while True:
+            await request_bucket.acquire()
+            await token_bucket.acquire(estimated_tokens)
+            try:
+                async with concurrency:
+                    start = time.perf_counter()
+                    try:
+                        response = await openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=[{"role": "user", "content": prompt}],
+                            api_key=self.api_key,
+                            api_base=self.api_base,
+                            **function_kwargs,
+                        )
+                    finally:
+                        METRICS.observe(
+                            "gpt_request_seconds", time.perf_counter() - start
+                        )
+            except retryable_errors() as e:
+                METRICS.inc("gpt_requests_total", outcome=e.__class__.__name__)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                METRICS.inc("gpt_retries_total")
+                logger.warning(
+                    f"Request to OpenAI failed ({e.__class__.__name__}), retry {attempt}/{self.max_retries} in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                METRICS.inc("gpt_requests_total", outcome=e.__class__.__name__)
+                raise
+
+            METRICS.inc("gpt_requests_total", outcome="ok")
+            usage = response.get("usage")  # type: ignore
+            if usage:
+                METRICS.inc("gpt_prompt_tokens_total", usage.get("prompt_tokens", 0))
+                METRICS.inc(
+                    "gpt_completion_tokens_total", usage.get("completion_tokens", 0)
+                )
+            if usage and "total_tokens" in usage:
+                token_bucket.adjust(usage["total_tokens"] - estimated_tokens)
+            message = response["choices"][0]["message"]  # type: ignore
+            function_call = message.get("function_call")
+            if function_call:
+                return function_call.get("arguments") or ""
+            return message.get("content") or ""
+
+    async def complete_all(
+        self,
+        prompts: List[str],
+        function: Optional[dict] = None,
+        return_exceptions: bool = False,
+    ) -> List[Union[str, BaseException]]:
+        """
+        Sends all the prompts concurrently and returns the responses in the same order.
+
+        Args:
+            prompts (List[str]): The prompts to send.
+            function (dict, optional): The JSON schema of a function the model is made to call, the arguments of the
+            call are returned instead of the content of the message. Default is None, which returns the content.
+            return_exceptions (bool, optional): Whether a request that failed returns its exception instead of
+            raising it, so the other responses aren't lost. Default is False.
+        """
+        import aiohttp
+        import openai
+
+        concurrency, request_bucket, token_bucket = self.limits()
+
+        async with aiohttp.ClientSession() as session:
+            # Share one connection pool between all the requests
+            openai.aiosession.set(session)
+            try:
+                return await asyncio.gather(
+                    *(
+                        self._complete(
+                            prompt, concurrency, request_bucket, token_bucket, function
+                        )
+                        for prompt in prompts
+                    ),
+                    return_exceptions=return_exceptions,
+                )
+            finally:
+                openai.aiosession.set(None)
+
+    def complete_all_sync(
+        self,
+        prompts: List[str],
+        function: Optional[dict] = None,
+        return_exceptions: bool = False,
+    ) -> List[Union[str, BaseException]]:
+        """Blocking version of `complete_all`, for code that doesn't run an event loop."""
+        return asyncio.run(self.complete_all(prompts, function, return_exceptions))
@@ -1,33 +1,154 @@
+import json
 import re
-import openai
+from typing import Dict, List, Optional, Tuple
 
-from conf import OPEN_AI_API_KEY, MODEL_ID, TOKEN_LIMIT
+from conf import GPT_PARTIAL_RETRIES, OPEN_AI_API_KEY, TOKEN_LIMIT
 from logger import get_logger
+from metrics import METRICS
+from models import Line
 
 from .base import Filter
+from .gpt_cache import ClassificationCache, hash_prompt, normalize_text
+from .gpt_client import AsyncChatClient, count_tokens
 
 logger = get_logger("gpt_filter")
 
+# The tokens of the answer about a line, e.g. {"id": 12, "probability": 95},
+ANSWER_TOKENS = 12
+
+# The function GPT is made to call with its answers, so they come back as JSON instead of free text
+CLASSIFY_FUNCTION = {
+    "name": "classify",
+    "description": "Reports the category likelihood of every line",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "answers": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "integer", "description": "The ID of the line"},
+                        "probability": {
+                            "type": "integer",
+                            "minimum": 0,
+                            "maximum": 100,
+                            "description": "The likelihood of the line being a category, in percent",
+                        },
+                    },
+                    "required": ["id", "probability"],
+                },
+            }
+        },
+        "required": ["answers"],
+    },
+}
+
+# Complete answers in a truncated or otherwise invalid JSON response
+RE_JSON_ANSWER = re.compile(
+    r'\{\s*"id"\s*:\s*"?(\d+)"?\s*,\s*"probability"\s*:\s*(-?\d+(?:\.\d+)?)\s*\}'
+)
+# Answers in the "ID: probability" format of the free text responses
+RE_TEXT_ANSWER = re.compile(r"^\s*(\d+)\s*:\s*(\d{1,3})\s*$", re.MULTILINE)
+
+
+def parse_answers(response: str, count: int) -> Dict[int, float]:
+    """
+    Parses the answers of GPT about the lines with the IDs 0 to count - 1, returns their probabilities by ID.
+
+    The response is expected to be the JSON arguments of CLASSIFY_FUNCTION. If it isn't valid JSON, e.g. because it
+    was cut off at the token limit, the complete answers in it are used, as are "ID: probability" lines of a free
+    text response. Answers with an unknown ID or a probability outside 0-100 are dropped, as are repeated answers
+    about the same ID.
+    """
+    try:
+        answers = [
+            (answer["id"], answer["probability"])
+            for answer in json.loads(response)["answers"]
+        ]
+    except (ValueError, KeyError, TypeError):
+        answers = RE_JSON_ANSWER.findall(response) or RE_TEXT_ANSWER.findall(response)
+
+    probabilities: Dict[int, float] = {}
+    invalid = 0
+    for id, probability in answers:
+        try:
+            id, probability = int(id), float(probability)
+        except (ValueError, TypeError):
+            invalid += 1
+            continue
+        if 0 <= id < count and 0 <= probability <= 100 and id not in probabilities:
+            probabilities[id] = probability
+        else:
+            invalid += 1
+
+    if invalid:
+        logger.debug(f"Dropped {invalid} invalid answers of GPT")
+        METRICS.inc("gpt_answers_total", invalid, outcome="invalid")
+    METRICS.inc("gpt_answers_total", len(probabilities), outcome="valid")
+    return probabilities
+
 
 class MakeAIDoTheFiltering(Filter):
     """Leverages GPT-3 to to check if a line is a category or not. This honestly doesn't work very well, but it's a cool idea.
 
+    The lines are packed into as few prompts as fit the token limit, with every distinct text asked about once. `apply_many`
+    packs the lines of several menus together.
+
     Args:
         conf_threshold (float, optional): The maximum threshold for a line to be considered a processed using GPT-3, reducing this value will use less tokens.
         Defaults to 1.
+        client (AsyncChatClient, optional): The client used to send the prompts, they are all sent concurrently.
+        Defaults to a client configured from conf.py.
+        cache (ClassificationCache, optional): The cache of previous answers, only lines missing from it are sent to GPT.
+        Defaults to a cache configured from conf.py.
+        partial_retries (int, optional): How many times the lines GPT skipped or gave an invalid answer for are asked
+        about again. Lines without a valid answer keep the confidence from the other filters.
+        Defaults to conf.GPT_PARTIAL_RETRIES.
     """
 
-    def __init__(self, weight: float, conf_threshold: float = 1):
+    # Every line costs tokens and a round trip to OpenAI, so it runs last on the lines that are left
+    cost = 1000
+
+    def __init__(
+        self,
+        weight: float,
+        conf_threshold: float = 1,
+        client: Optional[AsyncChatClient] = None,
+        cache: Optional[ClassificationCache] = None,
+        partial_retries: int = GPT_PARTIAL_RETRIES,
+    ):
         self.set_openai_api_key()
         self.weight = weight
         self.conf_threshold = conf_threshold
+        self.client = client or AsyncChatClient()
+        self.cache = cache
+        self.partial_retries = partial_retries
+
+    def signature(self) -> str:
+        # The answers depend on the model and the prompt, and without a key the filter doesn't do anything
+        return (
+            f"{super().signature()}{self.client.model}:{hash_prompt(self.create_base_prompt())}"
+            f":{bool(OPEN_AI_API_KEY)}"
+        )
 
     @staticmethod
     def set_openai_api_key():
         if OPEN_AI_API_KEY:
+            # Imported here, so runs without a key don't pay for importing it
+            import openai
+
             openai.api_key = OPEN_AI_API_KEY
 
     def apply(self, lines):
+        self.classify_lines([lines])
+
+    def apply_many(self, menus, line_lists):
+        # GPT doesn't need the menus, the lines of all of them are packed into the same prompts
+        self.classify_lines(line_lists)
+
+    def classify_lines(self, line_lists: List[List[Line]]):
+        """Updates the confidence of the lines above `conf_threshold` with GPT's answers, from all the lists at once."""
         if not OPEN_AI_API_KEY:
             logger.warning(
                 "OPEN_AI_API_KEY not set, the AI based filter will be skipped"
@@ -35,14 +156,46 @@ class MakeAIDoTheFiltering(Filter):
             return
 
         base_prompt = self.create_base_prompt()
-        probabilities = self.extract_probabilities(base_prompt, lines)
+        if self.cache is None:
+            self.cache = ClassificationCache(prompt=base_prompt)
+
+        candidates = [
+            line
+            for lines in line_lists
+            for line in lines
+            if line.analysis.category_confidence >= self.conf_threshold
+        ]
+        # Every text is only asked about once, however many lines and menus it is on
+        texts: Dict[str, str] = {}
+        for line in candidates:
+            texts.setdefault(normalize_text(line.text), line.text)
 
-        for p in probabilities:
-            self.update_line_confidence(p, lines)
+        known = {
+            normalize_text(text): probability
+            for text, probability in self.cache.get_many(texts.values()).items()
+        }
+        new = {
+            normalize_text(text): probability
+            for text, probability in self.extract_probabilities(
+                base_prompt, [text for key, text in texts.items() if key not in known]
+            ).items()
+        }
+        self.cache.put_many(new)
+        known.update(new)
+
+        logger.info(
+            f"GPT cache: {self.cache.hits} hits, {self.cache.misses} misses, {len(new)} new answers "
+            f"for {len(candidates)} lines of {len(line_lists)} menu(s)"
+        )
+
+        for line in candidates:
+            probability = known.get(normalize_text(line.text))
+            if probability is not None:
+                self.update_line_confidence(line, probability)
 
     @staticmethod
     def create_base_prompt():
-        return """Classify restaurant menu strings as probable (100) or improbable (0) menu categories. 'Polevky', 'Wafle', 'Vino' are examples of categories, while specific items or prices aren't. Output should follow \\d+: \\d{1,3} format, with the first number being the ID and the second the category likelihood percentage.
+        return """Classify restaurant menu strings as probable (100) or improbable (0) menu categories. 'Polevky', 'Wafle', 'Vino' are examples of categories, while specific items or prices aren't. Every line is given as its ID and its text, call the classify function with the category likelihood percentage of every ID.
 
         Example input:
         0: Soups
@@ -50,65 +203,109 @@ class MakeAIDoTheFiltering(Filter):
         2: Wafle s grilovanou slaninou
         3: 5.99,-
         4: Hot drinks
-        Example output based on the above input:
-        0: 99
-        1: 75
-        2: 15
-        3: 01
-        4: 95
-
-        provide a similar output for the following all of the following lines:
+        Example answer based on the above input:
+        {"answers": [{"id": 0, "probability": 99}, {"id": 1, "probability": 75}, {"id": 2, "probability": 15}, {"id": 3, "probability": 1}, {"id": 4, "probability": 95}]}
+
+        Classify all of the following lines:
+        """
+
+    def extract_probabilities(
+        self, base_prompt: str, texts: List[str]
+    ) -> Dict[str, float]:
         """
+        Asks GPT about the texts and returns the probability of every text it gave a valid answer for, keyed on the text.
+
+        Only the texts without a valid answer are asked about again, packed into new prompts together. The texts of
+        requests that failed, and those still without an answer after `partial_retries`, are left out.
+        """
+        probabilities: Dict[str, float] = {}
+        pending = texts
+        for attempt in range(self.partial_retries + 1):
+            if not pending:
+                break
+            if attempt:
+                logger.info(
+                    f"Asking GPT again about {len(pending)} lines without a valid answer"
+                )
+
+            prompts = self.create_prompts(base_prompt, pending)
+            responses = self.client.complete_all_sync(
+                [prompt for prompt, _ in prompts],
+                function=CLASSIFY_FUNCTION,
+                return_exceptions=True,
+            )
+            pending = []
+            for (_, prompt_texts), response in zip(prompts, responses):
+                if isinstance(response, BaseException):
+                    # The errors of openai have a short message without the response headers
+                    message = getattr(response, "user_message", None) or response
+                    logger.warning(
+                        f"A request to GPT failed ({response.__class__.__name__}: {message}), "
+                        f"{len(prompt_texts)} lines are scored without it"
+                    )
+                    METRICS.inc(
+                        "gpt_answers_total", len(prompt_texts), outcome="failed"
+                    )
+                    continue
 
-    def extract_probabilities(self, base_prompt, lines):
-        re_get_probabilities = re.compile(r"\d+: \d{1,3}")
-        id = 0
-        probabilities = []
-        while id < len(lines):
-            prompt, id = self.create_prompt(id, base_prompt, lines)
-            content = self.get_content_from_openai(prompt)
-            probabilities += re_get_probabilities.findall(content)
+                answers = parse_answers(response, len(prompt_texts))
+                for index, text in enumerate(prompt_texts):
+                    if index in answers:
+                        probabilities[text] = answers[index]
+                    else:
+                        pending.append(text)
+
+        if pending:
+            logger.warning(
+                f"GPT gave no valid answer for {len(pending)} lines, they are scored without it"
+            )
+            METRICS.inc("gpt_answers_total", len(pending), outcome="missing")
         return probabilities
 
-    def create_prompt(self, id, base_prompt, lines):
-        prompt = base_prompt + "\n\n"
+    def create_prompts(
+        self, base_prompt: str, texts: List[str]
+    ) -> List[Tuple[str, List[str]]]:
+        """
+        Packs the texts into as few prompts as possible, each of them filled up to TOKEN_LIMIT.
 
-        for i in range(id, len(lines)):
-            id += 1
-            line = lines[i]
-            # no reason to use up tokens on lines that are already filtered out
-            if line.analysis.category_confidence < self.conf_threshold:
-                continue
+        The texts are numbered from 0 in every prompt. The tokens are counted with the tokenizer of the model if
+        tiktoken is installed, and include the expected answer, so the whole exchange stays within the limit.
 
-            prompt += f"\n{i}: {line.text}"
+        Returns:
+            List[Tuple[str, List[str]]]: The prompts, with the texts they ask about in the order of their numbers.
+        """
+        header = base_prompt + "\n\n"
+        budget = TOKEN_LIMIT - count_tokens(header, self.client.model)
 
-            #  1 token is approximately 4 characters
-            if len(prompt) / 4 > TOKEN_LIMIT:
-                break
+        prompts: List[Tuple[str, List[str]]] = []
+        chunk: List[str] = []
+        entries: List[str] = []
+        used = 0
+        for text in texts:
+            entry = f"\n{len(chunk)}: {text}"
+            tokens = count_tokens(entry, self.client.model) + ANSWER_TOKENS
+            if chunk and used + tokens > budget:
+                prompts.append((header + "".join(entries), chunk))
+                chunk, entries, used = [], [], 0
+                entry = f"\n0: {text}"
+            chunk.append(text)
+            entries.append(entry)
+            used += tokens
+        if chunk:
+            prompts.append((header + "".join(entries), chunk))
 
         logger.info(
-            f"Sending approximately {len(prompt) / 4} tokens to GPT-3, this may take a while"
-        )
-        return prompt, id
-
-    @staticmethod
-    def get_content_from_openai(prompt):
-        response = openai.ChatCompletion.create(
-            model=MODEL_ID,
-            messages=[{"role": "user", "content": prompt}],
+            f"Sending {len(texts)} lines to GPT in {len(prompts)} request(s), this may take a while"
         )
-        return response["choices"][0]["message"]["content"]  # type: ignore
+        return prompts
 
-    def update_line_confidence(self, p, lines):
-        index, probability = p.split(": ")
-        index = int(index)
-        probability = float(probability)
+    def update_line_confidence(self, line: Line, probability: float):
         # calculate the confidence modifier based on the probability, and scale it's effect based on the weight
         confidence_multiplier = 1 - (1 - probability / 100) * self.weight
 
-        old_confidence = lines[index].analysis.category_confidence
-        lines[index].analysis.category_confidence *= confidence_multiplier
-        new_confidence = lines[index].analysis.category_confidence
+        old_confidence = line.analysis.category_confidence
+        line.analysis.category_confidence *= confidence_multiplier
+        new_confidence = line.analysis.category_confidence
 
         # Uncomment this line to enable detailed logging.
-        # logger.debug(f"'{lines[index].text}'\n\t{probability=}, {self.weight=}, {confidence_multiplier=}\n\t{old_confidence}->{new_confidence}")
+        # logger.debug(f"'{line.text}'\n\t{probability=}, {self.weight=}, {confidence_multiplier=}\n\t{old_confidence}->{new_confidence}")
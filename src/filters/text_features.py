@@ -0,0 +1,88 @@
+import functools
+import re
+from typing import Iterable, List, Optional
+
+from models import Line, TextFeatures
+
+CURRENCY_SIGNS = ["€", "$", "£", "kč", "kr", "kc", ",-"]
+# The characters FilterDuplicateText ignores when comparing lines
+DEDUPE_PATTERN = r"[^a-zA-Z0-9\s]"
+
+_digit = re.compile(r"\d").search
+
+
+class TextMatcher:
+    """
+    Extracts all the TextFeatures of a line in one pass over its text, with the patterns compiled once.
+
+    The features are cached on the analysis of the line, so the first text filter that looks at a line extracts them
+    and the following filters only read the flags. Features extracted by another matcher, with other currency signs
+    or another dedupe pattern, are extracted again.
+
+    Args:
+        currency_signs (List[str], optional): The signs that make a line a price, case-insensitive. Default is CURRENCY_SIGNS.
+        dedupe_pattern (str, optional): The regex of the characters that are removed from the dedupe key. Default is DEDUPE_PATTERN.
+    """
+
+    def __init__(
+        self,
+        currency_signs: Iterable[str] = CURRENCY_SIGNS,
+        dedupe_pattern: str = DEDUPE_PATTERN,
+    ):
+        self.currency_signs = sorted({sign.lower() for sign in currency_signs})
+        self.dedupe_pattern = dedupe_pattern
+        # The longest signs first, so the alternation doesn't stop at a prefix of one
+        self._currency = (
+            re.compile(
+                "|".join(
+                    map(re.escape, sorted(self.currency_signs, key=len, reverse=True))
+                )
+            ).search
+            if self.currency_signs
+            else None
+        )
+        self._dedupe = re.compile(dedupe_pattern).sub
+
+    def extract(self, text: str) -> TextFeatures:
+        """Returns the features of the text."""
+        # In the order of the fields, passing them as keywords takes twice as long
+        return TextFeatures(
+            self._currency is not None and self._currency(text.lower()) is not None,
+            # \d only matches decimal digits, the other characters str.isdigit accepts like ² are never ASCII
+            _digit(text) is not None
+            or (not text.isascii() and any(map(str.isdigit, text))),
+            text[:1].isupper(),
+            text[-1:],
+            self._dedupe("", text),
+            self,
+        )
+
+    def features(self, line: Line) -> TextFeatures:
+        """Returns the features of the line, extracting them if it has none from this matcher yet."""
+        features = line.analysis.text_features
+        if features is None or features.matcher is not self:
+            features = line.analysis.text_features = self.extract(line.text)
+        return features
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_matcher(currency_signs: tuple, dedupe_pattern: str) -> TextMatcher:
+    return TextMatcher(currency_signs, dedupe_pattern)
+
+
+def text_matcher(
+    currency_signs: Optional[List[str]] = None, dedupe_pattern: Optional[str] = None
+) -> TextMatcher:
+    """
+    Returns the matcher shared by all the filters with the same currency signs and dedupe pattern, so they read the
+    features extracted by the first of them.
+
+    Args:
+        currency_signs (List[str], optional): Default is CURRENCY_SIGNS.
+        dedupe_pattern (str, optional): Default is DEDUPE_PATTERN.
+    """
+    signs = CURRENCY_SIGNS if currency_signs is None else currency_signs
+    return _shared_matcher(
+        tuple(sorted({sign.lower() for sign in signs})),
+        DEDUPE_PATTERN if dedupe_pattern is None else dedupe_pattern,
+    )
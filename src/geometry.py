@@ -0,0 +1,171 @@
+from typing import Dict, List, Optional
+
+import attr
+import numpy as np
+
+# Every bounding box is stored as a row of 8 floats, the x and y coordinates of its 4 corners:
+# top left, top right, bottom right and bottom left
+X0, Y0, X1, Y1, X2, Y2, X3, Y3 = range(8)
+
+
+def box_array(boxes: List[List[float]]) -> np.ndarray:
+    return np.array(boxes, dtype=np.float64).reshape(-1, 8)
+
+
+@attr.s(eq=False)
+class GeometryStore:
+    """
+    Columnar storage of all the bounding boxes of a menu.
+
+    The bounding boxes of the lines and words are views into these arrays, so geometric computations over a whole
+    menu can be done as array operations instead of walking the points of every line.
+
+    Args:
+        lines (np.ndarray): N×8 array with the bounding boxes of all the lines, in the order of the menu.
+        words (np.ndarray): M×8 array with the bounding boxes of all the words, in the order of the menu.
+        line_pages (np.ndarray): The page number of every line.
+    """
+
+    lines: np.ndarray = attr.ib()
+    words: np.ndarray = attr.ib()
+    line_pages: np.ndarray = attr.ib()
+    _row_indexes: Dict[int, "RowIndex"] = attr.ib(factory=dict, init=False, repr=False)
+    _row_neighbours: Optional[np.ndarray] = attr.ib(
+        default=None, init=False, repr=False
+    )
+
+    @staticmethod
+    def from_json(pages: List[dict]) -> "GeometryStore":
+        """Builds the store from the recognitionResults of the OCR data."""
+        return GeometryStore(
+            lines=box_array(
+                [line["boundingBox"] for page in pages for line in page["lines"]]
+            ),
+            words=box_array(
+                [
+                    word["boundingBox"]
+                    for page in pages
+                    for line in page["lines"]
+                    for word in line["words"]
+                ]
+            ),
+            line_pages=np.repeat(
+                np.array([page["page"] for page in pages], dtype=np.int64),
+                [len(page["lines"]) for page in pages],
+            ),
+        )
+
+    def take_lines(self, indices: np.ndarray) -> np.ndarray:
+        """Returns the bounding boxes of the lines with the given indices, without copying if it's all of them."""
+        if len(indices) == len(self.lines) and np.array_equal(
+            indices, np.arange(len(self.lines))
+        ):
+            return self.lines
+        return self.lines[indices]
+
+    def row_index(self, page_num: int) -> "RowIndex":
+        """Returns the RowIndex over the lines of the page."""
+        if page_num not in self._row_indexes:
+            on_page = self.line_pages == page_num
+            self._row_indexes[page_num] = RowIndex(
+                self.lines[on_page, Y0], self.lines[on_page, Y3]
+            )
+        return self._row_indexes[page_num]
+
+    def count_row_mates(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns for each of the lines the number of other lines on its page which cover the vertical center
+        of the line, so the lines it shares a row with.
+        """
+        boxes = self.lines[indices]
+        pages = self.line_pages[indices]
+        center_y = centers_y(boxes)
+
+        counts = np.zeros(len(indices), dtype=np.int64)
+        for page_num in np.unique(pages):
+            on_page = pages == page_num
+            counts[on_page] = self.row_index(page_num).count(center_y[on_page])
+
+        # The line covers its own center
+        counts -= (boxes[:, Y0] < center_y) & (center_y < boxes[:, Y3])
+        return counts
+
+    def count_row_neighbours(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns for each of the lines how many of the two lines next to it on its page, in the order of their vertical
+        centers, cover the vertical center of the line. Unlike count_row_mates it is at most 2, however many
+        columns a row has.
+        """
+        if self._row_neighbours is None:
+            center_y = centers_y(self.lines)
+            # Lines with the same center keep their order in the menu
+            order = np.lexsort((center_y, self.line_pages))
+            center_y = center_y[order]
+            tops = self.lines[order, Y0]
+            bottoms = self.lines[order, Y3]
+            same_page = self.line_pages[order][1:] == self.line_pages[order][:-1]
+
+            counts = np.zeros(len(order), dtype=np.int64)
+            # The line before covers the center of the one after it, and the other way round
+            counts[1:] += (
+                same_page & (tops[:-1] < center_y[1:]) & (center_y[1:] < bottoms[:-1])
+            )
+            counts[:-1] += (
+                same_page & (tops[1:] < center_y[:-1]) & (center_y[:-1] < bottoms[1:])
+            )
+            self._row_neighbours = np.empty_like(counts)
+            self._row_neighbours[order] = counts
+        return self._row_neighbours[indices]
+
+
+def line_indices(lines) -> np.ndarray:
+    """Returns the indices of the lines into the GeometryStore of their menu."""
+    return np.fromiter((line.index for line in lines), dtype=np.intp, count=len(lines))
+
+
+def heights(boxes: np.ndarray) -> np.ndarray:
+    """The average of the heights of the left and right sides of the boxes."""
+    return ((boxes[:, Y3] - boxes[:, Y0]) + (boxes[:, Y2] - boxes[:, Y1])) / 2
+
+
+def widths(boxes: np.ndarray) -> np.ndarray:
+    """The average of the widths of the top and bottom sides of the boxes."""
+    return ((boxes[:, X1] - boxes[:, X0]) + (boxes[:, X2] - boxes[:, X3])) / 2
+
+
+def centers_x(boxes: np.ndarray) -> np.ndarray:
+    return (boxes[:, X0] + boxes[:, X1] + boxes[:, X2] + boxes[:, X3]) / 4
+
+
+def centers_y(boxes: np.ndarray) -> np.ndarray:
+    return (boxes[:, Y0] + boxes[:, Y1] + boxes[:, Y2] + boxes[:, Y3]) / 4
+
+
+class RowIndex:
+    """
+    An index over the vertical extents of the lines of a page, counting the lines that cover a given height.
+
+    The extents run from the top left to the bottom left corner of the boxes, a height is covered if it lies strictly
+    between them. The tops and the bottoms are sorted separately, so counting the lines covering any number of heights
+    is two binary searches per height.
+
+    Args:
+        tops (np.ndarray): The top of every line.
+        bottoms (np.ndarray): The bottom of every line.
+    """
+
+    def __init__(self, tops: np.ndarray, bottoms: np.ndarray):
+        # Empty or inverted extents can't cover anything
+        valid = tops < bottoms
+        self.tops = np.sort(tops[valid])
+        self.bottoms = np.sort(bottoms[valid])
+
+    def __len__(self) -> int:
+        return len(self.tops)
+
+    def count(self, ys: np.ndarray) -> np.ndarray:
+        """Returns the number of lines covering each of the heights."""
+        # Every valid extent ending above y also starts above it, so those can just be subtracted
+        return np.searchsorted(self.tops, ys, side="left") - np.searchsorted(
+            self.bottoms, ys, side="right"
+        )
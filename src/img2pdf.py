@@ -1,29 +1,70 @@
+import io
 import os
+from typing import Union
+
 from PIL import Image
 import fitz
-import tempfile
 
-from conf import IMG_EXTENSIONS
+from conf import IMG_EXTENSIONS, SOURCE_IMAGE_MAX_SIZE
+
+# Formats MuPDF can embed without converting them first, JPEGs are embedded as they are without re-encoding
+FITZ_IMAGE_FORMATS = {"JPEG", "PNG", "BMP", "GIF", "TIFF", "PPM", "PSD"}
+
+# The EXIF tag with the orientation of the image, 1 is upright
+EXIF_ORIENTATION = 274
 
 
-def img_file_to_pdf_file(image_path, output_path, resolution=72.0):
-    try:
-        image = Image.open(image_path)
-    except IOError:
-        raise Exception("Error opening image file: {}".format(image_path))
-    # Convert the image to PDF
-    image.save(output_path, "PDF", resolution=resolution)
+def _encode(image: Image.Image) -> bytes:
+    """Encodes the image as a JPEG if it's a photo, as a PNG otherwise."""
+    buffer = io.BytesIO()
+    if image.mode in ("RGB", "L", "CMYK"):
+        image.save(buffer, "JPEG", quality=90)
+    else:
+        image.save(buffer, "PNG")
+    return buffer.getvalue()
 
 
-def img_to_fitz(image_path: str):
-    _, ext = os.path.splitext(image_path)
-    if ext.upper()[1:] not in IMG_EXTENSIONS:
-        raise Exception(
-            "Image file type not supported. Allowed types are: {}".format(
-                ", ".join(IMG_EXTENSIONS)
+def img_to_fitz(
+    image: Union[str, bytes], max_size: int = SOURCE_IMAGE_MAX_SIZE
+) -> fitz.Document:
+    """
+    Creates a single page PDF document with the image, without any temporary files.
+
+    The page is as large in points as the image is in pixels, the same as the coordinates of the OCR data of images.
+
+    Args:
+        image (Union[str, bytes]): The path to the image or its content.
+        max_size (int, optional): If the image is larger, it's downscaled so its longest side has this many pixels.
+        The page keeps the original size, only the embedded image has a lower resolution. 0 keeps the original image.
+        Default is conf.SOURCE_IMAGE_MAX_SIZE.
+    """
+    if isinstance(image, str):
+        _, ext = os.path.splitext(image)
+        if ext.upper()[1:] not in {extension.upper() for extension in IMG_EXTENSIONS}:
+            raise Exception(
+                "Image file type not supported. Allowed types are: {}".format(
+                    ", ".join(IMG_EXTENSIONS)
+                )
             )
-        )
+        with open(image, "rb") as f:
+            data = f.read()
+    else:
+        data = image
+
+    # Opening the image only reads its header, the pixels are only decoded if it has to be converted
+    with Image.open(io.BytesIO(data)) as pil_image:
+        width, height = pil_image.size
+        if max_size and max(width, height) > max_size:
+            pil_image.thumbnail((max_size, max_size))
+            data = _encode(pil_image)
+        elif (
+            pil_image.format not in FITZ_IMAGE_FORMATS
+            # MuPDF would rotate the image, the OCR coordinates are of the stored pixels
+            or pil_image.getexif().get(EXIF_ORIENTATION, 1) != 1
+        ):
+            data = _encode(pil_image)
 
-    with tempfile.NamedTemporaryFile(suffix=".pdf") as temp:
-        img_file_to_pdf_file(image_path, temp.name)
-        return fitz.Document(temp.name)
+    doc = fitz.Document()
+    page = doc.new_page(width=width, height=height)
+    page.insert_image(page.rect, stream=data)
+    return doc
@@ -0,0 +1,119 @@
+import json
+from typing import Any, Iterator, TextIO, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    """A buffer over a text file that decodes one JSON value at a time."""
+
+    def __init__(self, file: TextIO, chunk_size: int):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size: int) -> bool:
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what was already consumed, so the buffer only holds the value being decoded
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character, or "" at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._read(self.chunk_size):
+                return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def decode(self) -> Any:
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow the reads, so a large value isn't decoded over and over again
+            self._read(size)
+            size *= 2
+
+
+def loads(data: bytes) -> Any:
+    """Decodes a JSON document, using orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load_json_file(path: str) -> Any:
+    """Decodes the JSON file, using orjson if it is installed, which is several times faster than the json module."""
+    if orjson is not None:
+        with open(path, "rb") as file:
+            return orjson.loads(file.read())
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def iter_object(
+    file: TextIO, stream_key: str, chunk_size: int = 1 << 16
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Iterates over the items of the top level JSON object in the file without loading the whole document.
+
+    The array under `stream_key` is streamed, a (key, element) pair is yielded for each of its elements as soon
+    as it is decoded. The values of the other keys are yielded whole.
+
+    Args:
+        file (TextIO): The file with the JSON document.
+        stream_key (str): The key of the array that is streamed.
+        chunk_size (int, optional): How many characters are read from the file at once. Default is 64 KiB.
+    """
+    reader = _Reader(file, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        key = reader.decode()
+        reader.expect(":")
+
+        if key == stream_key:
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield key, reader.decode()
+                    if reader.peek() == "]":
+                        reader.pos += 1
+                        break
+                    reader.expect(",")
+        else:
+            yield key, reader.decode()
+
+        if reader.peek() == "}":
+            return
+        reader.expect(",")
@@ -1,54 +1,201 @@
+import argparse
 import os
 import sys
-from conf import CONF_THRESHOLD
-from file_handler import load_ocr_data, save
+from typing import List, Optional, Sequence, Tuple
+from conf import CONF_THRESHOLD, PROFILER
+from batch import find_ocr_files, run_batch
+from file_handler import default_output_dir, load_ocr_data
 
 from models import *
-from filters import calculate_confindences
+from filters import LineFilter, calculate_confindences_many
 from logger import get_logger
+from metrics import METRICS, profile, write_metrics
+from output import SINK_NAMES, ProcessResult, Sink, create_sinks
 
 
 logger = get_logger(__name__)
 
 
-def process_ocr(path):
-    logger.info(f"Processing file {path}")
-    menu = load_ocr_data(path)
+def process_menu(
+    menu: Menu,
+    path: str,
+    sinks: Sequence[Sink] = (),
+    line_filter: Optional[LineFilter] = None,
+    source: Optional[Tuple[bytes, str]] = None,
+    conf_threshold: float = CONF_THRESHOLD,
+) -> ProcessResult:
+    """
+    Finds the lines of the menu that are probably categories and writes them to the sinks.
 
-    # Get all lines linked to page numbers
-    lines_to_pages = {
-        id(line): page.page_num for page in menu.pages for line in page.lines
-    }
+    Args:
+        menu (Menu): The menu to process.
+        path (str): The path of the OCR data of the menu, used to name the outputs and find the source file.
+        sinks (Sequence[Sink], optional): Where the results are written to. Default is nowhere, they are only returned.
+        line_filter (LineFilter, optional): The filter to use, so it can be reused between menus. Default is a new one.
+        source (Tuple[bytes, str], optional): The source file and its name, if it isn't stored next to the OCR data.
+        conf_threshold (float, optional): Default is conf.CONF_THRESHOLD.
+    """
+    result = process_menus([menu], [path], line_filter, conf_threshold)[0]
+    result.source = source
+    write_result(result, sinks)
+    return result
 
-    calculate_confindences(menu, lines_to_pages, CONF_THRESHOLD)
 
-    possible_category_lines = [
-        line
-        for page in menu.pages
-        for line in page.lines
-        if line.analysis.category_confidence > CONF_THRESHOLD
+def process_menus(
+    menus: Sequence[Menu],
+    paths: Sequence[str],
+    line_filter: Optional[LineFilter] = None,
+    conf_threshold: float = CONF_THRESHOLD,
+) -> List[ProcessResult]:
+    """
+    Finds the categories of several menus at once, so the GPT filter packs the lines of all of them into the same
+    requests. The results aren't written anywhere, see `write_result`.
+
+    Args:
+        menus (Sequence[Menu]): The menus to process.
+        paths (Sequence[str]): The paths of the OCR data of the menus, in the same order.
+        line_filter (LineFilter, optional): The filter to use, so it can be reused between menus. Default is a new one.
+        conf_threshold (float, optional): Default is conf.CONF_THRESHOLD.
+    """
+    results = [
+        ProcessResult(path, menu, categories)
+        for menu, path, categories in zip(
+            menus,
+            paths,
+            calculate_confindences_many(list(menus), conf_threshold, line_filter),
+        )
     ]
 
-    logger.info(f"Found {len(possible_category_lines)} possible categories")
+    for result in results:
+        logger.info(f"Found {len(result.categories)} possible categories")
+        METRICS.inc("menus_total")
+        METRICS.inc("lines_total", len(result.menu.lines))
+        METRICS.inc("categories_total", len(result.categories))
+    return results
+
 
-    save(menu, path, possible_category_lines, lines_to_pages)
+def write_result(result: ProcessResult, sinks: Sequence[Sink]):
+    """Writes the result to every sink."""
+    for sink in sinks:
+        with METRICS.timer("sink_seconds", sink=sink.__class__.__name__):
+            sink.write(result)
+
+
+def process_ocr(
+    path: str,
+    sinks: Sequence[Sink] = (),
+    line_filter: Optional[LineFilter] = None,
+) -> ProcessResult:
+    """Processes the OCR data in the JSON file, see `process_menu`."""
+    logger.info(f"Processing file {path}")
+    menu = load_ocr_data(path)
+    return process_menu(menu, path, sinks, line_filter)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Extracts the categories from restaurant menu OCR data."
+    )
+    parser.add_argument(
+        "path",
+        help="A JSON file containing OCR data or a directory containing such files",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used when processing a directory, 0 uses all cores. Default is 1",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep watching the directory and process the OCR files as they are added to it, until interrupted",
+    )
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="Report the results of a directory run as soon as they are done instead of in file order",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="csv,pdf",
+        help=f"Comma separated outputs, any of {', '.join(SINK_NAMES)}. Default is csv,pdf",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=None,
+        help="The folder the outputs are written to. Default is output_ai if OPEN_AI_API_KEY is set, output otherwise",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Write the timers and counters of the run to this file, in the Prometheus text format if it ends "
+        "with .prom, otherwise appended as a JSON line",
+    )
+    parser.add_argument(
+        "--profile",
+        default=PROFILER,
+        choices=["cprofile", "pyinstrument"],
+        help="Profile the processing of every file, the profiles are saved to conf.PROFILE_DIR. Default is conf.PROFILER",
+    )
+    args = parser.parse_args(argv)
+
+    args.output = [name.strip() for name in args.output.split(",")]
+    unknown = [name for name in args.output if name not in SINK_NAMES]
+    if unknown:
+        parser.error(
+            f"unknown output {', '.join(unknown)}, expected any of {', '.join(SINK_NAMES)}"
+        )
+    if args.watch and not os.path.isdir(args.path):
+        parser.error("--watch needs a directory")
+    return args
 
 
 def main() -> None:
-    # Retrieve the first argument
-    path = sys.argv[1]
+    args = parse_args()
+    path = args.path
+    sinks = create_sinks(args.output, args.output_dir or default_output_dir())
+    for sink in sinks:
+        sink.start()
+
+    failed = False
+    if args.watch:
+        from watch import watch_directory
 
-    if os.path.isfile(path):
+        watch_directory(
+            path,
+            sinks,
+            args.output_dir or default_output_dir(),
+            workers=args.workers or os.cpu_count() or 1,
+            # The source file is only needed for the highlighted PDFs
+            wait_for_source="pdf" in args.output,
+            profiler=args.profile,
+        )
+    elif os.path.isfile(path):
         if not path.endswith(".json"):
             raise ValueError(
                 "Please provide a JSON file containing OCR data or a directory containing such files"
             )
-        process_ocr(path)
+        with profile(os.path.splitext(os.path.basename(path))[0], args.profile):
+            process_ocr(path, sinks)
     elif os.path.isdir(path):
-        for file in os.listdir(path):
-            if not file.endswith(".json"):
-                continue
-            process_ocr(os.path.join(path, file))
+        workers = args.workers or os.cpu_count() or 1
+        summary = run_batch(
+            find_ocr_files(path),
+            workers=workers,
+            ordered=not args.unordered,
+            sinks=sinks,
+            profiler=args.profile,
+        )
+        summary.log()
+        failed = bool(summary.failed)
+
+    if args.metrics:
+        write_metrics(args.metrics)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+import attr
+
+from conf import PROFILE_DIR, PROFILER
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# The prefix of the metric names in the Prometheus text format
+PREFIX = "menu_"
+
+# A metric is identified by its name and its sorted labels
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+# Descriptions of the metrics, for the HELP lines of the Prometheus text format
+DESCRIPTIONS = {
+    "load_seconds": "Time spent loading the OCR data",
+    "filter_seconds": "Time spent in every stage of the filters",
+    "filter_lines_total": "Lines every stage of the filters was applied to",
+    "sink_seconds": "Time spent writing the results to every output",
+    "menus_total": "Processed menus",
+    "lines_total": "OCR lines of the processed menus",
+    "categories_total": "Category lines found",
+    "gpt_request_seconds": "Latency of the requests to OpenAI, every attempt separately",
+    "gpt_requests_total": "Requests to OpenAI by outcome",
+    "gpt_retries_total": "Requests to OpenAI that were retried",
+    "gpt_prompt_tokens_total": "Prompt tokens sent to OpenAI",
+    "gpt_completion_tokens_total": "Completion tokens received from OpenAI",
+    "gpt_answers_total": "Answers of GPT about lines by outcome: valid, invalid, missing or failed",
+    "watch_files_total": "Files of the watched directory by outcome: processed, failed or duplicate",
+    "watch_latency_seconds": "Time from a watched file appearing to it being processed",
+}
+
+
+def _key(name: str, labels: Dict[str, object]) -> Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in labels) + "}"
+    )
+
+
+@attr.s
+class Timer:
+    """The number, total and longest duration of the observations of a timer, in seconds."""
+
+    count: int = attr.ib(default=0)
+    sum: float = attr.ib(default=0.0)
+    max: float = attr.ib(default=0.0)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "Timer"):
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+
+class Metrics:
+    """
+    Counters and timers with labels, safe to update from several threads.
+
+    The pipeline records into the module level `METRICS`, which is exported with `render_prometheus` or written
+    as a JSON line with `write_metrics`. Worker processes of a batch send their `snapshot` back to be merged.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Key, float] = {}
+        self.timers: Dict[Key, Timer] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = Timer()
+            timer.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Observes how long the block took, also if it raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def snapshot(self) -> dict:
+        """Returns the metrics as JSON serializable lists, see `merge`."""
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "timers": [
+                    {"name": name, "labels": dict(labels), **attr.asdict(timer)}
+                    for (name, labels), timer in self.timers.items()
+                ],
+            }
+
+    def merge(self, snapshot: dict):
+        """Adds the metrics of a snapshot, e.g. one taken in a worker process."""
+        for counter in snapshot["counters"]:
+            self.inc(counter["name"], counter["value"], **counter["labels"])
+        for entry in snapshot["timers"]:
+            key = _key(entry["name"], entry["labels"])
+            with self._lock:
+                timer = self.timers.setdefault(key, Timer())
+                timer.merge(Timer(entry["count"], entry["sum"], entry["max"]))
+
+    def render_prometheus(self) -> str:
+        """Renders the metrics in the Prometheus text format, every timer as a summary with a _count and a _sum."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+
+        output = []
+        described = set()
+
+        def describe(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                output.append(f"# HELP {PREFIX}{name} {DESCRIPTIONS.get(name, name)}")
+                output.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            output.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for (name, labels), timer in timers:
+            describe(name, "summary")
+            output.append(f"{PREFIX}{name}_count{_format_labels(labels)} {timer.count}")
+            output.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {timer.sum}")
+        return "\n".join(output) + "\n" if output else ""
+
+
+METRICS = Metrics()
+
+
+def write_metrics(path: str, metrics: Metrics = METRICS):
+    """
+    Writes the metrics to the file, in the Prometheus text format if it ends with .prom, otherwise appends them as
+    one JSON line, so the runs can be compared.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if path.endswith(".prom"):
+        with open(path, "w") as f:
+            f.write(metrics.render_prometheus())
+        return
+
+    with open(path, "a") as f:
+        f.write(json.dumps({"time": time.time(), **metrics.snapshot()}) + "\n")
+
+
+@contextmanager
+def profile(
+    name: str, profiler: Optional[str] = PROFILER, directory: str = PROFILE_DIR
+) -> Iterator[None]:
+    """
+    Profiles the block and saves the profile as `<directory>/<name>.prof` or `.html`.
+
+    Args:
+        name (str): The name of the profile, e.g. the name of the processed file.
+        profiler (str, optional): "cprofile" saves a pstats file, to be read with e.g. snakeviz, "pyinstrument" an
+        HTML report. None or "" doesn't profile. Default is conf.PROFILER.
+        directory (str, optional): Default is conf.PROFILE_DIR.
+    """
+    if not profiler:
+        yield
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    if profiler == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError:
+            logger.warning("pyinstrument isn't installed, using cProfile instead")
+            profiler = "cprofile"
+
+    if profiler == "pyinstrument":
+        sampler = pyinstrument.Profiler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            path = os.path.join(directory, name + ".html")
+            with open(path, "w") as f:
+                f.write(sampler.output_html())
+            logger.info(f"Saved the profile of {name} to {path}")
+    elif profiler == "cprofile":
+        import cProfile
+
+        tracer = cProfile.Profile()
+        tracer.enable()
+        try:
+            yield
+        finally:
+            tracer.disable()
+            path = os.path.join(directory, name + ".prof")
+            tracer.dump_stats(path)
+            logger.info(f"Saved the profile of {name} to {path}")
+    else:
+        raise ValueError(
+            f"Unknown profiler {profiler}, expected cprofile or pyinstrument"
+        )
@@ -1,30 +1,43 @@
-from typing import List, Optional
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence, TextIO, Tuple
 import attr
 from attr.validators import instance_of
-import json
-
-from fitz import Point as FitzPoint
+import numpy as np
 
 from conf import PDF_SCALES as SCALES
+from geometry import GeometryStore, box_array
+from json_stream import iter_object, load_json_file
+
+if TYPE_CHECKING:
+    # fitz is only imported once a PDF is drawn on, most runs never need it
+    from fitz import Point as FitzPoint
 
 
-@attr.s
+@attr.s(slots=True, frozen=True)
 class Point:
     x: float = attr.ib(converter=float)
     y: float = attr.ib(converter=float)
 
-    def to_fitz(self, scale: str) -> FitzPoint:
+    def to_fitz(self, scale: str) -> "FitzPoint":
+        from fitz import Point as FitzPoint
+
         return FitzPoint(self.x * SCALES[scale], self.y * SCALES[scale])
 
 
-@attr.s
+@attr.s(slots=True)
 class BoundingBox:
-    points: List[Point] = attr.ib()
+    # The x and y coordinates of the corners, usually a view into the GeometryStore of the menu
+    coords: np.ndarray = attr.ib(eq=attr.cmp_using(eq=np.array_equal))
+
+    @property
+    def points(self) -> List[Point]:
+        return [
+            Point(x=self.coords[i], y=self.coords[i + 1])
+            for i in range(0, len(self.coords), 2)
+        ]
 
     @staticmethod
     def from_json(lst: list[float]) -> "BoundingBox":
-        points = [Point(x=lst[i], y=lst[i + 1]) for i in range(0, len(lst), 2)]
-        return BoundingBox(points=points)
+        return BoundingBox(coords=np.array(lst, dtype=np.float64))
 
     def draw(self, page, scale: str = "inch", color: tuple = (0, 0, 1)):
         points = [point.to_fitz(scale) for point in self.points]
@@ -34,43 +47,137 @@ class BoundingBox:
         annot.update()
 
 
-@attr.s
+@attr.s(slots=True, frozen=True)
 class Word:
     text: str = attr.ib()
     bounding_box: BoundingBox = attr.ib()
     confidence: Optional[str] = attr.ib(default=None)
 
 
-@attr.s
+class LazyWords(Sequence[Word]):
+    """
+    The words of a line, which are only turned into Word objects when they are accessed.
+
+    Until then only their texts and confidences are kept, the bounding boxes are rows of the word array
+    of the GeometryStore of the menu.
+    """
+
+    __slots__ = ("texts", "confidences", "boxes", "_words")
+
+    def __init__(
+        self,
+        texts: Tuple[str, ...],
+        confidences: Tuple[Optional[str], ...],
+        boxes: np.ndarray,
+    ):
+        self.texts = texts
+        self.confidences = confidences
+        self.boxes = boxes
+        self._words: Optional[List[Word]] = None
+
+    def materialize(self) -> List[Word]:
+        if self._words is None:
+            self._words = [
+                Word(text=text, bounding_box=BoundingBox(box), confidence=confidence)
+                for text, confidence, box in zip(
+                    self.texts, self.confidences, self.boxes
+                )
+            ]
+        return self._words
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        return self.materialize()[index]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+    def __repr__(self) -> str:
+        return repr(self.materialize())
+
+
+@attr.s(slots=True)
+class TextFeatures:
+    """The flags of the text of a line the text filters read, extracted once per line by a TextMatcher."""
+
+    currency: bool = attr.ib()
+    digits: bool = attr.ib()
+    starts_with_capital: bool = attr.ib()
+    # The last character of the text, empty for a line without text
+    ending: str = attr.ib()
+    # The text without the characters duplicates may differ in
+    dedupe_key: str = attr.ib()
+    # The filters.text_features.TextMatcher that extracted them
+    matcher: object = attr.ib(eq=False, repr=False)
+
+
+@attr.s(slots=True)
 class LineAnalasis:
     category_confidence: float = attr.ib(default=1)
     type: Optional[str] = attr.ib(default=None)
+    text_features: Optional[TextFeatures] = attr.ib(default=None, eq=False)
 
 
-@attr.s
+@attr.s(slots=True)
 class Line:
     text: str = attr.ib()
     bounding_box: BoundingBox = attr.ib()
     words: List[Word] = attr.ib(factory=list)
     analysis: LineAnalasis = attr.ib(factory=LineAnalasis)
+    # The index of the line in the GeometryStore of the menu
+    index: int = attr.ib(default=-1, eq=False)
+    # Where the line is in its menu and the page it is on, set by the menu it is added to
+    page_index: int = attr.ib(default=-1, eq=False)
+    line_index: int = attr.ib(default=-1, eq=False)
+    page: Optional["MenuPage"] = attr.ib(default=None, eq=False, repr=False)
 
     @staticmethod
-    def from_json(data: dict) -> "Line":
+    def from_json(
+        data: dict,
+        index: int = -1,
+        line_boxes: Optional[Iterator[np.ndarray]] = None,
+        word_boxes: Optional[Iterator[np.ndarray]] = None,
+    ) -> "Line":
+        """
+        Creates a line from the OCR data. If the iterators over the rows of a GeometryStore are passed,
+        the bounding boxes are views into the store instead of separate arrays.
+        """
         return Line(
-            bounding_box=BoundingBox.from_json(data["boundingBox"]),
+            bounding_box=BoundingBox(next(line_boxes))
+            if line_boxes
+            else BoundingBox.from_json(data["boundingBox"]),
             words=[
                 Word(
-                    bounding_box=BoundingBox.from_json(word["boundingBox"]),
+                    bounding_box=BoundingBox(next(word_boxes))
+                    if word_boxes
+                    else BoundingBox.from_json(word["boundingBox"]),
                     text=word["text"],
                     confidence=word.get("confidence"),
                 )
                 for word in data["words"]
             ],
             text=data["text"],
+            index=index,
         )
 
+    @property
+    def position(self) -> Tuple[int, int]:
+        """The (page_index, line_index) of the line, which identifies it within its menu, even across processes."""
+        return self.page_index, self.line_index
 
-@attr.s
+    def word_confidences(self) -> Sequence[Optional[str]]:
+        """The OCR confidences of the words, without creating the Word objects of lazily loaded lines."""
+        if isinstance(self.words, LazyWords):
+            return self.words.confidences
+        return [word.confidence for word in self.words]
+
+
+@attr.s(slots=True)
 class MenuPage:
     page_num: int = attr.ib(validator=instance_of(int))
     clockwise_orientation: float = attr.ib()
@@ -80,30 +187,140 @@ class MenuPage:
     lines: List[Line] = attr.ib(factory=list)
 
     @staticmethod
-    def from_json(data: dict) -> "MenuPage":
+    def from_json(
+        data: dict,
+        first_line_index: int = 0,
+        line_boxes: Optional[Iterator[np.ndarray]] = None,
+        word_boxes: Optional[Iterator[np.ndarray]] = None,
+    ) -> "MenuPage":
         return MenuPage(
             page_num=data["page"],
             clockwise_orientation=data["clockwiseOrientation"],
             width=data["width"],
             height=data["height"],
             unit=data["unit"],
-            lines=[Line.from_json(line) for line in data["lines"]],
+            lines=[
+                Line.from_json(line, first_line_index + i, line_boxes, word_boxes)
+                for i, line in enumerate(data["lines"])
+            ],
         )
 
 
-@attr.s
+@attr.s(slots=True)
 class Menu:
     status: str = attr.ib()
     pages: List[MenuPage] = attr.ib(factory=list)
+    geometry: Optional[GeometryStore] = attr.ib(default=None, eq=False, repr=False)
+
+    def __attrs_post_init__(self):
+        # Link the lines to their pages, so no lookup tables are needed to find the page of a line
+        for page_index, page in enumerate(self.pages):
+            for line_index, line in enumerate(page.lines):
+                line.page_index = page_index
+                line.line_index = line_index
+                line.page = page
+
+    @property
+    def lines(self) -> List[Line]:
+        """All the lines of the menu, in order."""
+        return [line for page in self.pages for line in page.lines]
+
+    def get_line(self, page_index: int, line_index: int) -> Line:
+        return self.pages[page_index].lines[line_index]
 
     @staticmethod
     def from_json(data: dict) -> "Menu":
-        recognition_results = [
-            MenuPage.from_json(page) for page in data["recognitionResults"]
-        ]
-        return Menu(status=data["status"], pages=recognition_results)
+        geometry = GeometryStore.from_json(data["recognitionResults"])
+        line_boxes = iter(geometry.lines)
+        word_boxes = iter(geometry.words)
+
+        recognition_results = []
+        first_line_index = 0
+        for page in data["recognitionResults"]:
+            recognition_results.append(
+                MenuPage.from_json(page, first_line_index, line_boxes, word_boxes)
+            )
+            first_line_index += len(page["lines"])
+
+        return Menu(status=data["status"], pages=recognition_results, geometry=geometry)
 
     @staticmethod
     def from_json_file(path: str) -> "Menu":
-        with open(path) as file:
-            return Menu.from_json(json.load(file))
+        return Menu.from_json(load_json_file(path))
+
+    @staticmethod
+    def from_json_stream(file: TextIO) -> "Menu":
+        """
+        Creates a menu from a file with the OCR data, decoding one page at a time instead of the whole document.
+        The words of the lines are LazyWords, which only create the Word objects when they are accessed.
+        """
+        status = None
+        pages: List[MenuPage] = []
+        page_line_boxes: List[np.ndarray] = []
+        page_word_boxes: List[np.ndarray] = []
+        first_line_index = 0
+
+        for key, value in iter_object(file, "recognitionResults"):
+            if key == "status":
+                status = value
+            elif key == "recognitionResults":
+                line_boxes = box_array([line["boundingBox"] for line in value["lines"]])
+                word_boxes = box_array(
+                    [
+                        word["boundingBox"]
+                        for line in value["lines"]
+                        for word in line["words"]
+                    ]
+                )
+
+                lines = []
+                first_word = 0
+                for i, line in enumerate(value["lines"]):
+                    words = line["words"]
+                    lines.append(
+                        Line(
+                            text=line["text"],
+                            bounding_box=BoundingBox(line_boxes[i]),
+                            words=LazyWords(  # type: ignore
+                                tuple(word["text"] for word in words),
+                                tuple(word.get("confidence") for word in words),
+                                word_boxes[first_word : first_word + len(words)],
+                            ),
+                            index=first_line_index + i,
+                        )
+                    )
+                    first_word += len(words)
+
+                pages.append(
+                    MenuPage(
+                        page_num=value["page"],
+                        clockwise_orientation=value["clockwiseOrientation"],
+                        width=value["width"],
+                        height=value["height"],
+                        unit=value["unit"],
+                        lines=lines,
+                    )
+                )
+                page_line_boxes.append(line_boxes)
+                page_word_boxes.append(word_boxes)
+                first_line_index += len(lines)
+
+        geometry = GeometryStore(
+            lines=np.concatenate(page_line_boxes) if pages else box_array([]),
+            words=np.concatenate(page_word_boxes) if pages else box_array([]),
+            line_pages=np.repeat(
+                np.array([page.page_num for page in pages], dtype=np.int64),
+                [len(page.lines) for page in pages],
+            ),
+        )
+
+        # Point the boxes at the store, so the per page arrays can be freed
+        first_word = 0
+        for page in pages:
+            for line in page.lines:
+                line.bounding_box.coords = geometry.lines[line.index]
+                words: LazyWords = line.words  # type: ignore
+                words.boxes = geometry.words[first_word : first_word + len(words)]
+                first_word += len(words)
+
+        return Menu(status=status, pages=pages, geometry=geometry)
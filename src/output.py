@@ -0,0 +1,244 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+import attr
+
+from conf import PDF_SAVE_MODE
+from file_handler import (
+    InvalidSourceError,
+    PdfStats,
+    get_source_file,
+    highlight_lines,
+    load_source_bytes,
+    load_source_image,
+    pdf_bytes,
+    save_csv,
+    save_pdf,
+    write_pdf,
+)
+from logger import get_logger
+from models import Line, Menu
+
+if TYPE_CHECKING:
+    from fitz import Document
+
+logger = get_logger(__name__)
+
+
+def line_json(line: Line) -> dict:
+    return {
+        "text": line.text,
+        "confidence": line.analysis.category_confidence,
+        "page": line.page_index,
+        "line": line.line_index,
+    }
+
+
+@attr.s
+class ProcessResult:
+    """
+    The outcome of processing the OCR data of a menu.
+
+    Args:
+        path (str): The path of the OCR data, the source file is looked up next to it.
+        menu (Menu): The processed menu.
+        categories (List[Line]): The lines that are probably categories.
+        source (Tuple[bytes, str], optional): The source file and its name, if it was received in memory instead of
+        being stored next to the OCR data.
+        pdf (bytes, optional): The highlighted source file, set by the PdfBytesSink.
+        pdf_stats (PdfStats, optional): The pages touched and bytes written by the PDF sinks.
+    """
+
+    path: str = attr.ib()
+    menu: Menu = attr.ib(repr=False)
+    categories: List[Line] = attr.ib()
+    source: Optional[Tuple[bytes, str]] = attr.ib(default=None, repr=False)
+    pdf: Optional[bytes] = attr.ib(default=None, repr=False)
+    pdf_stats: Optional[PdfStats] = attr.ib(default=None)
+
+    @property
+    def name(self) -> str:
+        """The filename of the OCR data without the extension, used to name the outputs."""
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def open_source(self) -> Optional["Document"]:
+        """Opens the source file the OCR data was made from, None if there isn't one."""
+        if self.source is not None:
+            return load_source_bytes(*self.source)
+        source_file = get_source_file(self.path)
+        return load_source_image(source_file) if source_file else None
+
+    def to_json(self) -> dict:
+        return {
+            "file": self.name,
+            "lines": len(self.menu.lines),
+            "categories": [line_json(line) for line in self.categories],
+        }
+
+
+class Sink(ABC):
+    """Abstract base class for the outputs of the results, each sink writes every result it is given."""
+
+    def start(self):
+        """Called once at the start of a run, before any result is written."""
+        pass
+
+    @abstractmethod
+    def write(self, result: ProcessResult):
+        raise NotImplementedError
+
+
+@attr.s
+class CsvSink(Sink):
+    """Writes the category lines and their confidence to `<output_dir>/<name>.csv`."""
+
+    output_dir: str = attr.ib()
+
+    def write(self, result: ProcessResult):
+        os.makedirs(self.output_dir, exist_ok=True)
+        save_csv(result.categories, result.name, self.output_dir)
+
+
+@attr.s
+class JsonlSink(Sink):
+    """
+    Appends one JSON object per menu to a file.
+
+    Every result is written with a single append, so batch workers can share the file.
+    """
+
+    path: str = attr.ib()
+
+    def start(self):
+        # Start every run with an empty file instead of appending to the previous one
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write(self, result: ProcessResult):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(result.to_json(), ensure_ascii=False) + "\n")
+
+
+@attr.s
+class PdfSink(Sink):
+    """
+    Writes the source file with the category lines highlighted to `<output_dir>/<name>.pdf`.
+
+    In the "incremental" mode the highlights are appended to a copy of a source PDF, also of one received in memory.
+    """
+
+    output_dir: str = attr.ib()
+    mode: str = attr.ib(default=PDF_SAVE_MODE)
+
+    def write(self, result: ProcessResult):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if result.source is None:
+            result.pdf_stats = save_pdf(
+                result.categories, result.name, result.path, self.output_dir, self.mode
+            )
+            return
+
+        data, filename = result.source
+        if self.mode == "incremental" and filename.upper().endswith(".PDF"):
+            self.append_highlights(result)
+            return
+
+        # The source isn't stored next to the OCR data, so save_pdf can't find it
+        pdf = PdfBytesSink(self.mode).render(result)
+        if pdf is not None:
+            with open(os.path.join(self.output_dir, result.name + ".pdf"), "wb") as f:
+                f.write(pdf)
+
+    def append_highlights(self, result: ProcessResult):
+        """
+        Writes a PDF that was received in memory to the output folder and appends the highlights to it, like the
+        "incremental" mode of save_pdf does with a copy of a source file.
+        """
+        import fitz
+
+        data, filename = result.source
+        output_path = os.path.join(self.output_dir, result.name + ".pdf")
+        with open(output_path, "wb") as f:
+            f.write(data)
+        try:
+            doc = fitz.Document(output_path)
+        except RuntimeError as e:
+            os.remove(output_path)
+            raise InvalidSourceError(
+                f"Can't read {filename}: {e.__class__.__name__}: {e}"
+            ) from e
+
+        try:
+            pages_total = len(doc)
+            pages = highlight_lines(doc, result.categories)
+            write_pdf(doc, output_path, self.mode, pages)
+        finally:
+            doc.close()
+        result.pdf_stats = PdfStats(
+            pages_touched=len(pages),
+            pages_total=pages_total,
+            bytes_written=os.path.getsize(output_path) - len(data),
+            bytes_copied=len(data),
+        )
+        logger.debug(f"Saved {output_path}: {result.pdf_stats}")
+
+
+@attr.s
+class PdfBytesSink(Sink):
+    """
+    Renders the source file with the category lines highlighted into `result.pdf`, without touching the disk.
+
+    The "pages" mode only renders the pages with category lines, the other modes the whole document.
+    """
+
+    mode: str = attr.ib(default=PDF_SAVE_MODE)
+
+    def render(self, result: ProcessResult) -> Optional[bytes]:
+        doc = result.open_source()
+        if doc is None:
+            logger.warning(f"No source file found for {result.name}, skipping PDF")
+            return None
+        try:
+            pages_total = len(doc)
+            pages = highlight_lines(doc, result.categories)
+            pdf = pdf_bytes(doc, pages, self.mode)
+            result.pdf_stats = PdfStats(len(pages), pages_total, len(pdf))
+            return pdf
+        finally:
+            doc.close()
+
+    def write(self, result: ProcessResult):
+        result.pdf = self.render(result)
+
+
+# The sinks that can be chosen by name
+SINK_NAMES = ["csv", "jsonl", "pdf", "none"]
+
+
+def create_sinks(names: Iterable[str], output_dir: str) -> List[Sink]:
+    """
+    Creates the sinks with the given names, writing to the output directory.
+
+    Args:
+        names (Iterable[str]): Any of "csv", "jsonl" (all the menus in `<output_dir>/categories.jsonl`), "pdf" and
+        "none", which writes nothing.
+        output_dir (str): The folder the outputs are written to.
+    """
+    sinks: List[Sink] = []
+    for name in names:
+        if name == "csv":
+            sinks.append(CsvSink(output_dir))
+        elif name == "jsonl":
+            sinks.append(JsonlSink(os.path.join(output_dir, "categories.jsonl")))
+        elif name == "pdf":
+            sinks.append(PdfSink(output_dir))
+        elif name != "none":
+            raise ValueError(
+                f"Unknown output {name}, expected one of {', '.join(SINK_NAMES)}"
+            )
+    return sinks
@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import attr
+from aiohttp import web
+
+from conf import (
+    CONF_THRESHOLD,
+    PDF_SAVE_MODE,
+    SERVER_HOST,
+    SERVER_MAX_CONCURRENCY,
+    SERVER_MAX_PENDING,
+    SERVER_MAX_UPLOAD_MB,
+    SERVER_PORT,
+)
+from file_handler import InvalidSourceError
+from filters import LineFilter, default_filters
+from json_stream import loads
+from logger import get_logger
+from main import process_menu
+from metrics import METRICS
+from models import Menu
+from output import PdfBytesSink, ProcessResult, line_json
+
+logger = get_logger(__name__)
+
+
+class BadRequest(Exception):
+    """The request can't be processed, the message is returned to the client."""
+
+
+@attr.s
+class ServiceMetrics:
+    """
+    Counters of the HTTP service, exposed in the Prometheus text format on /metrics.
+
+    The lines, categories and the time of every stage are counted by the pipeline in `metrics.METRICS`.
+    """
+
+    requests: int = attr.ib(default=0)
+    failed: int = attr.ib(default=0)
+    rejected: int = attr.ib(default=0)
+    in_flight: int = attr.ib(default=0)
+    pending: int = attr.ib(default=0)
+    processing_seconds: float = attr.ib(default=0.0)
+    started: float = attr.ib(factory=time.time)
+
+    def render(self) -> str:
+        metrics = [
+            ("requests_total", "counter", "Processed menus", self.requests),
+            ("failed_total", "counter", "Menus that failed to process", self.failed),
+            (
+                "rejected_total",
+                "counter",
+                "Requests rejected as overloaded",
+                self.rejected,
+            ),
+            ("in_flight", "gauge", "Menus being processed", self.in_flight),
+            ("pending", "gauge", "Requests waiting for a free slot", self.pending),
+            (
+                "processing_seconds_total",
+                "counter",
+                "Time spent processing menus",
+                self.processing_seconds,
+            ),
+            (
+                "start_time_seconds",
+                "gauge",
+                "Unix time the service started at",
+                self.started,
+            ),
+        ]
+        output = []
+        for name, kind, description, value in metrics:
+            output.append(f"# HELP menu_{name} {description}")
+            output.append(f"# TYPE menu_{name} {kind}")
+            output.append(f"menu_{name} {value}")
+        return "\n".join(output) + "\n"
+
+
+class MenuService:
+    """
+    Processes menus for the HTTP service.
+
+    Every processing slot has its own LineFilter, which is created once and reused, so the GPT client and cache stay
+    warm between requests. The filters keep state while they are applied, so a LineFilter is only ever used by one
+    request at a time. The processing itself runs in a thread pool to keep the event loop responsive.
+
+    Args:
+        max_concurrency (int, optional): The number of menus processed at the same time. Default is conf.SERVER_MAX_CONCURRENCY.
+        max_pending (int, optional): The number of requests that may wait for a free slot. Default is conf.SERVER_MAX_PENDING.
+        conf_threshold (float, optional): Default is conf.CONF_THRESHOLD.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SERVER_MAX_CONCURRENCY,
+        max_pending: int = SERVER_MAX_PENDING,
+        conf_threshold: float = CONF_THRESHOLD,
+    ):
+        self.max_pending = max_pending
+        self.conf_threshold = conf_threshold
+        self.metrics = ServiceMetrics()
+        self.executor = ThreadPoolExecutor(max_concurrency, "menu-service")
+        self.line_filters: asyncio.Queue = asyncio.Queue()
+        for _ in range(max_concurrency):
+            self.line_filters.put_nowait(LineFilter(*default_filters(conf_threshold)))
+
+    def process(
+        self,
+        line_filter: LineFilter,
+        ocr: bytes,
+        source: Optional[Tuple[bytes, str]] = None,
+        pdf_mode: str = PDF_SAVE_MODE,
+    ) -> ProcessResult:
+        """Processes the menu, the highlighted source is rendered into the result if one was given."""
+        try:
+            with METRICS.timer("load_seconds", loader="request"):
+                menu = Menu.from_json(loads(ocr))
+        except (ValueError, KeyError, TypeError) as e:
+            raise BadRequest(f"Invalid OCR data: {e.__class__.__name__}: {e}")
+
+        try:
+            return process_menu(
+                menu,
+                "request.json",
+                [PdfBytesSink(pdf_mode)] if source is not None else [],
+                line_filter,
+                source,
+                self.conf_threshold,
+            )
+        except InvalidSourceError as e:
+            raise BadRequest(f"Invalid source file: {e}")
+
+    async def submit(
+        self,
+        ocr: bytes,
+        source: Optional[Tuple[bytes, str]] = None,
+        pdf_mode: str = PDF_SAVE_MODE,
+    ) -> ProcessResult:
+        if self.metrics.pending >= self.max_pending:
+            self.metrics.rejected += 1
+            raise web.HTTPServiceUnavailable(
+                text="Too many requests, try again later", headers={"Retry-After": "1"}
+            )
+
+        self.metrics.pending += 1
+        try:
+            line_filter = await self.line_filters.get()
+        finally:
+            self.metrics.pending -= 1
+
+        self.metrics.in_flight += 1
+        start = time.perf_counter()
+
+        def finished(future: asyncio.Future):
+            # Runs once the thread is done with the filter, even if the request was cancelled before
+            self.metrics.in_flight -= 1
+            self.metrics.processing_seconds += time.perf_counter() - start
+            self.line_filters.put_nowait(line_filter)
+            if future.cancelled():
+                self.metrics.failed += 1
+            elif future.exception() is None:
+                self.metrics.requests += 1
+            elif not isinstance(future.exception(), BadRequest):
+                self.metrics.failed += 1
+
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.process, line_filter, ocr, source, pdf_mode
+        )
+        future.add_done_callback(finished)
+        # aiohttp cancels the handler when the client disconnects, but the thread keeps using the filter, so the
+        # future itself isn't cancelled and only gives the filter back once the thread is done
+        return await asyncio.shield(future)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+async def read_request(
+    request: web.Request,
+) -> Tuple[bytes, Optional[Tuple[bytes, str]]]:
+    """
+    Returns the OCR data and the source file of the request, with the name of the source file.
+
+    The OCR data is either the JSON body of the request or the "ocr" field of a multipart form, which may also
+    contain the PDF or image the OCR data was made from in a "source" field.
+    """
+    if not request.content_type.startswith("multipart/"):
+        return await request.read(), None
+
+    ocr = None
+    source = None
+    async for part in await request.multipart():
+        if part.name == "ocr":
+            ocr = await part.read()
+        elif part.name == "source":
+            if not part.filename:
+                raise BadRequest("The source file needs a filename with its extension")
+            source = (bytes(await part.read()), part.filename)
+    if ocr is None:
+        raise BadRequest("Missing the 'ocr' field")
+    return bytes(ocr), source
+
+
+async def handle_process(request: web.Request) -> web.Response:
+    """
+    Processes a menu and returns its category lines as JSON.
+
+    With `?pdf=1` the source file highlighted with the category lines is returned instead, `?pdf=pages` only returns
+    the pages with category lines.
+    """
+    service: MenuService = request.app["service"]
+    pdf = request.query.get("pdf", "").lower()
+    want_pdf = pdf in ("1", "true", "yes", "pages")
+    start = time.perf_counter()
+
+    try:
+        ocr, source = await read_request(request)
+        if want_pdf and source is None:
+            raise BadRequest("A source file is needed to return the PDF")
+        result = await service.submit(
+            ocr,
+            source if want_pdf else None,
+            "pages" if pdf == "pages" else PDF_SAVE_MODE,
+        )
+    except BadRequest as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    if want_pdf:
+        return web.Response(body=result.pdf, content_type="application/pdf")
+    return web.json_response(
+        {
+            "categories": [line_json(line) for line in result.categories],
+            "lines": len(result.menu.lines),
+            "duration": time.perf_counter() - start,
+        }
+    )
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    metrics: ServiceMetrics = request.app["service"].metrics
+    return web.json_response(
+        {"status": "ok", "in_flight": metrics.in_flight, "pending": metrics.pending}
+    )
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    # The counters of the service, followed by those of the pipeline
+    return web.Response(
+        text=request.app["service"].metrics.render() + METRICS.render_prometheus()
+    )
+
+
+def create_app(service: Optional[MenuService] = None) -> web.Application:
+    """
+    Creates the aiohttp application of the HTTP service.
+
+    Args:
+        service (MenuService, optional): The service processing the menus. Default is a MenuService configured from conf.py,
+        created when the application starts.
+    """
+    app = web.Application(client_max_size=int(SERVER_MAX_UPLOAD_MB * 1024 * 1024))
+
+    async def start(app: web.Application):
+        # The queue of the service has to be created inside the event loop
+        app["service"] = service or MenuService()
+
+    async def stop(app: web.Application):
+        app["service"].close()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app.router.add_post("/process", handle_process)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serves the category extraction over HTTP."
+    )
+    parser.add_argument(
+        "--host", default=SERVER_HOST, help="Default is conf.SERVER_HOST"
+    )
+    parser.add_argument(
+        "--port", type=int, default=SERVER_PORT, help="Default is conf.SERVER_PORT"
+    )
+    args = parser.parse_args()
+
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
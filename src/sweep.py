@@ -0,0 +1,265 @@
+"""
+Grid search over the weights of the filters and the confidence threshold.
+
+The factor every filter multiplied the confidence of every line by is recorded once per menu and cached in
+conf.FACTOR_CACHE_DIR, keyed on the content of the OCR file and the filters, so the OCR data is only parsed and GPT
+only asked again when one of them changes. Every combination of weights and thresholds is then applied to the
+cached factors, which takes milliseconds for the whole corpus.
+
+    # The weights are exponents of the factors of a filter: 0 disables it, 1 keeps it as it is, 2 applies it twice
+    poetry run python src/sweep.py data --weight FilterFontSize=0.5,1,2 --weight FilterContainsNumbers=0,1 \
+        --threshold 0.6,0.75,0.9
+
+The combinations are scored against the labels written by src/train_classifier.py if the menus have any, otherwise
+they are compared with the categories found with the filters as they are and conf.CONF_THRESHOLD.
+"""
+import argparse
+import csv
+import itertools
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from batch import find_ocr_files
+from conf import CONF_THRESHOLD
+from filters import FactorCache, FactorMatrix, default_filters, record_factors
+from filters.factors import Weights
+from logger import get_logger
+from train_classifier import Scores, labels_path
+
+logger = get_logger(__name__)
+
+
+def parse_values(text: str) -> List[float]:
+    return [float(value) for value in text.split(",") if value.strip()]
+
+
+def parse_weight(text: str) -> Tuple[str, List[float]]:
+    name, separator, values = text.partition("=")
+    if not separator or not values:
+        raise argparse.ArgumentTypeError(
+            f"Expected NAME=VALUE[,VALUE...], got '{text}'"
+        )
+    try:
+        return name.strip(), parse_values(values)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid weights in '{text}'")
+
+
+def load_position_labels(matrix: FactorMatrix, path: str) -> Optional[np.ndarray]:
+    """Returns the labels of the rows of the matrix, or None if they don't match its lines."""
+    labels: Dict[Tuple[int, int], bool] = {}
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            labels[int(row["page"]), int(row["line"])] = row["category"].strip() == "1"
+
+    positions = [tuple(position) for position in matrix.positions.tolist()]
+    if any(position not in labels for position in positions):
+        logger.warning(f"{path} doesn't label all the lines, skipping it")
+        return None
+    return np.array([labels[position] for position in positions], dtype=bool)
+
+
+def sweep(
+    matrices: List[FactorMatrix],
+    labels: List[Optional[np.ndarray]],
+    weights: List[Weights],
+    thresholds: List[float],
+) -> List[dict]:
+    """
+    Rescores the menus with every combination of the weights and the thresholds.
+
+    Returns:
+        List[dict]: A result per combination with its weights, threshold and the number of categories found, and
+        either the Scores against the labels or the categories added and removed compared to the filters as they are.
+    """
+    shape = (len(thresholds), len(weights))
+    found = np.zeros(shape, dtype=np.int64)
+    true_positives = np.zeros(shape, dtype=np.int64)
+    false_positives = np.zeros(shape, dtype=np.int64)
+    false_negatives = np.zeros(shape, dtype=np.int64)
+    added = np.zeros(shape, dtype=np.int64)
+    removed = np.zeros(shape, dtype=np.int64)
+    labeled = any(menu_labels is not None for menu_labels in labels)
+
+    for matrix, menu_labels in zip(matrices, labels):
+        if labeled and menu_labels is None:
+            continue
+        confidences = matrix.confidences(weights)
+        reference = matrix.confidences()[:, 0] > CONF_THRESHOLD
+        expected = menu_labels if labeled else reference
+        for i, threshold in enumerate(thresholds):
+            predicted = confidences > threshold
+            found[i] += predicted.sum(axis=0)
+            hits = (predicted & expected[:, np.newaxis]).sum(axis=0)
+            true_positives[i] += hits
+            false_positives[i] += predicted.sum(axis=0) - hits
+            false_negatives[i] += expected.sum() - hits
+            added[i] += (predicted & ~reference[:, np.newaxis]).sum(axis=0)
+            removed[i] += (~predicted & reference[:, np.newaxis]).sum(axis=0)
+
+    results = []
+    for i, threshold in enumerate(thresholds):
+        for j, weight in enumerate(weights):
+            results.append(
+                {
+                    "weights": weight,
+                    "threshold": threshold,
+                    "categories": int(found[i, j]),
+                    "scores": Scores(
+                        int(true_positives[i, j]),
+                        int(false_positives[i, j]),
+                        int(false_negatives[i, j]),
+                    )
+                    if labeled
+                    else None,
+                    "added": int(added[i, j]),
+                    "removed": int(removed[i, j]),
+                }
+            )
+    return results
+
+
+def format_weights(weights: Weights) -> str:
+    return " ".join(f"{name}={value:g}" for name, value in weights.items()) or "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory", help="The directory with the OCR data")
+    parser.add_argument(
+        "--weight",
+        type=parse_weight,
+        action="append",
+        default=[],
+        metavar="FILTER=W1,W2",
+        help="Weights to try for a filter, by its class name. Can be repeated, the other filters are weighted with 1",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=parse_values,
+        default=[CONF_THRESHOLD],
+        metavar="T1,T2",
+        help="Confidence thresholds to try. Default is conf.CONF_THRESHOLD",
+    )
+    parser.add_argument(
+        "--labels-dir",
+        help="The directory with the label files. Default is <directory>/labels",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="How many of the combinations to report, the best ones if the menus are labeled. Default is 10",
+    )
+    parser.add_argument(
+        "--output", help="Write the results of all the combinations to this CSV file"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Record the factors again instead of using conf.FACTOR_CACHE_DIR",
+    )
+    args = parser.parse_args()
+    labels_dir = args.labels_dir or os.path.join(args.directory, "labels")
+
+    json_files = find_ocr_files(args.directory)
+    if not json_files:
+        raise SystemExit(f"No OCR data found in {args.directory}")
+
+    start = time.perf_counter()
+    matrices = record_factors(
+        json_files,
+        default_filters(CONF_THRESHOLD),
+        CONF_THRESHOLD,
+        cache=None if args.no_cache else FactorCache(),
+    )
+    logger.info(f"Loaded the factors in {time.perf_counter() - start:.2f}s")
+
+    labels = []
+    for json_file, matrix in zip(json_files, matrices):
+        path = labels_path(json_file, labels_dir)
+        labels.append(
+            load_position_labels(matrix, path) if os.path.exists(path) else None
+        )
+    labeled = sum(menu_labels is not None for menu_labels in labels)
+
+    names = [name for name, _ in args.weight]
+    grid = [
+        dict(zip(names, values))
+        for values in itertools.product(*(values for _, values in args.weight))
+    ]
+    try:
+        start = time.perf_counter()
+        results = sweep(matrices, labels, grid, args.threshold)
+        duration = time.perf_counter() - start
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    lines = sum(len(matrix.texts) for matrix in matrices)
+    logger.info(
+        f"Rescored {len(matrices)} menus with {lines} lines for {len(results)} combinations in "
+        f"{duration * 1000:.1f} ms ({duration / len(results) * 1000:.2f} ms per combination)"
+    )
+
+    if labeled:
+        logger.info(f"Scored against the labels of {labeled} menus")
+        results.sort(key=lambda result: -result["scores"].f1)
+    else:
+        logger.info(
+            f"No labels in {labels_dir}, comparing with the categories found with the filters as they are"
+        )
+
+    for result in results[: args.top]:
+        score = (
+            str(result["scores"])
+            if labeled
+            else f"+{result['added']} -{result['removed']}"
+        )
+        logger.info(
+            f"threshold {result['threshold']:g}  {format_weights(result['weights'])}: "
+            f"{result['categories']} categories, {score}"
+        )
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                [
+                    *names,
+                    "threshold",
+                    "categories",
+                    "added",
+                    "removed",
+                    "precision",
+                    "recall",
+                    "f1",
+                ]
+            )
+            for result in results:
+                scores = result["scores"]
+                writer.writerow(
+                    [
+                        *(result["weights"][name] for name in names),
+                        result["threshold"],
+                        result["categories"],
+                        result["added"],
+                        result["removed"],
+                        *(
+                            (
+                                f"{scores.precision:.4f}",
+                                f"{scores.recall:.4f}",
+                                f"{scores.f1:.4f}",
+                            )
+                            if scores
+                            else ("", "", "")
+                        ),
+                    ]
+                )
+        logger.info(f"Wrote the results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
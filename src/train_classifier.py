@@ -0,0 +1,264 @@
+"""
+Training and evaluation of the classifier used by FilterByClassifier.
+
+The labels are CSV files named after the OCR data, e.g. data/labels/menu-1.csv for data/menu-1.json, with a row
+per line of the menu: page,line,text,category, where category is 1 for the categories and 0 for the other lines.
+
+    # Writes label files pre-filled with the predictions of the hand-tuned filters, to be corrected by hand
+    poetry run python src/train_classifier.py label data
+
+    # Trains the model on the labeled menus and reports its leave-one-menu-out cross-validation scores
+    poetry run python src/train_classifier.py train data
+
+    # Compares the model with the hand-tuned filters on the labeled menus
+    poetry run python src/train_classifier.py eval data
+"""
+import argparse
+import csv
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import attr
+import numpy as np
+
+from batch import find_ocr_files
+from conf import CLASSIFIER_MODEL_PATH, CONF_THRESHOLD
+from file_handler import load_ocr_data
+from filters import LineFilter, default_filters
+from filters.classifier import FilterByClassifier, LogisticModel, line_features
+from filters.gpt_filter import MakeAIDoTheFiltering
+from logger import get_logger
+from models import Menu
+
+logger = get_logger(__name__)
+
+
+@attr.s
+class Scores:
+    true_positives: int = attr.ib(default=0)
+    false_positives: int = attr.ib(default=0)
+    false_negatives: int = attr.ib(default=0)
+
+    def add(self, predicted: np.ndarray, labels: np.ndarray):
+        self.true_positives += int(np.sum(predicted & labels))
+        self.false_positives += int(np.sum(predicted & ~labels))
+        self.false_negatives += int(np.sum(~predicted & labels))
+
+    @property
+    def precision(self) -> float:
+        predicted = self.true_positives + self.false_positives
+        return self.true_positives / predicted if predicted else 0.0
+
+    @property
+    def recall(self) -> float:
+        actual = self.true_positives + self.false_negatives
+        return self.true_positives / actual if actual else 0.0
+
+    @property
+    def f1(self) -> float:
+        total = self.precision + self.recall
+        return 2 * self.precision * self.recall / total if total else 0.0
+
+    def __str__(self) -> str:
+        return f"precision {self.precision:.2f}  recall {self.recall:.2f}  F1 {self.f1:.2f}"
+
+
+def labels_path(json_file: str, labels_dir: str) -> str:
+    name = os.path.splitext(os.path.basename(json_file))[0]
+    return os.path.join(labels_dir, name + ".csv")
+
+
+def heuristic_filter() -> LineFilter:
+    """The hand-tuned filters, without the ones that need the network or a trained model."""
+    return LineFilter(
+        *(
+            filter
+            for filter in default_filters(CONF_THRESHOLD)
+            if not isinstance(filter, (MakeAIDoTheFiltering, FilterByClassifier))
+        )
+    )
+
+
+def load_labels(menu: Menu, path: str) -> Optional[np.ndarray]:
+    """Returns the labels of the lines of the menu, in the order of `menu.lines`, or None if they don't match."""
+    labels: Dict[Tuple[int, int], bool] = {}
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            position = (int(row["page"]), int(row["line"]))
+            line = menu.get_line(*position)
+            if line.text != row["text"]:
+                logger.warning(
+                    f"{path}: line {position} is '{line.text}' in the OCR data, but '{row['text']}' in the labels"
+                )
+                return None
+            labels[position] = row["category"].strip() == "1"
+
+    if len(labels) != len(menu.lines):
+        logger.warning(f"{path}: {len(menu.lines) - len(labels)} lines aren't labeled")
+        return None
+    return np.array([labels[line.position] for line in menu.lines])
+
+
+def load_dataset(
+    directory: str, labels_dir: str
+) -> List[Tuple[str, Menu, np.ndarray, np.ndarray]]:
+    """Returns the path, menu, feature matrix and labels of every labeled menu in the directory."""
+    dataset = []
+    for json_file in find_ocr_files(directory):
+        path = labels_path(json_file, labels_dir)
+        if not os.path.exists(path):
+            continue
+        menu = load_ocr_data(json_file)
+        labels = load_labels(menu, path)
+        if labels is not None:
+            features = line_features(menu.lines, menu.geometry)
+            dataset.append((json_file, menu, features, labels))
+
+    if not dataset:
+        raise SystemExit(f"No labeled menus found, see `{__file__} label --help`")
+    return dataset
+
+
+def label(args: argparse.Namespace):
+    os.makedirs(args.labels_dir, exist_ok=True)
+    line_filter = heuristic_filter()
+    for json_file in find_ocr_files(args.directory):
+        path = labels_path(json_file, args.labels_dir)
+        if os.path.exists(path) and not args.overwrite:
+            logger.info(f"{path} already exists, skipping it")
+            continue
+
+        menu = load_ocr_data(json_file)
+        categories = {
+            line.position
+            for line in line_filter.get_possible_categories(menu, CONF_THRESHOLD)
+        }
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["page", "line", "text", "category"])
+            for line in menu.lines:
+                writer.writerow(
+                    [*line.position, line.text, int(line.position in categories)]
+                )
+        logger.info(
+            f"Wrote {path}, {len(categories)} of {len(menu.lines)} lines are categories"
+        )
+
+
+def train(args: argparse.Namespace):
+    dataset = load_dataset(args.directory, args.labels_dir)
+
+    if len(dataset) > 1:
+        scores = Scores()
+        for i, (_, _, features, labels) in enumerate(dataset):
+            rest = [entry for j, entry in enumerate(dataset) if j != i]
+            model = LogisticModel.fit(
+                np.vstack([entry[2] for entry in rest]),
+                np.concatenate([entry[3] for entry in rest]),
+                l2=args.l2,
+            )
+            scores.add(model.predict(features) > 0.5, labels)
+        logger.info(f"Leave-one-menu-out cross-validation: {scores}")
+
+    model = LogisticModel.fit(
+        np.vstack([entry[2] for entry in dataset]),
+        np.concatenate([entry[3] for entry in dataset]),
+        l2=args.l2,
+    )
+    directory = os.path.dirname(args.model)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    model.save(args.model)
+
+    lines = sum(len(entry[3]) for entry in dataset)
+    logger.info(
+        f"Trained on {len(dataset)} menus with {lines} lines, saved to {args.model}"
+    )
+    for name, weight in sorted(
+        zip(model.features, model.weights), key=lambda item: -abs(item[1])
+    ):
+        logger.info(f"  {name:<22}{weight:>8.3f}")
+
+
+def evaluate(args: argparse.Namespace):
+    model = LogisticModel.load(args.model)
+    dataset = load_dataset(args.directory, args.labels_dir)
+    line_filter = heuristic_filter()
+
+    model_scores = Scores()
+    heuristic_scores = Scores()
+    duration = 0.0
+    lines = 0
+    for json_file, menu, _, labels in dataset:
+        start = time.perf_counter()
+        probabilities = model.predict(line_features(menu.lines, menu.geometry))
+        duration += time.perf_counter() - start
+        lines += len(menu.lines)
+
+        predicted = probabilities > 0.5
+        model_scores.add(predicted, labels)
+        heuristic = {
+            line.position
+            for line in line_filter.get_possible_categories(menu, CONF_THRESHOLD)
+        }
+        heuristic_predicted = np.array(
+            [line.position in heuristic for line in menu.lines]
+        )
+        heuristic_scores.add(heuristic_predicted, labels)
+
+        menu_scores = Scores()
+        menu_scores.add(predicted, labels)
+        logger.info(f"{os.path.basename(json_file):<16} model: {menu_scores}")
+
+    logger.info(f"Classifier:  {model_scores}")
+    logger.info(f"Hand-tuned:  {heuristic_scores}")
+    logger.info(
+        f"Features and scoring took {duration / lines * 1e6:.1f} µs per line ({lines} lines)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(required=True)
+
+    def add_command(name, function, help):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.set_defaults(function=function)
+        subparser.add_argument("directory", help="The directory with the OCR data")
+        subparser.add_argument(
+            "--labels-dir",
+            help="The directory with the label files. Default is <directory>/labels",
+        )
+        return subparser
+
+    labeling = add_command(
+        "label", label, "Writes label files pre-filled by the hand-tuned filters"
+    )
+    labeling.add_argument(
+        "--overwrite", action="store_true", help="Overwrite existing label files"
+    )
+
+    training = add_command("train", train, "Trains the model on the labeled menus")
+    training.add_argument(
+        "--l2", type=float, default=1.0, help="L2 regularization strength. Default is 1"
+    )
+
+    evaluation = add_command(
+        "eval", evaluate, "Compares the model with the hand-tuned filters"
+    )
+
+    for subparser in (training, evaluation):
+        subparser.add_argument(
+            "--model",
+            default=CLASSIFIER_MODEL_PATH,
+            help="Where the model is stored. Default is conf.CLASSIFIER_MODEL_PATH",
+        )
+
+    args = parser.parse_args()
+    args.labels_dir = args.labels_dir or os.path.join(args.directory, "labels")
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
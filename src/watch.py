@@ -0,0 +1,437 @@
+"""
+Watches a directory for OCR files and processes every new one as soon as it is complete.
+
+The directory is rescanned whenever inotify reports a change in it, if inotify_simple is installed (`poetry install
+-E watch`), and every conf.WATCH_POLL_INTERVAL seconds otherwise. A JSON file is processed once it hasn't been
+modified for conf.WATCH_SETTLE_SECONDS and its source file is there too, or conf.WATCH_SOURCE_TIMEOUT passed without
+one showing up. Inputs whose content was already processed are skipped, also after a restart, as the hashes are
+recorded in the output folder.
+"""
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import attr
+
+import conf
+from batch import FileResult, _init_worker, _process_group
+from conf import (
+    GPT_BATCH_MENUS,
+    PROFILER,
+    WATCH_POLL_INTERVAL,
+    WATCH_QUEUE_SIZE,
+    WATCH_SETTLE_SECONDS,
+    WATCH_SOURCE_TIMEOUT,
+)
+from file_handler import SOURCE_INDEX, SourceIndex, hash_file
+from logger import get_logger
+from metrics import METRICS
+from output import Sink
+
+logger = get_logger(__name__)
+
+
+@attr.s
+class WatchedFile:
+    """An OCR file that is ready to be processed."""
+
+    path: str = attr.ib()
+    # The hashes of the content of the OCR data and of the source file, which identify the input
+    key: str = attr.ib()
+    # When the watcher first saw this version of the file, to report how long it took to process it
+    first_seen: float = attr.ib()
+
+
+class ProcessedInputs:
+    """
+    The keys of the processed inputs, appended to a file so that a restarted watcher skips them too.
+
+    Args:
+        path (str): The file the keys are stored in, one per line.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.keys: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.keys = {line.strip() for line in f if line.strip()}
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self.keys
+
+    def add(self, key: str):
+        with self._lock:
+            if key in self.keys:
+                return
+            self.keys.add(key)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(key + "\n")
+
+
+class PollingNotifier:
+    """Waits for the next scan of the directory by sleeping."""
+
+    name = "polling"
+
+    def __init__(self, stop: threading.Event):
+        self.stop = stop
+
+    def wait(self, timeout: float):
+        self.stop.wait(timeout)
+
+    def close(self):
+        pass
+
+
+class InotifyNotifier:
+    """Waits until something in the directory changes, or the timeout passes."""
+
+    name = "inotify"
+
+    def __init__(self, directory: str):
+        from inotify_simple import INotify, flags
+
+        self.inotify = INotify()
+        self.inotify.add_watch(
+            directory,
+            flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE,
+        )
+
+    def wait(self, timeout: float):
+        self.inotify.read(timeout=int(timeout * 1000))
+
+    def close(self):
+        self.inotify.close()
+
+
+def create_notifier(directory: str, stop: threading.Event):
+    """Returns an InotifyNotifier if inotify_simple is installed and works on this system, a PollingNotifier otherwise."""
+    try:
+        return InotifyNotifier(directory)
+    except ImportError:
+        logger.info("inotify_simple isn't installed, polling the directory instead")
+    except OSError as e:
+        logger.warning(f"inotify isn't available ({e}), polling the directory instead")
+    return PollingNotifier(stop)
+
+
+def _init_watch_worker(api_key: Optional[str], rate_limit_share: float):
+    # The watcher shuts the workers down when it is interrupted, they don't have to handle Ctrl+C themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # A forked worker doesn't get the updates of the watcher, so it checks the directory for changes itself
+    SOURCE_INDEX.clear()
+    _init_worker(api_key, rate_limit_share)
+
+
+class FolderWatcher:
+    """
+    Processes the OCR files dropped into a directory as they arrive.
+
+    The files that are ready are put into a bounded queue, which the workers take them from. When the workers can't
+    keep up and the queue is full, the directory isn't scanned until there is room again, the files wait on disk.
+    When the GPT filter is used, a worker takes up to conf.GPT_BATCH_MENUS files that are waiting at once, so their
+    lines are packed into the same requests, but it never waits for more files to arrive.
+
+    Args:
+        directory (str): The directory to watch.
+        sinks (Sequence[Sink], optional): Where the results of every file are written to. Default is nowhere.
+        state_path (str, optional): Where the keys of the processed inputs are stored. Default is none, so they are
+        only skipped until the watcher is restarted.
+        workers (int, optional): The number of worker processes, 1 processes the files in the current process.
+        Default is 1.
+        wait_for_source (bool, optional): Whether to wait for the source file of the OCR data, needed for the PDF
+        output. Default is True.
+        queue_size (int, optional): How many files can wait for a worker. Default is conf.WATCH_QUEUE_SIZE.
+        poll_interval (float, optional): Default is conf.WATCH_POLL_INTERVAL.
+        settle_seconds (float, optional): Default is conf.WATCH_SETTLE_SECONDS.
+        source_timeout (float, optional): Default is conf.WATCH_SOURCE_TIMEOUT.
+        profiler (str, optional): The profiler run around every file, see `metrics.profile`. Default is conf.PROFILER.
+        sources (SourceIndex, optional): The index the source files are looked up in, it is updated with the
+        changes of the directory found by every scan. Default is the one used by `get_source_file`.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sinks: Sequence[Sink] = (),
+        state_path: Optional[str] = None,
+        workers: int = 1,
+        wait_for_source: bool = True,
+        queue_size: int = WATCH_QUEUE_SIZE,
+        poll_interval: float = WATCH_POLL_INTERVAL,
+        settle_seconds: float = WATCH_SETTLE_SECONDS,
+        source_timeout: float = WATCH_SOURCE_TIMEOUT,
+        profiler: Optional[str] = PROFILER,
+        sources: SourceIndex = SOURCE_INDEX,
+    ):
+        self.directory = directory
+        self.sources = sources
+        self.sinks = sinks
+        self.workers = max(1, workers)
+        self.wait_for_source = wait_for_source
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.source_timeout = source_timeout
+        self.profiler = profiler
+        self.processed = ProcessedInputs(state_path) if state_path else None
+        self.queue: "queue.Queue[Optional[WatchedFile]]" = queue.Queue(
+            max(1, queue_size)
+        )
+        self.executor = None
+
+        # The size and modification time of the files that were queued or skipped, so they aren't hashed again
+        self.handled: Dict[str, Tuple[int, int]] = {}
+        # The names of all the files in the directory at the last scan
+        self.names: Set[str] = set()
+        # When the files that aren't ready yet were first seen
+        self.first_seen: Dict[str, float] = {}
+        # The keys of the files that are queued or being processed
+        self._in_flight: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, key: str) -> bool:
+        with self._lock:
+            if key in self._in_flight:
+                return True
+        return self.processed is not None and key in self.processed
+
+    def scan(self) -> List[WatchedFile]:
+        """Returns the OCR files that are complete and weren't queued yet, in the order of their names."""
+        now = time.time()
+        ready = []
+        try:
+            entries = sorted(os.scandir(self.directory), key=lambda entry: entry.name)
+        except OSError as e:
+            logger.error(f"Can't list {self.directory}: {e}")
+            return ready
+
+        # The source index is updated with the changes instead of listing the directory again
+        names = {entry.name for entry in entries}
+        for name in names - self.names:
+            self.sources.add(os.path.join(self.directory, name))
+        for name in self.names - names:
+            self.sources.remove(os.path.join(self.directory, name))
+        self.names = names
+
+        present = set()
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            path = entry.path
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Removed since it was listed
+                continue
+            present.add(path)
+            version = (stat.st_size, stat.st_mtime_ns)
+            if self.handled.get(path) == version:
+                continue
+
+            first_seen = self.first_seen.setdefault(path, now)
+            if now - stat.st_mtime < self.settle_seconds:
+                continue
+
+            source = self.sources.get(path)
+            if source is None:
+                if self.wait_for_source and now - first_seen < self.source_timeout:
+                    continue
+                if self.wait_for_source:
+                    logger.warning(
+                        f"No source file for {path} after {self.source_timeout:g}s, processing it without one"
+                    )
+            else:
+                try:
+                    if now - os.path.getmtime(source) < self.settle_seconds:
+                        continue
+                except OSError:
+                    continue
+
+            try:
+                key = hash_file(path) + (":" + hash_file(source) if source else "")
+            except OSError as e:
+                logger.warning(f"Can't read {path}: {e}")
+                continue
+            self.handled[path] = version
+            del self.first_seen[path]
+
+            if self.is_duplicate(key):
+                logger.info(f"Skipping {path}, the same input was already processed")
+                METRICS.inc("watch_files_total", outcome="duplicate")
+                continue
+            with self._lock:
+                self._in_flight.add(key)
+            ready.append(WatchedFile(path, key, first_seen))
+
+        # Forget the files that were removed, a file added again under the same name is a new one
+        self.handled = {path: v for path, v in self.handled.items() if path in present}
+        self.first_seen = {
+            path: t for path, t in self.first_seen.items() if path in present
+        }
+        return ready
+
+    def enqueue(self, file: WatchedFile, stop: threading.Event) -> bool:
+        """Puts the file into the queue, waiting for a free slot while it is full. Returns False if stopped first."""
+        waiting = False
+        while not stop.is_set():
+            try:
+                self.queue.put(file, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                if not waiting:
+                    logger.info(
+                        f"{self.queue.maxsize} files are waiting for a worker, waiting for a free slot"
+                    )
+                    waiting = True
+        with self._lock:
+            self._in_flight.discard(file.key)
+        return False
+
+    def process(self, files: List[WatchedFile]):
+        """Processes the files together, and records the ones that succeeded as processed."""
+        paths = [file.path for file in files]
+        try:
+            if self.executor is not None:
+                results = self.executor.submit(
+                    _process_group, paths, self.sinks, self.profiler, True
+                ).result()
+                for result in results:
+                    if result.metrics:
+                        METRICS.merge(result.metrics)
+            else:
+                results = _process_group(paths, self.sinks, self.profiler)
+        except Exception as e:
+            # e.g. a worker process that died
+            error = f"{e.__class__.__name__}: {e}"
+            results = [FileResult(path=path, ok=False, error=error) for path in paths]
+
+        for file, result in zip(files, results):
+            latency = time.time() - file.first_seen
+            METRICS.observe("watch_latency_seconds", latency)
+            if result.ok:
+                if self.processed is not None:
+                    self.processed.add(file.key)
+                METRICS.inc("watch_files_total", outcome="processed")
+                logger.info(
+                    f"Done {result.path}: {result.categories} possible categories in {result.duration:.2f}s, "
+                    f"{latency:.1f}s after it appeared"
+                )
+            else:
+                # Not retried until the file changes, or the watcher is restarted
+                METRICS.inc("watch_files_total", outcome="failed")
+                logger.error(f"Failed {result.path}: {result.error}")
+            with self._lock:
+                self._in_flight.discard(file.key)
+
+    def consume(self):
+        """Processes the files from the queue until it gets None."""
+        # Without GPT nothing is gained by processing the files together
+        group_size = max(1, GPT_BATCH_MENUS) if conf.OPEN_AI_API_KEY else 1
+        while True:
+            file = self.queue.get()
+            if file is None:
+                return
+            group = [file]
+            done = False
+            while len(group) < group_size:
+                try:
+                    file = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if file is None:
+                    done = True
+                    break
+                group.append(file)
+            self.process(group)
+            if done:
+                return
+
+    def run(self, stop: Optional[threading.Event] = None):
+        """Watches the directory until `stop` is set or the process is interrupted."""
+        stop = stop or threading.Event()
+        if self.workers > 1:
+            # multiprocessing is only imported when it's used
+            from concurrent.futures import ProcessPoolExecutor
+
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_watch_worker,
+                initargs=(conf.OPEN_AI_API_KEY, 1 / self.workers),
+            )
+        consumers = [
+            threading.Thread(target=self.consume, name=f"watch-worker-{i}")
+            for i in range(self.workers)
+        ]
+        for consumer in consumers:
+            consumer.start()
+
+        notifier = create_notifier(self.directory, stop)
+        logger.info(
+            f"Watching {self.directory} for OCR files ({notifier.name}) with {self.workers} worker(s), "
+            f"press Ctrl+C to stop"
+        )
+        try:
+            while not stop.is_set():
+                for file in self.scan():
+                    if not self.enqueue(file, stop):
+                        break
+                # Files that are still being written are checked again as soon as they could have settled
+                notifier.wait(
+                    min(self.settle_seconds, self.poll_interval)
+                    if self.first_seen
+                    else self.poll_interval
+                )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info(
+                "Stopping, the files being processed are finished, the queued ones are left for the next run"
+            )
+            stop.set()
+            notifier.close()
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in consumers:
+                self.queue.put(None)
+            for consumer in consumers:
+                consumer.join()
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+def watch_directory(
+    directory: str,
+    sinks: Sequence[Sink],
+    output_dir: str,
+    workers: int = 1,
+    wait_for_source: bool = True,
+    profiler: Optional[str] = PROFILER,
+):
+    """
+    Watches the directory until interrupted or terminated, see FolderWatcher. The processed inputs are recorded in
+    the output folder.
+    """
+    stop = threading.Event()
+    # Stops as gracefully on SIGTERM, e.g. from a service manager, as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    FolderWatcher(
+        directory,
+        sinks,
+        state_path=os.path.join(output_dir, ".watch_processed"),
+        workers=workers,
+        wait_for_source=wait_for_source,
+        profiler=profiler,
+    ).run(stop)
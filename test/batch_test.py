@@ -0,0 +1,104 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import conf
+from batch import find_ocr_files, run_batch
+from output import CsvSink
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+DATA_DIR = os.path.join(ROOT, "data")
+MENUS = ["menu-1", "menu-2", "menu-3"]
+
+
+@pytest.fixture
+def menus_dir(tmp_path):
+    directory = tmp_path / "menus"
+    directory.mkdir()
+    for name in MENUS:
+        shutil.copy(os.path.join(DATA_DIR, f"{name}.json"), directory)
+    # Cut off in the middle of the first page
+    with open(os.path.join(DATA_DIR, "menu-4.json")) as f:
+        (directory / "broken.json").write_text(f.read()[:5000])
+    return directory
+
+
+@pytest.fixture(autouse=True)
+def without_gpt(monkeypatch):
+    monkeypatch.setattr(conf, "OPEN_AI_API_KEY", None)
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_a_broken_file_only_fails_itself(menus_dir, tmp_path, ordered):
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    paths = find_ocr_files(str(menus_dir))
+
+    summary = run_batch(
+        paths, workers=2, ordered=ordered, sinks=[CsvSink(str(output_dir))]
+    )
+
+    results = {os.path.basename(result.path): result for result in summary.results}
+    assert sorted(results) == sorted(os.path.basename(path) for path in paths)
+    if ordered:
+        assert [result.path for result in summary.results] == paths
+
+    assert [result.path for result in summary.failed] == [
+        str(menus_dir / "broken.json")
+    ]
+    assert results["broken.json"].error
+    for name in MENUS:
+        assert results[f"{name}.json"].ok
+        assert results[f"{name}.json"].categories > 0
+        assert (output_dir / f"{name}.csv").exists()
+    assert not (output_dir / "broken.csv").exists()
+    assert summary.workers == 2
+
+
+def test_workers_give_the_same_results_as_one_process(menus_dir, tmp_path):
+    outputs = {}
+    for workers in [1, 2]:
+        output_dir = tmp_path / f"output-{workers}"
+        output_dir.mkdir()
+        run_batch(
+            find_ocr_files(str(menus_dir)),
+            workers=workers,
+            sinks=[CsvSink(str(output_dir))],
+        )
+        outputs[workers] = {
+            name: (output_dir / name).read_text()
+            for name in sorted(os.listdir(output_dir))
+        }
+
+    assert outputs[1] == outputs[2]
+    assert len(outputs[1]) == len(MENUS)
+
+
+def test_cli_exits_with_1_when_a_file_failed(menus_dir, tmp_path):
+    env = {key: value for key, value in os.environ.items() if key != "OPEN_AI_API_KEY"}
+    output_dir = tmp_path / "output"
+
+    process = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ROOT, "src", "main.py"),
+            str(menus_dir),
+            "-j",
+            "2",
+            "-o",
+            "csv",
+            "--output-dir",
+            str(output_dir),
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+
+    assert process.returncode == 1
+    assert "broken.json" in process.stdout + process.stderr
+    assert sorted(os.listdir(output_dir)) == [f"{name}.csv" for name in MENUS]
@@ -0,0 +1,218 @@
+import os
+import shutil
+from collections import Counter
+
+import fitz
+import pytest
+
+from file_handler import (
+    InvalidSourceError,
+    PdfStats,
+    SourceIndex,
+    load_source_bytes,
+    save_pdf,
+)
+from filters import gpt_filter
+from main import process_ocr
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def touch(path: str):
+    with open(path, "wb"):
+        pass
+
+
+def bump_mtime(directory: str):
+    """Moves the modification time of the directory forward, the clock may be too coarse to notice a change."""
+    stat = os.stat(directory)
+    os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_source_file_next_to_the_ocr_file(tmp_path):
+    touch(tmp_path / "menu.json")
+    touch(tmp_path / "menu.jpg")
+    touch(tmp_path / "other.png")
+    touch(tmp_path / "notes.txt")
+
+    index = SourceIndex(["PDF", "JPG", "PNG"])
+
+    assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.jpg")
+    assert index.get(str(tmp_path / "other.json")) == str(tmp_path / "other.png")
+    assert index.get(str(tmp_path / "notes.json")) is None
+    assert index.get(str(tmp_path / "missing" / "menu.json")) is None
+
+
+def test_pdf_is_preferred_over_an_image(tmp_path):
+    for name in ["menu.json", "menu.jpg", "menu.PDF", "menu.png"]:
+        touch(tmp_path / name)
+
+    assert SourceIndex(["PDF", "JPG", "PNG"]).get(str(tmp_path / "menu.json")) == str(
+        tmp_path / "menu.PDF"
+    )
+    assert SourceIndex(["PNG", "PDF"]).get(str(tmp_path / "menu.json")) == str(
+        tmp_path / "menu.png"
+    )
+
+
+def test_files_added_after_the_first_lookup_are_found(tmp_path):
+    index = SourceIndex(["PDF", "JPG"])
+    touch(tmp_path / "menu.jpg")
+    assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.jpg")
+    assert index.get(str(tmp_path / "new.json")) is None
+
+    touch(tmp_path / "new.jpg")
+    touch(tmp_path / "menu.pdf")
+    bump_mtime(str(tmp_path))
+
+    # The directory changed, so it is listed again
+    assert index.get(str(tmp_path / "new.json")) == str(tmp_path / "new.jpg")
+    assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.pdf")
+
+    os.remove(tmp_path / "menu.pdf")
+    bump_mtime(str(tmp_path))
+    assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.jpg")
+
+
+def test_unchanged_directories_are_listed_once(tmp_path, monkeypatch):
+    touch(tmp_path / "menu.pdf")
+    index = SourceIndex(["PDF"])
+    listings = []
+    index_directory = index.index_directory
+    monkeypatch.setattr(
+        index,
+        "index_directory",
+        lambda directory: listings.append(directory) or index_directory(directory),
+    )
+
+    for _ in range(3):
+        assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.pdf")
+        assert index.get(str(tmp_path / "other.json")) is None
+
+    assert len(listings) == 1
+
+
+def test_added_and_removed_files_are_reported_by_a_watcher(tmp_path):
+    index = SourceIndex(["PDF", "JPG"])
+    assert index.get(str(tmp_path / "menu.json")) is None
+
+    # Without checking the directory again
+    index.add(str(tmp_path / "menu.jpg"))
+    assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.jpg")
+    index.add(str(tmp_path / "menu.pdf"))
+    index.add(str(tmp_path / "menu.txt"))
+    assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.pdf")
+
+    index.remove(str(tmp_path / "menu.pdf"))
+    assert index.get(str(tmp_path / "menu.json")) == str(tmp_path / "menu.jpg")
+    index.remove(str(tmp_path / "menu.jpg"))
+    assert index.get(str(tmp_path / "menu.json")) is None
+
+
+def test_load_source_bytes():
+    with open(os.path.join(DATA_DIR, "menu-2.pdf"), "rb") as f:
+        pdf = load_source_bytes(f.read(), "menu.pdf")
+    with open(os.path.join(DATA_DIR, "menu-3.jpg"), "rb") as f:
+        image = load_source_bytes(f.read(), "menu.JPG")
+
+    assert pdf.page_count > 0
+    assert image.page_count == 1
+
+
+@pytest.mark.parametrize("filename", ["menu.pdf", "menu.jpg", "menu"])
+@pytest.mark.parametrize("data", [b"", b"not a source file"])
+def test_invalid_source_bytes(filename, data):
+    with pytest.raises(InvalidSourceError, match=filename):
+        load_source_bytes(data, filename)
+
+
+@pytest.fixture
+def menu_4(tmp_path, monkeypatch):
+    """A copy of menu-4 and its 24 page PDF, with its category lines."""
+    monkeypatch.setattr(gpt_filter, "OPEN_AI_API_KEY", None)
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for name in ["menu-4.json", "menu-4.pdf"]:
+        shutil.copy(os.path.join(DATA_DIR, name), source_dir)
+    json_file = str(source_dir / "menu-4.json")
+    return json_file, process_ocr(json_file).categories
+
+
+def highlights(pdf: fitz.Document) -> Counter:
+    """The number of highlighted lines on every page with any."""
+    return Counter(
+        {
+            page.number: len(list(page.annots(types=[fitz.PDF_ANNOT_POLYGON])))
+            for page in pdf
+            if page.first_annot
+        }
+    )
+
+
+@pytest.mark.parametrize("mode", ["full", "compact", "incremental", "pages"])
+def test_save_pdf(menu_4, tmp_path, mode):
+    json_file, lines = menu_4
+    source_file = json_file[: -len(".json")] + ".pdf"
+    lines_by_page = Counter(line.page_index for line in lines)
+    pages = sorted(lines_by_page)
+
+    stats = save_pdf(lines, "menu-4", json_file, str(tmp_path), mode)
+
+    written = (tmp_path / "menu-4.pdf").read_bytes()
+    pdf = fitz.Document(stream=written, filetype="pdf")
+    assert stats.pages_touched == len(pages) < stats.pages_total == 24
+    assert stats.bytes_written + stats.bytes_copied == len(written)
+    if mode == "pages":
+        # Only the highlighted pages, in their order
+        assert pdf.page_count == len(pages)
+        assert highlights(pdf) == Counter(
+            {number: lines_by_page[page] for number, page in enumerate(pages)}
+        )
+    else:
+        assert pdf.page_count == 24
+        assert highlights(pdf) == lines_by_page
+
+    with open(source_file, "rb") as f:
+        source = f.read()
+    if mode == "incremental":
+        # The highlights are appended to a copy of the source
+        assert written.startswith(source)
+        assert stats.bytes_copied == len(source)
+        assert stats.bytes_written < len(source)
+    else:
+        assert stats.bytes_copied == 0
+    if mode in ("compact", "pages"):
+        # Compacted, smaller than the document rewritten as it is
+        full = save_pdf(lines, "full", json_file, str(tmp_path), "full")
+        assert stats.bytes_written < full.bytes_written
+
+
+@pytest.mark.parametrize("mode", ["full", "incremental", "pages"])
+def test_save_pdf_of_an_image(tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(gpt_filter, "OPEN_AI_API_KEY", None)
+    for name in ["menu-3.json", "menu-3.jpg"]:
+        shutil.copy(os.path.join(DATA_DIR, name), tmp_path)
+    json_file = str(tmp_path / "menu-3.json")
+    lines = process_ocr(json_file).categories
+
+    stats = save_pdf(lines, "out", json_file, str(tmp_path), mode)
+
+    pdf = fitz.Document(str(tmp_path / "out.pdf"))
+    assert stats == PdfStats(1, 1, os.path.getsize(tmp_path / "out.pdf"))
+    assert highlights(pdf) == Counter({0: len(lines)})
+
+
+def test_save_pdf_without_lines_or_source(menu_4, tmp_path):
+    json_file, lines = menu_4
+
+    assert save_pdf([], "menu-4", json_file, str(tmp_path), "full") is None
+    assert save_pdf(lines, "menu-4", str(tmp_path / "x.json"), str(tmp_path)) is None
+    assert not (tmp_path / "menu-4.pdf").exists()
+
+
+def test_pdf_stats_str():
+    assert str(PdfStats(2, 24, 1000)) == "2/24 pages touched, 1000 bytes written"
+    assert (
+        str(PdfStats(2, 24, 1000, 5000))
+        == "2/24 pages touched, 1000 bytes written, 5000 bytes copied"
+    )
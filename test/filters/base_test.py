@@ -0,0 +1,182 @@
+import glob
+import os
+from typing import List
+
+import numpy as np
+import pytest
+
+from file_handler import load_ocr_data
+from filters import LineFilter, default_filters
+from filters.base import Filter, LineWiseFilter
+from filters.gpt_filter import MakeAIDoTheFiltering
+from models import BoundingBox, Line, Menu, MenuPage
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+CONF_THRESHOLD = 0.75
+
+
+class Multiply(LineWiseFilter):
+    """Multiplies the confidence of the lines whose text contains `word` and remembers the lines it was given."""
+
+    def __init__(self, confidence_multiplier: float, word: str, cost: float = 1):
+        super().__init__(confidence_multiplier)
+        self.word = word
+        self.cost = cost
+        self.seen: List[str] = []
+
+    def line_multiplier(self, line: Line) -> float:
+        self.seen.append(line.text)
+        if self.word in line.text:
+            return self.confidence_multiplier
+        return 1
+
+
+class MultiplyAll(Filter):
+    """A filter over all the lines at once, like the statistics filters."""
+
+    def __init__(self, confidence_multiplier: float, word: str, needs_all_lines: bool):
+        super().__init__(confidence_multiplier)
+        self.word = word
+        self.needs_all_lines = needs_all_lines
+        self.seen: List[str] = []
+
+    def apply(self, lines: List[Line]):
+        for line in lines:
+            self.seen.append(line.text)
+            if self.word in line.text:
+                line.analysis.category_confidence *= self.confidence_multiplier
+
+
+def make_menu(*texts: str) -> Menu:
+    lines = [Line(text=text, bounding_box=BoundingBox(np.zeros(8))) for text in texts]
+    return Menu(
+        status="succeeded",
+        pages=[
+            MenuPage(
+                page_num=1,
+                clockwise_orientation=0,
+                width=100,
+                height=100,
+                unit="pixel",
+                lines=lines,
+            )
+        ],
+    )
+
+
+def offline_filters() -> List[Filter]:
+    """The default filters without the ones that need GPT."""
+    return [
+        filter
+        for filter in default_filters(CONF_THRESHOLD)
+        if not isinstance(filter, MakeAIDoTheFiltering)
+    ]
+
+
+def test_consecutive_line_wise_filters_are_fused():
+    a, b, c = Multiply(0.5, "a"), Multiply(0.5, "b"), Multiply(0.5, "c")
+    all_lines = MultiplyAll(0.5, "d", needs_all_lines=True)
+
+    line_filter = LineFilter(a, b, all_lines, c, fuse=True, order_by_cost=False)
+
+    assert line_filter.stages == [(a, b), all_lines, (c,)]
+    assert line_filter.stage_names == [
+        "Multiply+Multiply",
+        "MultiplyAll",
+        "Multiply",
+    ]
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"fuse": False}, {"fuse": True, "record": True}],
+    ids=["default", "unfused", "recording"],
+)
+def test_every_filter_is_a_stage_without_fusing(options):
+    a, b = Multiply(0.5, "a"), Multiply(0.5, "b")
+
+    assert LineFilter(a, b, order_by_cost=False, **options).stages == [a, b]
+
+
+def test_filters_are_ordered_by_cost():
+    expensive = Multiply(0.5, "a", cost=3)
+    cheap = Multiply(0.5, "b", cost=1)
+    also_cheap = Multiply(0.5, "c", cost=1)
+    all_lines = MultiplyAll(0.5, "d", needs_all_lines=True)
+    all_lines.cost = 2
+
+    ordered = LineFilter(expensive, all_lines, cheap, also_cheap, fuse=True)
+    as_given = LineFilter(
+        expensive, all_lines, cheap, also_cheap, fuse=True, order_by_cost=False
+    )
+
+    # Filters of the same cost keep their order
+    assert ordered.stages == [(cheap, also_cheap), all_lines, (expensive,)]
+    assert as_given.stages == [(expensive,), all_lines, (cheap, also_cheap)]
+
+
+def test_pruned_lines_are_only_passed_to_filters_that_need_all_lines():
+    first = Multiply(0.1, "drop")
+    after = MultiplyAll(0.5, "x", needs_all_lines=False)
+    statistics = MultiplyAll(0.5, "x", needs_all_lines=True)
+    menu = make_menu("keep", "drop me", "keep x")
+
+    remaining = LineFilter(
+        first, after, statistics, order_by_cost=False
+    ).get_possible_categories(menu, CONF_THRESHOLD)
+
+    assert first.seen == ["keep", "drop me", "keep x"]
+    assert after.seen == ["keep", "keep x"]
+    assert statistics.seen == ["keep", "drop me", "keep x"]
+    assert [line.text for line in remaining] == ["keep"]
+
+
+def test_fused_filters_skip_lines_pruned_by_earlier_stages():
+    first = MultiplyAll(0.1, "drop", needs_all_lines=False)
+    a, b = Multiply(0.9, "a"), Multiply(0.9, "b")
+    menu = make_menu("a b", "drop a")
+
+    LineFilter(first, a, b, fuse=True, order_by_cost=False).get_possible_categories(
+        menu, CONF_THRESHOLD
+    )
+
+    # Neither of the fused filters sees the pruned line
+    assert a.seen == b.seen == ["a b"]
+
+
+def test_nothing_is_pruned_without_pruning():
+    first = Multiply(0.1, "drop")
+    after = MultiplyAll(0.5, "x", needs_all_lines=False)
+    menu = make_menu("keep", "drop me")
+
+    LineFilter(first, after, prune=False).get_possible_categories(menu, CONF_THRESHOLD)
+
+    assert after.seen == ["keep", "drop me"]
+
+
+def test_confidences_above_one_are_clamped():
+    menu = make_menu("a", "b")
+
+    LineFilter(Multiply(2, "a"), Multiply(1, "b"), fuse=True).get_possible_categories(
+        menu, CONF_THRESHOLD
+    )
+
+    assert [line.analysis.category_confidence for line in menu.lines] == [1, 1]
+
+
+@pytest.mark.parametrize(
+    "path", sorted(glob.glob(os.path.join(DATA_DIR, "menu-*.json")))
+)
+def test_fusing_and_pruning_keep_the_result(path):
+    def run(**options):
+        menu = load_ocr_data(path)
+        lines = LineFilter(*offline_filters(), **options).get_possible_categories(
+            menu, CONF_THRESHOLD
+        )
+        return [(line.index, line.analysis.category_confidence) for line in lines]
+
+    expected = run(prune=False)
+
+    assert run() == expected
+    assert run(fuse=True) == expected
+    assert run(fuse=True, prune=False) == expected
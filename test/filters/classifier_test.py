@@ -0,0 +1,134 @@
+import os
+
+import numpy as np
+import pytest
+
+import filters
+from file_handler import load_ocr_data
+from filters import default_filters
+from filters.classifier import (
+    FEATURES,
+    FilterByClassifier,
+    LogisticModel,
+    line_features,
+)
+from filters.text_features import text_matcher
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+
+
+def separable(rng: np.random.Generator, size: int):
+    features = rng.normal(size=(size, len(FEATURES)))
+    labels = features[:, 2] - 0.5 * features[:, 7] > 1
+    return features, labels
+
+
+def test_fit_separable_data():
+    rng = np.random.default_rng(0)
+    features, labels = separable(rng, 500)
+    test_features, test_labels = separable(rng, 500)
+
+    model = LogisticModel.fit(features, labels, l2=0.01)
+
+    assert model.features == FEATURES
+    assert np.mean((model.predict(test_features) > 0.5) == test_labels) > 0.97
+    # The two features the labels depend on weigh the most
+    assert set(np.argsort(-np.abs(model.weights))[:2]) == {2, 7}
+
+
+def test_fit_constant_features():
+    features = np.ones((10, len(FEATURES)))
+    labels = np.arange(10) < 3
+
+    probabilities = LogisticModel.fit(features, labels).predict(features)
+
+    assert np.all(np.isfinite(probabilities))
+
+
+def test_save_and_load(tmp_path):
+    rng = np.random.default_rng(1)
+    features, labels = separable(rng, 100)
+    model = LogisticModel.fit(features, labels)
+    path = str(tmp_path / "model.json")
+
+    model.save(path)
+    loaded = LogisticModel.load(path)
+
+    assert loaded.features == model.features
+    assert loaded.bias == model.bias
+    np.testing.assert_array_equal(loaded.weights, model.weights)
+    np.testing.assert_array_equal(loaded.predict(features), model.predict(features))
+
+
+def test_load_a_model_of_other_features(tmp_path):
+    path = tmp_path / "model.json"
+    LogisticModel(FEATURES[:-1], [0] * 11, [1] * 11, [0] * 11, 0).save(str(path))
+
+    with pytest.raises(ValueError, match="retrain"):
+        LogisticModel.load(str(path))
+
+
+def test_line_features():
+    menu = load_ocr_data(os.path.join(DATA_DIR, "menu-2.json"))
+
+    features = line_features(menu.lines, menu.geometry)
+
+    assert features.shape == (len(menu.lines), len(FEATURES))
+    assert np.all(np.isfinite(features))
+    assert np.all((0 <= features[:, 0]) & (features[:, 0] <= 1))
+    matcher = text_matcher()
+    assert features[:, FEATURES.index("contains_digit")].tolist() == [
+        float(matcher.features(line).digits) for line in menu.lines
+    ]
+
+
+def test_line_features_of_no_lines():
+    menu = load_ocr_data(os.path.join(DATA_DIR, "menu-2.json"))
+
+    assert line_features([], menu.geometry).shape == (0, len(FEATURES))
+
+
+def test_filter_by_classifier():
+    menu = load_ocr_data(os.path.join(DATA_DIR, "menu-2.json"))
+    features = line_features(menu.lines, menu.geometry)
+    # Only the lines with a digit are unlikely to be categories
+    weights = np.zeros(len(FEATURES))
+    weights[FEATURES.index("contains_digit")] = -10
+    model = LogisticModel(
+        FEATURES, np.zeros(len(FEATURES)), np.ones(len(FEATURES)), weights, 5
+    )
+    classifier = FilterByClassifier(0.5, model)
+
+    classifier.prepare(menu)
+    classifier.apply(menu.lines)
+
+    confidences = np.array([line.analysis.category_confidence for line in menu.lines])
+    expected = 1 - (1 - model.predict(features)) * 0.5
+    np.testing.assert_allclose(confidences, expected)
+    assert np.all(confidences[features[:, 2] == 1] < 0.51)
+
+
+@pytest.fixture
+def model_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "model.json")
+    monkeypatch.setattr(filters, "CLASSIFIER_MODEL_PATH", path)
+    return path
+
+
+def test_default_filters_without_a_model(model_path):
+    assert not any(
+        isinstance(filter, FilterByClassifier) for filter in default_filters()
+    )
+    assert FilterByClassifier.from_file(0.5, model_path) is None
+
+
+def test_default_filters_with_a_model(model_path):
+    rng = np.random.default_rng(2)
+    LogisticModel.fit(*separable(rng, 100)).save(model_path)
+
+    classifiers = [
+        filter for filter in default_filters() if isinstance(filter, FilterByClassifier)
+    ]
+
+    assert len(classifiers) == 1
+    assert classifiers[0].confidence_multiplier == filters.CLASSIFIER_WEIGHT
@@ -0,0 +1,155 @@
+import glob
+import os
+from typing import List
+
+import numpy as np
+import pytest
+
+from file_handler import load_ocr_data
+from filters import (
+    FactorCache,
+    FactorMatrix,
+    LineFilter,
+    default_filters,
+    factors,
+    record_factors,
+)
+from filters.base import Filter
+from filters.gpt_filter import MakeAIDoTheFiltering
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+MENUS = sorted(glob.glob(os.path.join(DATA_DIR, "menu-*.json")))
+CONF_THRESHOLD = 0.75
+
+
+def offline_filters() -> List[Filter]:
+    """The default filters without the ones that need GPT."""
+    return [
+        filter
+        for filter in default_filters(CONF_THRESHOLD)
+        if not isinstance(filter, MakeAIDoTheFiltering)
+    ]
+
+
+def live_confidences(path: str, filters: List[Filter]) -> np.ndarray:
+    menu = load_ocr_data(path)
+    LineFilter(*filters, prune=False).get_possible_categories(menu, CONF_THRESHOLD)
+    return np.array([line.analysis.category_confidence for line in menu.lines])
+
+
+def make_matrix() -> FactorMatrix:
+    return FactorMatrix(
+        ["FilterA", "FilterB"],
+        np.array([[1.0, 0.5], [0.25, 1.0], [2.0, 0.9]]),
+        np.array([[0, 0], [0, 1], [1, 0]]),
+        ["Polévky", "5,99 Kč", ""],
+    )
+
+
+def test_confidences_with_weights():
+    matrix = make_matrix()
+
+    confidences = matrix.confidences([{}, {"FilterA": 0}, {"FilterB": 2}])
+
+    # Confidences above 1 are clamped
+    assert confidences == pytest.approx(
+        np.array([[0.5, 0.5, 0.25], [0.25, 1, 0.25], [1, 0.9, 1]])
+    )
+    assert matrix.categories().tolist() == [2]
+    assert matrix.categories({"FilterB": 0}).tolist() == [0, 2]
+    with pytest.raises(ValueError, match="Unknown filters FilterC"):
+        matrix.confidences([{"FilterC": 1}])
+
+
+def test_save_and_load(tmp_path):
+    matrix = make_matrix()
+    path = str(tmp_path / "matrix.npz")
+
+    matrix.save(path)
+    loaded = FactorMatrix.load(path)
+
+    assert loaded.filters == matrix.filters
+    assert loaded.texts == matrix.texts
+    np.testing.assert_array_equal(loaded.factors, matrix.factors)
+    np.testing.assert_array_equal(loaded.positions, matrix.positions)
+    assert loaded.positions.dtype == matrix.positions.dtype
+
+
+@pytest.mark.parametrize("path", MENUS, ids=os.path.basename)
+def test_recorded_factors_reproduce_the_filters(path):
+    (matrix,) = record_factors([path], offline_filters(), CONF_THRESHOLD)
+    menu = load_ocr_data(path)
+    categories = LineFilter(*offline_filters()).get_possible_categories(
+        menu, CONF_THRESHOLD
+    )
+
+    assert matrix.factors.shape == (len(menu.lines), len(offline_filters()))
+    assert matrix.texts == [line.text for line in menu.lines]
+    np.testing.assert_allclose(
+        matrix.confidences()[:, 0], live_confidences(path, offline_filters())
+    )
+    rows = {tuple(position): row for row, position in enumerate(matrix.positions)}
+    assert matrix.categories(conf_threshold=CONF_THRESHOLD).tolist() == [
+        rows[line.position] for line in categories
+    ]
+
+
+@pytest.mark.parametrize("path", MENUS[:3], ids=os.path.basename)
+def test_a_weight_of_0_disables_a_filter(path):
+    (matrix,) = record_factors([path], offline_filters(), CONF_THRESHOLD)
+
+    for name in matrix.filters:
+        without = [
+            filter for filter in offline_filters() if filter.__class__.__name__ != name
+        ]
+        np.testing.assert_allclose(
+            matrix.confidences([{name: 0}])[:, 0],
+            live_confidences(path, without),
+            err_msg=name,
+        )
+
+
+def test_cached_factors_are_used(tmp_path, monkeypatch):
+    cache = FactorCache(str(tmp_path / "factors"))
+    paths = MENUS[:2]
+    recorded = record_factors(paths, offline_filters(), CONF_THRESHOLD, cache)
+    assert len(os.listdir(cache.directory)) == 2
+
+    def load_ocr_data(path):
+        raise AssertionError(f"{path} was parsed again")
+
+    monkeypatch.setattr(factors, "load_ocr_data", load_ocr_data)
+    cached = record_factors(paths, offline_filters(), CONF_THRESHOLD, cache)
+
+    for matrix, cached_matrix in zip(recorded, cached):
+        np.testing.assert_array_equal(matrix.factors, cached_matrix.factors)
+    # Another threshold or other filters are recorded again
+    with pytest.raises(AssertionError, match="parsed again"):
+        record_factors(paths, offline_filters(), 0.5, cache)
+    with pytest.raises(AssertionError, match="parsed again"):
+        record_factors(paths, offline_filters()[1:], CONF_THRESHOLD, cache)
+
+
+def test_cache_is_keyed_on_the_content_of_the_file(tmp_path):
+    cache = FactorCache(str(tmp_path / "factors"))
+    json_file = tmp_path / "menu.json"
+    json_file.write_text("{}")
+    cache.put(str(json_file), "signature", make_matrix())
+
+    assert cache.get(str(json_file), "signature").texts == make_matrix().texts
+    assert cache.get(str(json_file), "other") is None
+
+    json_file.write_text('{"changed": true}')
+    assert cache.get(str(json_file), "signature") is None
+
+
+def test_unreadable_cached_factors_are_ignored(tmp_path):
+    cache = FactorCache(str(tmp_path / "factors"))
+    json_file = tmp_path / "menu.json"
+    json_file.write_text("{}")
+    cache.put(str(json_file), "signature", make_matrix())
+
+    with open(cache.path(str(json_file), "signature"), "wb") as f:
+        f.write(b"not a zip file")
+
+    assert cache.get(str(json_file), "signature") is None
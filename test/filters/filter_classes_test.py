@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+from file_handler import load_ocr_data
+from filters.filter_classes import FilterFontSize, FilterSameRowAsSomethingelse
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+
+
+@pytest.mark.parametrize(
+    "geometric_filter",
+    [FilterSameRowAsSomethingelse(0.85), FilterFontSize(0.75)],
+    ids=lambda filter: filter.__class__.__name__,
+)
+def test_geometric_filters_need_prepare(geometric_filter):
+    menu = load_ocr_data(os.path.join(DATA_DIR, "menu-1.json"))
+
+    with pytest.raises(RuntimeError, match="prepare"):
+        geometric_filter.apply(menu.lines)
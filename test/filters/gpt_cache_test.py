@@ -0,0 +1,125 @@
+from typing import List
+
+import pytest
+
+from filters import gpt_cache
+from filters.gpt_cache import ClassificationCache, normalize_text
+
+DAY = 24 * 60 * 60
+
+
+class Clock:
+    """Stands in for the time module of the cache, so the tests can move time forward."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(gpt_cache, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    caches: List[ClassificationCache] = []
+
+    def make_cache(**options) -> ClassificationCache:
+        options.setdefault("path", str(tmp_path / "cache.sqlite"))
+        caches.append(ClassificationCache(**options))
+        return caches[-1]
+
+    yield make_cache
+    for cache in caches:
+        cache.close()
+
+
+def test_normalize_text():
+    assert normalize_text("  Hot \t DRINKS\n") == "hot drinks"
+
+
+def test_cached_probabilities_are_returned_by_text(clock, make_cache):
+    cache = make_cache()
+    cache.put_many({"Soups": 95, "Drinks": 80})
+
+    assert cache.get_many(["soups ", "Desserts", "DRINKS"]) == {
+        "soups ": 95,
+        "DRINKS": 80,
+    }
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.get_many(["Desserts"])
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert cache.get_many([]) == {}
+
+
+def test_entries_persist_and_are_separated_by_model_and_prompt(clock, make_cache):
+    make_cache(prompt="a").put_many({"Soups": 95})
+
+    assert make_cache(prompt="a").get_many(["Soups"]) == {"Soups": 95}
+    assert make_cache(prompt="b").get_many(["Soups"]) == {}
+    assert make_cache(prompt="a", model="other").get_many(["Soups"]) == {}
+
+
+def test_expired_entries_are_not_returned(clock, make_cache):
+    cache = make_cache(ttl_days=1)
+    cache.put_many({"Soups": 95})
+
+    clock.now += DAY - 1
+    assert cache.get_many(["Soups"]) == {"Soups": 95}
+
+    # Using an entry doesn't extend its life
+    clock.now += 2
+    assert cache.get_many(["Soups"]) == {}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entries_are_removed(clock, make_cache):
+    make_cache(ttl_days=1).put_many({"Soups": 95})
+    clock.now += 2 * DAY
+
+    # Opening the cache evicts the expired entries, a longer TTL later doesn't bring them back
+    make_cache(ttl_days=1).connection
+    assert make_cache(ttl_days=10).get_many(["Soups"]) == {}
+
+
+def test_least_recently_used_entries_are_evicted(clock, make_cache):
+    cache = make_cache(max_entries=2)
+    cache.put_many({"Soups": 95})
+    clock.now += 1
+    cache.put_many({"Drinks": 80})
+    clock.now += 1
+    # Soups is used after Drinks was stored, Drinks becomes the least recently used entry
+    cache.get_many(["Soups"])
+    clock.now += 1
+
+    cache.put_many({"Desserts": 90})
+
+    assert cache.get_many(["Soups", "Drinks", "Desserts"]) == {
+        "Soups": 95,
+        "Desserts": 90,
+    }
+
+
+def test_hits_are_marked_as_used_in_one_statement(clock, make_cache):
+    cache = make_cache()
+    texts = [f"text {i}" for i in range(1200)]
+    cache.put_many(dict.fromkeys(texts, 50))
+    statements: List[str] = []
+    cache.connection.set_trace_callback(statements.append)
+    clock.now += 1
+
+    assert len(cache.get_many(texts + ["missing"])) == 1200
+
+    # The keys are looked up in chunks of 500, every chunk with hits is updated once
+    updates = [statement for statement in statements if statement.startswith("UPDATE")]
+    assert len(updates) == 3
+    last_used = cache.connection.execute(
+        "SELECT DISTINCT last_used FROM classifications"
+    ).fetchall()
+    assert last_used == [(clock.now,)]
@@ -0,0 +1,308 @@
+import asyncio
+import random
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional
+
+import openai
+import pytest
+from aiohttp import web
+
+from filters.gpt_client import AsyncChatClient, ConcurrencyLimit, TokenBucket
+
+FUNCTION = {"name": "classify", "parameters": {"type": "object", "properties": {}}}
+
+
+def completion(content: str, function_call: bool = False) -> dict:
+    message = {"role": "assistant", "content": None if function_call else content}
+    if function_call:
+        message["function_call"] = {"name": "classify", "arguments": content}
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-3.5-turbo",
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    }
+
+
+def error(status: int, message: str, headers: Optional[dict] = None):
+    return web.json_response(
+        {"error": {"message": message, "type": "test", "param": None, "code": None}},
+        status=status,
+        headers=headers,
+    )
+
+
+class FakeOpenAI:
+    """
+    A local chat completion endpoint running on its own thread and event loop. `respond(prompt, attempt)` returns
+    the response to the `attempt`th request with the prompt, by default the prompt is echoed back.
+    """
+
+    def __init__(self, respond: Optional[Callable] = None, delay: float = 0):
+        self.respond = respond or (lambda prompt, attempt: None)
+        self.delay = delay
+        self.requests: List[dict] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._attempts = {}
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    async def _chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests.append(body)
+        prompt = body["messages"][0]["content"]
+        attempt = self._attempts[prompt] = self._attempts.get(prompt, -1) + 1
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            response = self.respond(prompt, attempt)
+            if response is None:
+                return web.json_response(completion(prompt, "functions" in body))
+            return response
+        finally:
+            self.in_flight -= 1
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = self._runner.addresses[0][1]
+        self._started.set()
+        self._loop.run_forever()
+
+    def __enter__(self) -> "FakeOpenAI":
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def client(self, **options) -> AsyncChatClient:
+        # The limits are shared by the clients with the same key, so every client of a test gets its own ones
+        options.setdefault("api_key", f"test-{uuid.uuid4()}")
+        return AsyncChatClient(api_base=f"http://127.0.0.1:{self.port}/v1", **options)
+
+
+def test_responses_come_in_the_order_of_the_prompts():
+    with FakeOpenAI(delay=0.01) as server:
+        responses = server.client().complete_all_sync([f"prompt {i}" for i in range(8)])
+
+    assert responses == [f"prompt {i}" for i in range(8)]
+
+
+def test_function_call_arguments_are_returned():
+    with FakeOpenAI() as server:
+        responses = server.client().complete_all_sync(['{"answers": []}'], FUNCTION)
+
+    assert responses == ['{"answers": []}']
+    assert server.requests[0]["function_call"] == {"name": "classify"}
+
+
+def test_rate_limited_requests_honor_retry_after():
+    def respond(prompt, attempt):
+        if attempt == 0:
+            return error(429, "Rate limit reached", {"Retry-After": "0.3"})
+
+    with FakeOpenAI(respond) as server:
+        client = server.client(backoff_base=10)
+        start = time.perf_counter()
+        responses = client.complete_all_sync(["a", "b"])
+        elapsed = time.perf_counter() - start
+
+    assert responses == ["a", "b"]
+    assert len(server.requests) == 4
+    # The Retry-After of the server is used instead of the much longer backoff
+    assert 0.3 <= elapsed < 5
+
+
+def test_rate_limited_requests_are_retried_with_a_jittered_backoff():
+    def respond(prompt, attempt):
+        if attempt < 2:
+            return error(429, "Rate limit reached")
+
+    with FakeOpenAI(respond) as server:
+        responses = server.client(backoff_base=0.01).complete_all_sync(["a"])
+
+    assert responses == ["a"]
+    assert len(server.requests) == 3
+
+
+def test_backoff():
+    client = AsyncChatClient(backoff_base=1, backoff_max=5)
+    random.seed(0)
+
+    for attempt in range(6):
+        delays = [client._backoff(attempt, Exception()) for _ in range(200)]
+        limit = min(5, 2**attempt)
+        assert all(0 <= delay <= limit for delay in delays)
+        # Full jitter spreads the retries over the whole range
+        assert min(delays) < limit * 0.1 and max(delays) > limit * 0.9
+
+    retry_after = openai.error.RateLimitError("slow down", headers={"retry-after": "7"})
+    assert client._backoff(0, retry_after) == 7
+
+
+def test_retries_give_up():
+    with FakeOpenAI(lambda prompt, attempt: error(429, "Rate limit reached")) as server:
+        client = server.client(max_retries=2, backoff_base=0.01)
+        with pytest.raises(openai.error.RateLimitError):
+            client.complete_all_sync(["a"])
+
+    assert len(server.requests) == 3
+
+
+def test_return_exceptions():
+    def respond(prompt, attempt):
+        if prompt == "bad":
+            return error(400, "Invalid prompt")
+
+    with FakeOpenAI(respond) as server:
+        client = server.client()
+        responses = client.complete_all_sync(
+            ["good", "bad", "also good"], return_exceptions=True
+        )
+        with pytest.raises(openai.error.InvalidRequestError):
+            client.complete_all_sync(["good", "bad"])
+
+    assert responses[0] == "good" and responses[2] == "also good"
+    assert isinstance(responses[1], openai.error.InvalidRequestError)
+
+
+def test_concurrency_cap():
+    with FakeOpenAI(delay=0.05) as server:
+        server.client(max_concurrency=2).complete_all_sync(
+            [f"prompt {i}" for i in range(8)]
+        )
+
+    assert server.max_in_flight == 2
+
+
+def test_concurrency_cap_is_shared_between_threads():
+    with FakeOpenAI(delay=0.05) as server:
+        clients = [server.client(max_concurrency=3, api_key="shared") for _ in range(4)]
+        threads = [
+            threading.Thread(
+                target=client.complete_all_sync,
+                args=([f"prompt {i}" for i in range(4)],),
+            )
+            for client in clients
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(server.requests) == 16
+    assert server.max_in_flight == 3
+
+
+def test_requests_are_throttled_by_the_shared_bucket():
+    with FakeOpenAI() as server:
+        client = server.client(requests_per_minute=600)
+        _, request_bucket, _ = client.limits()
+        # An earlier call used up the whole minute
+        request_bucket.reserve(600)
+
+        start = time.perf_counter()
+        client.complete_all_sync(["a", "b", "c"])
+        elapsed = time.perf_counter() - start
+
+    # 10 requests per second, the third one waits for 0.3 s
+    assert 0.25 <= elapsed < 2
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10, period=1)
+
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(5) == pytest.approx(0.5, abs=0.05)
+    # Later callers wait behind the debt of the earlier ones
+    assert bucket.reserve(5) == pytest.approx(1, abs=0.05)
+    # A request larger than the bucket only waits for a full bucket
+    assert TokenBucket(10, period=1).reserve(100) == 0
+
+    bucket.adjust(-10)
+    assert bucket.reserve(0) == pytest.approx(0, abs=0.05)
+
+
+def test_token_bucket_refills():
+    bucket = TokenBucket(10, period=0.1)
+    bucket.reserve(10)
+    time.sleep(0.15)
+
+    assert bucket.reserve(10) == 0
+
+
+def test_concurrency_limit_hands_slots_over_in_order():
+    async def main():
+        limit = ConcurrencyLimit(1)
+        order = []
+
+        async def request(name: str):
+            async with limit:
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(request(name) for name in "abcd"))
+        return limit, order
+
+    limit, order = asyncio.run(main())
+
+    assert order == list("abcd")
+    assert limit.in_flight == 0
+
+
+def test_cancelled_waiters_pass_the_slot_on():
+    async def main():
+        limit = ConcurrencyLimit(1)
+        await limit.__aenter__()
+
+        cancelled = asyncio.create_task(limit.__aenter__())
+        waiting = asyncio.create_task(limit.__aenter__())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await limit.__aexit__(None, None, None)
+
+        await asyncio.wait_for(waiting, 1)
+        assert cancelled.cancelled()
+        assert limit.in_flight == 1
+        await limit.__aexit__(None, None, None)
+        return limit
+
+    assert asyncio.run(main()).in_flight == 0
+
+
+def test_a_slot_handed_to_a_cancelled_waiter_is_passed_on():
+    async def main():
+        limit = ConcurrencyLimit(1)
+        await limit.__aenter__()
+        first = asyncio.create_task(limit.__aenter__())
+        second = asyncio.create_task(limit.__aenter__())
+        await asyncio.sleep(0)
+
+        # The slot is handed to the first waiter, which is cancelled before it runs
+        await limit.__aexit__(None, None, None)
+        first.cancel()
+
+        await asyncio.wait_for(second, 1)
+        assert limit.in_flight == 1
+        await limit.__aexit__(None, None, None)
+        return limit
+
+    assert asyncio.run(main()).in_flight == 0
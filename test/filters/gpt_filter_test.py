@@ -0,0 +1,227 @@
+import json
+import re
+from typing import Callable, Dict, List
+
+import numpy as np
+import pytest
+
+from conf import MODEL_ID
+from filters import gpt_filter
+from filters.gpt_cache import ClassificationCache
+from filters.gpt_client import count_tokens
+from filters.gpt_filter import ANSWER_TOKENS, MakeAIDoTheFiltering, parse_answers
+from models import BoundingBox, Line
+
+RE_PROMPT_LINE = re.compile(r"^(\d+): (.*)$", re.MULTILINE)
+
+
+class FakeClient:
+    """
+    Stands in for the AsyncChatClient, answering every prompt with `answer(texts, attempt)`, where `texts` are the
+    texts of the prompt by their IDs.
+    """
+
+    model = MODEL_ID
+
+    def __init__(self, answer: Callable[[List[str], int], str]):
+        self.answer = answer
+        self.prompts: List[List[str]] = []
+        self.calls = 0
+
+    def complete_all_sync(self, prompts, function=None, return_exceptions=False):
+        responses = []
+        for prompt in prompts:
+            # Only the numbered lines after the examples of the base prompt
+            texts = [
+                text for _, text in RE_PROMPT_LINE.findall(prompt.rsplit("\n\n", 1)[-1])
+            ]
+            self.prompts.append(texts)
+            try:
+                responses.append(self.answer(texts, self.calls))
+            except Exception as error:
+                if not return_exceptions:
+                    raise
+                responses.append(error)
+        self.calls += 1
+        return responses
+
+
+def answers(probabilities: Dict[int, float]) -> str:
+    return json.dumps(
+        {
+            "answers": [
+                {"id": id, "probability": probability}
+                for id, probability in probabilities.items()
+            ]
+        }
+    )
+
+
+def extract(client: FakeClient, texts: List[str], partial_retries: int = 2):
+    gpt_filter = MakeAIDoTheFiltering(1, client=client, partial_retries=partial_retries)
+    return gpt_filter.extract_probabilities(gpt_filter.create_base_prompt(), texts)
+
+
+def make_lines(*texts: str, confidence: float = 1) -> List[Line]:
+    lines = [Line(text=text, bounding_box=BoundingBox(np.zeros(8))) for text in texts]
+    for line in lines:
+        line.analysis.category_confidence = confidence
+    return lines
+
+
+def test_parse_json_answers():
+    assert parse_answers(answers({0: 95, 1: 10, 2: 0}), 3) == {0: 95, 1: 10, 2: 0}
+
+
+def test_parse_truncated_json_answers():
+    response = answers({0: 95, 1: 10, 2: 50})[:-12]
+
+    assert parse_answers(response, 3) == {0: 95, 1: 10}
+
+
+def test_parse_text_answers():
+    response = "Here you go:\n0: 95\n 1 : 10\n2: high\n3: 1000"
+
+    assert parse_answers(response, 4) == {0: 95, 1: 10}
+
+
+def test_parse_drops_invalid_answers():
+    response = json.dumps(
+        {
+            "answers": [
+                {"id": 0, "probability": 95},
+                # Repeated, the first answer counts
+                {"id": 0, "probability": 5},
+                {"id": 1, "probability": 101},
+                {"id": 2, "probability": -1},
+                # An unknown ID
+                {"id": 6, "probability": 50},
+                {"id": "4", "probability": "40"},
+                {"id": 5, "probability": "high"},
+                {"id": None, "probability": 20},
+            ]
+        }
+    )
+
+    assert parse_answers(response, 6) == {0: 95, 4: 40}
+
+
+@pytest.mark.parametrize(
+    "response", ["", "I can't classify these", "{}", '{"answers": 5}', "null"]
+)
+def test_parse_responses_without_answers(response):
+    assert parse_answers(response, 3) == {}
+
+
+def test_every_line_is_answered():
+    client = FakeClient(
+        lambda texts, attempt: answers(dict.fromkeys(range(len(texts)), 80))
+    )
+
+    assert extract(client, ["Soups", "Drinks"]) == {"Soups": 80, "Drinks": 80}
+    assert client.calls == 1
+
+
+def test_skipped_lines_are_asked_about_again():
+    def answer(texts, attempt):
+        # The first time the second line gets an invalid probability and the last one is skipped
+        if attempt == 0:
+            return answers({0: 90, 1: 500, 2: 30})
+        return answers({id: 60 for id in range(len(texts))})
+
+    client = FakeClient(answer)
+
+    probabilities = extract(client, ["Soups", "Drinks", "Wafle", "5.99,-"])
+
+    assert probabilities == {"Soups": 90, "Drinks": 60, "Wafle": 30, "5.99,-": 60}
+    # Only the lines without a valid answer are asked about again, numbered from 0
+    assert client.prompts == [
+        ["Soups", "Drinks", "Wafle", "5.99,-"],
+        ["Drinks", "5.99,-"],
+    ]
+
+
+def test_lines_without_an_answer_after_the_retries_are_left_out():
+    client = FakeClient(lambda texts, attempt: answers({0: 70}))
+
+    probabilities = extract(client, ["Soups", "Drinks", "Wafle"], partial_retries=1)
+
+    assert probabilities == {"Soups": 70, "Drinks": 70}
+    assert client.prompts == [["Soups", "Drinks", "Wafle"], ["Drinks", "Wafle"]]
+
+
+def test_no_retries():
+    client = FakeClient(lambda texts, attempt: "")
+
+    assert extract(client, ["Soups"], partial_retries=0) == {}
+    assert client.calls == 1
+
+
+def test_failed_requests_are_not_retried():
+    def answer(texts, attempt):
+        raise RuntimeError("Rate limit reached")
+
+    client = FakeClient(answer)
+
+    assert extract(client, ["Soups", "Drinks"]) == {}
+    assert client.calls == 1
+
+
+def test_prompts_stay_within_the_token_limit(monkeypatch):
+    monkeypatch.setattr(gpt_filter, "TOKEN_LIMIT", 600)
+    gpt = MakeAIDoTheFiltering(1, client=FakeClient(lambda texts, attempt: ""))
+    texts = [f"Category number {i} " + "x" * (i % 40) for i in range(100)]
+
+    prompts = gpt.create_prompts(gpt.create_base_prompt(), texts)
+
+    assert len(prompts) > 1
+    for prompt, prompt_texts in prompts:
+        # The prompt together with the expected answers fits the limit
+        tokens = count_tokens(prompt, MODEL_ID) + ANSWER_TOKENS * len(prompt_texts)
+        assert tokens <= 600
+        numbered = RE_PROMPT_LINE.findall(prompt.rsplit("\n\n", 1)[-1])
+        assert numbered == [(str(id), text) for id, text in enumerate(prompt_texts)]
+    # Every text is asked about once, in order
+    assert [text for _, prompt_texts in prompts for text in prompt_texts] == texts
+
+
+def test_a_text_over_the_limit_gets_a_prompt_of_its_own(monkeypatch):
+    monkeypatch.setattr(gpt_filter, "TOKEN_LIMIT", 300)
+    gpt = MakeAIDoTheFiltering(1, client=FakeClient(lambda texts, attempt: ""))
+
+    prompts = gpt.create_prompts(gpt.create_base_prompt(), ["a", "b" * 2000, "c"])
+
+    assert [texts for _, texts in prompts] == [["a"], ["b" * 2000], ["c"]]
+
+
+def test_identical_texts_of_all_menus_are_sent_once(monkeypatch, tmp_path):
+    monkeypatch.setattr(gpt_filter, "OPEN_AI_API_KEY", "test")
+    client = FakeClient(
+        lambda texts, attempt: answers(
+            {id: 90 if "soup" in text.lower() else 20 for id, text in enumerate(texts)}
+        )
+    )
+    cache = ClassificationCache(path=str(tmp_path / "cache.sqlite"))
+    gpt = MakeAIDoTheFiltering(1, conf_threshold=0.5, client=client, cache=cache)
+    first = make_lines("Soups", "Hot drinks", "SOUPS ")
+    second = make_lines("soups", "hot  Drinks", "Desserts")
+    # Lines below the threshold are left alone
+    skipped = make_lines("Hot drinks", "Beers", confidence=0.4)
+
+    gpt.apply_many([None, None, None], [first, second, skipped])
+
+    # One request, with every distinct text once, the way it was first written
+    assert client.prompts == [["Soups", "Hot drinks", "Desserts"]]
+    confidences = [
+        line.analysis.category_confidence for line in first + second + skipped
+    ]
+    assert confidences == pytest.approx([0.9, 0.2, 0.9, 0.9, 0.2, 0.2, 0.4, 0.4])
+
+    # Another run over the same texts is answered from the cache
+    again = make_lines("HOT DRINKS", "soups")
+    gpt.apply_many([None], [again])
+
+    assert len(client.prompts) == 1
+    assert [line.analysis.category_confidence for line in again] == pytest.approx(
+        [0.2, 0.9]
+    )
@@ -0,0 +1,130 @@
+import re
+
+import numpy as np
+import pytest
+
+from filters.text_features import (
+    CURRENCY_SIGNS,
+    DEDUPE_PATTERN,
+    TextMatcher,
+    text_matcher,
+)
+from models import BoundingBox, Line
+
+TEXTS = [
+    "Svíčková na smetaně",
+    "Guláš 149 Kč",
+    "GULÁŠ 149 KČ",
+    "polévka dne",
+    "Dezerty:",
+    "Pivo 0,5l 45,-",
+    "Smørrebrød 95 kr",
+    "Fish & Chips £12.50",
+    "Menu €9",
+    "$",
+    "x",
+    # Digits str.isdigit accepts, \d only matches the decimal ones
+    "Espresso²",
+    "Polévka ①",
+    "قهوة ٣٠",
+    "Café ١٢",
+    "Ⅻ course",
+    "Ñoquis.",
+    "été",
+    "  leading space",
+    "trailing)",
+    "Kc 20",
+    "kČ",
+]
+
+
+def old_currency(text: str, signs) -> bool:
+    return any(map(text.lower().__contains__, [sign.lower() for sign in signs]))
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_features_match_the_old_predicates(text):
+    features = TextMatcher().extract(text)
+
+    assert features.currency == old_currency(text, CURRENCY_SIGNS)
+    assert features.digits == any(map(str.isdigit, text))
+    assert features.starts_with_capital == text[0].isupper()
+    assert features.ending == text[-1]
+    assert features.dedupe_key == re.sub(DEDUPE_PATTERN, "", text)
+
+
+def test_non_ascii_digits():
+    matcher = TextMatcher()
+
+    assert matcher.extract("Espresso²").digits
+    assert matcher.extract("٣٠").digits
+    assert matcher.extract("①").digits
+    # Numeric but not a digit for str.isdigit either
+    assert not matcher.extract("Ⅻ").digits
+
+
+def test_empty_text():
+    features = TextMatcher().extract("")
+
+    assert not features.currency
+    assert not features.digits
+    assert not features.starts_with_capital
+    assert features.ending == ""
+    assert features.dedupe_key == ""
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("Pivo 45,-", True),
+        ("Pivo 45, -", False),
+        ("Pivo 45-", False),
+        ("149 KČ", True),
+        ("149 kc", True),
+        ("Krém", True),
+        ("K č", False),
+    ],
+)
+def test_multi_character_currency_signs(text, expected):
+    assert TextMatcher().extract(text).currency == expected
+    assert old_currency(text, CURRENCY_SIGNS) == expected
+
+
+def test_signs_that_are_prefixes_of_each_other():
+    signs = ["k", "kč"]
+
+    for text in ["Kč", "kc", "K"]:
+        assert TextMatcher(signs).extract(text).currency == old_currency(text, signs)
+
+
+def test_no_currency_signs():
+    assert not TextMatcher([]).extract("149 Kč").currency
+
+
+def test_custom_dedupe_pattern():
+    matcher = TextMatcher(dedupe_pattern=r"\s")
+
+    assert matcher.extract("Guláš  s knedlíkem!").dedupe_key == "Gulášsknedlíkem!"
+
+
+def test_features_are_cached_per_matcher():
+    line = Line(text="Guláš 149 Kč", bounding_box=BoundingBox(np.zeros(8)))
+    matcher = TextMatcher()
+
+    features = matcher.features(line)
+
+    assert matcher.features(line) is features
+    assert line.analysis.text_features is features
+
+    # Another matcher extracts them again with its own signs
+    other = TextMatcher(["€"])
+    assert not other.features(line).currency
+    assert line.analysis.text_features.matcher is other
+
+
+def test_text_matcher_is_shared():
+    assert text_matcher() is text_matcher(CURRENCY_SIGNS, DEDUPE_PATTERN)
+    # The signs are case-insensitive and their order doesn't matter
+    assert text_matcher(["KČ", "€"]) is text_matcher(["€", "kč"])
+    assert text_matcher(["€"]) is not text_matcher()
+    assert text_matcher(dedupe_pattern=r"\s") is not text_matcher()
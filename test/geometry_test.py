@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+
+from geometry import Y0, Y1, Y2, Y3, GeometryStore, RowIndex, centers_y
+
+
+def random_extents(rng: np.random.Generator, size: int):
+    """Extents on a small integer grid, so there are many equal tops, bottoms and heights on their edges."""
+    tops = rng.integers(0, 50, size).astype(np.float64)
+    # Some of them are empty or inverted
+    bottoms = tops + rng.integers(-2, 8, size)
+    return tops, bottoms
+
+
+def covering(tops: np.ndarray, bottoms: np.ndarray, y: float) -> np.ndarray:
+    return np.flatnonzero((tops < y) & (y < bottoms))
+
+
+def random_store(rng: np.random.Generator, size: int, pages: int) -> GeometryStore:
+    lines = rng.uniform(0, 100, (size, 8))
+    lines[:, Y3] = lines[:, Y0] + rng.uniform(-1, 6, size)
+    return GeometryStore(
+        lines=lines,
+        words=np.zeros((0, 8)),
+        line_pages=np.sort(rng.integers(1, pages + 1, size)),
+    )
+
+
+def brute_force_row_mates(store: GeometryStore, indices: np.ndarray) -> np.ndarray:
+    center_y = centers_y(store.lines)
+    counts = []
+    for i in indices:
+        others = store.line_pages == store.line_pages[i]
+        others[i] = False
+        counts.append(
+            np.sum(
+                others
+                & (store.lines[:, Y0] < center_y[i])
+                & (center_y[i] < store.lines[:, Y3])
+            )
+        )
+    return np.array(counts, dtype=np.int64)
+
+
+def baseline_row_neighbours(store: GeometryStore) -> np.ndarray:
+    """The row check of the filter before the GeometryStore, the lines next to each other sorted by (page, center)."""
+    center_y = centers_y(store.lines)
+    order = sorted(
+        range(len(store.lines)), key=lambda i: (store.line_pages[i], center_y[i])
+    )
+    counts = np.zeros(len(store.lines), dtype=np.int64)
+    for position, i in enumerate(order):
+        for other in order[max(position - 1, 0) : position + 2]:
+            if (
+                other != i
+                and store.line_pages[other] == store.line_pages[i]
+                and store.lines[other, Y0] < center_y[i] < store.lines[other, Y3]
+            ):
+                counts[i] += 1
+    return counts
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 17, 64, 200])
+def test_count_matches_brute_force(size):
+    rng = np.random.default_rng(size)
+    tops, bottoms = random_extents(rng, size)
+    ys = np.arange(-1, 60, 0.5)
+
+    expected = [len(covering(tops, bottoms, y)) for y in ys]
+
+    assert RowIndex(tops, bottoms).count(ys).tolist() == expected
+
+
+def test_empty_index():
+    index = RowIndex(np.zeros(0), np.zeros(0))
+
+    assert len(index) == 0
+    assert index.count(np.array([0.0, 1.0])).tolist() == [0, 0]
+
+
+def test_single_line():
+    index = RowIndex(np.array([1.0]), np.array([3.0]))
+
+    # A height is covered if it's strictly inside the extent
+    assert index.count(np.array([1.0, 2.0, 3.0])).tolist() == [0, 1, 0]
+
+
+def test_empty_and_inverted_extents_cover_nothing():
+    index = RowIndex(np.array([1.0, 5.0, 2.0]), np.array([1.0, 2.0, 4.0]))
+
+    assert len(index) == 1
+    assert index.count(np.array([1.5, 3.0])).tolist() == [0, 1]
+
+
+@pytest.mark.parametrize("size,pages", [(1, 1), (2, 1), (50, 3), (300, 5)])
+def test_count_row_mates_matches_brute_force(size, pages):
+    rng = np.random.default_rng(size)
+    store = random_store(rng, size, pages)
+    indices = np.arange(size)
+
+    assert (
+        store.count_row_mates(indices).tolist()
+        == brute_force_row_mates(store, indices).tolist()
+    )
+    # A subset of the lines still counts the row-mates among all the lines of their pages
+    subset = indices[::3]
+    assert (
+        store.count_row_mates(subset).tolist()
+        == brute_force_row_mates(store, subset).tolist()
+    )
+
+
+def test_count_row_mates_of_no_lines():
+    store = GeometryStore(
+        lines=np.zeros((0, 8)), words=np.zeros((0, 8)), line_pages=np.zeros(0)
+    )
+
+    assert store.count_row_mates(np.zeros(0, dtype=np.intp)).tolist() == []
+
+
+def test_row_index_covers_the_lines_of_its_page():
+    rng = np.random.default_rng(0)
+    store = random_store(rng, 100, 4)
+    ys = np.arange(0, 100, 2.5)
+
+    for page_num in np.unique(store.line_pages):
+        on_page = store.lines[store.line_pages == page_num]
+        expected = [len(covering(on_page[:, Y0], on_page[:, Y3], y)) for y in ys]
+        assert store.row_index(page_num).count(ys).tolist() == expected
+
+
+@pytest.mark.parametrize("size,pages", [(1, 1), (2, 1), (50, 3), (300, 5)])
+def test_count_row_neighbours_matches_the_baseline(size, pages):
+    rng = np.random.default_rng(size)
+    store = random_store(rng, size, pages)
+    # Equal centers keep the order of the menu
+    store.lines[::7] = store.lines[0]
+    expected = baseline_row_neighbours(store)
+
+    assert store.count_row_neighbours(np.arange(size)).tolist() == expected.tolist()
+    subset = np.arange(size)[::3]
+    assert store.count_row_neighbours(subset).tolist() == expected[subset].tolist()
+
+
+def test_count_row_neighbours_at_most_two():
+    # A row of five columns
+    lines = np.zeros((5, 8))
+    lines[:, [Y0, Y1]], lines[:, [Y2, Y3]] = 10.0, 20.0
+    store = GeometryStore(lines=lines, words=np.zeros((0, 8)), line_pages=np.ones(5))
+
+    assert store.count_row_neighbours(np.arange(5)).tolist() == [1, 2, 2, 2, 1]
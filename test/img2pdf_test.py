@@ -0,0 +1,86 @@
+import io
+import os
+
+import fitz
+import pytest
+from PIL import Image
+
+from img2pdf import EXIF_ORIENTATION, img_to_fitz
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+MENU_IMAGE = os.path.join(DATA_DIR, "menu-3.jpg")
+
+
+def encode(image: Image.Image, format: str, **options) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+def embedded_image(doc: fitz.Document) -> dict:
+    (image,) = doc[0].get_images()
+    return doc.extract_image(image[0])
+
+
+def test_image_from_a_path_and_from_bytes():
+    with open(MENU_IMAGE, "rb") as f:
+        data = f.read()
+    with Image.open(MENU_IMAGE) as image:
+        size = image.size
+
+    for source in [MENU_IMAGE, data]:
+        doc = img_to_fitz(source, max_size=0)
+
+        assert doc.page_count == 1
+        # A point on the page for every pixel, like the coordinates of the OCR data
+        assert (doc[0].rect.width, doc[0].rect.height) == size
+        # The JPEG is embedded as it is, without re-encoding it
+        assert embedded_image(doc)["image"] == data
+
+
+def test_rotated_jpeg_keeps_its_stored_pixels():
+    image = Image.new("RGB", (40, 20), "white")
+    exif = image.getexif()
+    # Stored on its side, viewers rotate it by 90 degrees
+    exif[EXIF_ORIENTATION] = 6
+    data = encode(image, "JPEG", exif=exif)
+
+    doc = img_to_fitz(data, max_size=0)
+
+    assert (doc[0].rect.width, doc[0].rect.height) == (40, 20)
+    embedded = embedded_image(doc)
+    assert (embedded["width"], embedded["height"]) == (40, 20)
+    assert embedded["image"] != data
+
+
+def test_formats_mupdf_can_not_embed_are_converted():
+    data = encode(Image.new("RGBA", (30, 10), (255, 0, 0, 128)), "TGA")
+
+    doc = img_to_fitz(data, max_size=0)
+
+    assert (doc[0].rect.width, doc[0].rect.height) == (30, 10)
+    assert embedded_image(doc)["width"] == 30
+
+
+def test_large_images_are_downscaled():
+    data = encode(Image.new("RGB", (400, 200), "white"), "PNG")
+
+    doc = img_to_fitz(data, max_size=100)
+
+    # The page keeps the size of the original image
+    assert (doc[0].rect.width, doc[0].rect.height) == (400, 200)
+    embedded = embedded_image(doc)
+    assert (embedded["width"], embedded["height"]) == (100, 50)
+
+
+def test_unsupported_file_type(tmp_path):
+    path = tmp_path / "menu.txt"
+    path.write_text("not an image")
+
+    with pytest.raises(Exception, match="not supported"):
+        img_to_fitz(str(path))
+
+
+def test_data_that_is_not_an_image():
+    with pytest.raises(OSError):
+        img_to_fitz(b"not an image")
@@ -0,0 +1,131 @@
+import glob
+import io
+import json
+import os
+
+import pytest
+
+from json_stream import iter_object, load_json_file, loads
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+# Small chunks split the keys, strings, escapes and numbers at every possible place
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1 << 16]
+
+DOCUMENTS = [
+    {},
+    {"pages": []},
+    {"status": "succeeded"},
+    {"status": "succeeded", "pages": [1, 2, 3]},
+    {"pages": [{"lines": [{"text": "a"}]}], "status": "succeeded"},
+    {
+        "before": {"nested": [[], {}, [[1, [2, {"deep": None}]]]]},
+        "pages": [
+            {"text": 'Quotes " and backslashes \\ and slashes /'},
+            {"text": "Brackets ] } [ { and commas , : inside strings"},
+            {"text": "Escapes \n\t\r\b\f and é č"},
+            {"text": "Surrogate pairs \U0001f355 \U0001f37a"},
+            {"text": "\u0000 control"},
+            {"numbers": [0, -1, 12345678901234567890, 1.5, -2.5e-10, 1e300]},
+            {"literals": [True, False, None]},
+            "a bare string",
+            123456789,
+            [],
+        ],
+        "after": "the end",
+    },
+]
+
+
+def streamed(text: str, stream_key: str, chunk_size: int) -> dict:
+    """Collects the items of iter_object back into the document they came from."""
+    document = {}
+    for key, value in iter_object(io.StringIO(text), stream_key, chunk_size):
+        if key == stream_key:
+            document.setdefault(key, []).append(value)
+        else:
+            document[key] = value
+    return document
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("document", DOCUMENTS)
+@pytest.mark.parametrize(
+    "dump",
+    [
+        lambda document: json.dumps(document),
+        lambda document: json.dumps(document, ensure_ascii=False),
+        lambda document: json.dumps(document, indent=4),
+        lambda document: json.dumps(document, separators=(",", ":")),
+    ],
+    ids=["ascii", "unicode", "indented", "compact"],
+)
+def test_iter_object_matches_json_load(document, dump, chunk_size):
+    text = dump(document)
+    expected = json.load(io.StringIO(text))
+    # An empty streamed array doesn't yield anything
+    if expected.get("pages") == []:
+        del expected["pages"]
+
+    assert streamed(text, "pages", chunk_size) == expected
+
+
+def test_items_come_in_the_order_of_the_document():
+    text = '{"a": 1, "pages": [2, 3], "b": 4}'
+
+    assert list(iter_object(io.StringIO(text), "pages", 2)) == [
+        ("a", 1),
+        ("pages", 2),
+        ("pages", 3),
+        ("b", 4),
+    ]
+
+
+def test_other_arrays_are_yielded_whole():
+    text = '{"lines": [1, 2], "pages": [3]}'
+
+    assert list(iter_object(io.StringIO(text), "pages")) == [
+        ("lines", [1, 2]),
+        ("pages", 3),
+    ]
+
+
+def test_elements_are_decoded_lazily():
+    text = '{"pages": [1, 2, oops]}'
+    items = iter_object(io.StringIO(text), "pages", 4)
+
+    assert next(items) == ("pages", 1)
+    assert next(items) == ("pages", 2)
+    with pytest.raises(json.JSONDecodeError):
+        next(items)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "[]",
+        '{"pages": [1, 2',
+        '{"pages": [{"text": "unterminated',
+        '{"pages": [1 2]}',
+        '{"pages": 5}',
+        '{"status" "succeeded"}',
+        '{"status": "succeeded"',
+    ],
+)
+def test_invalid_documents_raise(text):
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_object(io.StringIO(text), "pages", 3))
+
+
+@pytest.mark.parametrize(
+    "path", sorted(glob.glob(os.path.join(DATA_DIR, "menu-*.json")))
+)
+def test_menu_files(path):
+    with open(path, "r") as file:
+        expected = json.load(file)
+    with open(path, "r") as file:
+        text = file.read()
+
+    assert streamed(text, "recognitionResults", 4096) == expected
+    assert load_json_file(path) == expected
+    assert loads(text.encode()) == expected
@@ -0,0 +1,153 @@
+import json
+import os
+
+import pytest
+
+import conf
+from batch import run_batch
+from filters import gpt_filter
+from metrics import METRICS, Metrics, Timer, profile, write_metrics
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+MENUS = [os.path.join(DATA_DIR, f"menu-{i}.json") for i in range(1, 5)]
+
+
+def worker_metrics(lines: int, seconds: float) -> dict:
+    """The snapshot of a worker that processed one menu."""
+    metrics = Metrics()
+    metrics.inc("menus_total")
+    metrics.inc("lines_total", lines)
+    metrics.inc("gpt_requests_total", outcome="ok")
+    metrics.observe("filter_seconds", seconds, filter="FilterFontSize")
+    # Sent to the parent process as JSON
+    return json.loads(json.dumps(metrics.snapshot()))
+
+
+def test_counters_and_timers():
+    metrics = Metrics()
+    metrics.inc("menus_total")
+    metrics.inc("menus_total", 2)
+    metrics.inc("gpt_requests_total", outcome="ok")
+    metrics.inc("gpt_requests_total", outcome="error")
+    metrics.observe("load_seconds", 0.5, loader="eager")
+    metrics.observe("load_seconds", 1.5, loader="eager")
+    with pytest.raises(RuntimeError):
+        with metrics.timer("sink_seconds", sink="csv"):
+            raise RuntimeError()
+
+    assert metrics.counters == {
+        ("menus_total", ()): 3,
+        ("gpt_requests_total", (("outcome", "ok"),)): 1,
+        ("gpt_requests_total", (("outcome", "error"),)): 1,
+    }
+    assert metrics.timers[("load_seconds", (("loader", "eager"),))] == Timer(
+        2, 2.0, 1.5
+    )
+    # Blocks that raised are timed too
+    assert metrics.timers[("sink_seconds", (("sink", "csv"),))].count == 1
+
+    metrics.reset()
+    assert metrics.counters == metrics.timers == {}
+
+
+def test_worker_metrics_are_merged():
+    metrics = Metrics()
+    metrics.inc("menus_total")
+
+    metrics.merge(worker_metrics(100, 0.25))
+    metrics.merge(worker_metrics(50, 0.75))
+
+    assert metrics.counters == {
+        ("menus_total", ()): 3,
+        ("lines_total", ()): 150,
+        ("gpt_requests_total", (("outcome", "ok"),)): 2,
+    }
+    assert metrics.timers == {
+        ("filter_seconds", (("filter", "FilterFontSize"),)): Timer(2, 1.0, 0.75)
+    }
+
+
+def test_metrics_of_worker_processes_are_merged(monkeypatch):
+    monkeypatch.setattr(conf, "OPEN_AI_API_KEY", None)
+    monkeypatch.setattr(gpt_filter, "OPEN_AI_API_KEY", None)
+
+    def counters(workers: int) -> dict:
+        METRICS.reset()
+        run_batch(MENUS, workers=workers)
+        return dict(METRICS.counters)
+
+    try:
+        in_process, in_workers = counters(1), counters(2)
+    finally:
+        METRICS.reset()
+
+    assert in_workers == in_process
+    assert in_workers[("menus_total", ())] == len(MENUS)
+    assert in_workers[("lines_total", ())] > 0
+
+
+def test_render_prometheus():
+    metrics = Metrics()
+    metrics.inc("menus_total", 2)
+    metrics.inc("gpt_requests_total", outcome="ok")
+    metrics.inc("gpt_requests_total", 3, outcome="rate_limited")
+    metrics.observe("filter_seconds", 0.5, filter='Filter"Quoted"\n')
+    metrics.observe("unknown_seconds", 1)
+
+    assert metrics.render_prometheus().splitlines() == [
+        "# HELP menu_gpt_requests_total Requests to OpenAI by outcome",
+        "# TYPE menu_gpt_requests_total counter",
+        'menu_gpt_requests_total{outcome="ok"} 1',
+        'menu_gpt_requests_total{outcome="rate_limited"} 3',
+        "# HELP menu_menus_total Processed menus",
+        "# TYPE menu_menus_total counter",
+        "menu_menus_total 2",
+        "# HELP menu_filter_seconds Time spent in every stage of the filters",
+        "# TYPE menu_filter_seconds summary",
+        'menu_filter_seconds_count{filter="Filter\\"Quoted\\"\\n"} 1',
+        'menu_filter_seconds_sum{filter="Filter\\"Quoted\\"\\n"} 0.5',
+        # Metrics without a description are described by their name
+        "# HELP menu_unknown_seconds unknown_seconds",
+        "# TYPE menu_unknown_seconds summary",
+        "menu_unknown_seconds_count 1",
+        "menu_unknown_seconds_sum 1.0",
+    ]
+    assert Metrics().render_prometheus() == ""
+
+
+def test_write_metrics(tmp_path):
+    metrics = Metrics()
+    metrics.inc("menus_total", 2)
+    metrics.observe("load_seconds", 0.5, loader="lazy")
+    prometheus = str(tmp_path / "metrics" / "run.prom")
+    jsonl = str(tmp_path / "metrics" / "runs.jsonl")
+
+    write_metrics(prometheus, metrics)
+    write_metrics(jsonl, metrics)
+    rendered = metrics.render_prometheus()
+    metrics.inc("menus_total")
+    write_metrics(jsonl, metrics)
+
+    with open(prometheus) as f:
+        assert f.read() == rendered
+    with open(jsonl) as f:
+        runs = [json.loads(line) for line in f]
+    # Every run is appended, and can be merged again
+    assert [run["counters"][0]["value"] for run in runs] == [2, 3]
+    merged = Metrics()
+    merged.merge(runs[0])
+    assert merged.timers == {
+        ("load_seconds", (("loader", "lazy"),)): Timer(1, 0.5, 0.5)
+    }
+
+
+def test_profile(tmp_path):
+    with profile("menu-1", "cprofile", str(tmp_path)):
+        sum(range(1000))
+    with profile("menu-2", None, str(tmp_path)):
+        pass
+
+    assert os.listdir(tmp_path) == ["menu-1.prof"]
+    with pytest.raises(ValueError, match="Unknown profiler"):
+        with profile("menu-1", "perf", str(tmp_path)):
+            pass
@@ -0,0 +1,142 @@
+import json
+import os
+
+import attr
+import fitz
+import pytest
+
+from file_handler import InvalidSourceError
+from filters import gpt_filter
+from main import process_ocr
+from output import (
+    CsvSink,
+    JsonlSink,
+    PdfBytesSink,
+    PdfSink,
+    ProcessResult,
+    create_sinks,
+)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def data(name: str) -> bytes:
+    with open(os.path.join(DATA_DIR, name), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(autouse=True)
+def without_gpt(monkeypatch):
+    monkeypatch.setattr(gpt_filter, "OPEN_AI_API_KEY", None)
+
+
+@pytest.fixture(scope="module")
+def results():
+    return {
+        name: process_ocr(os.path.join(DATA_DIR, f"{name}.json"))
+        for name in ["menu-1", "menu-2"]
+    }
+
+
+def test_csv_sink(results, tmp_path):
+    output_dir = tmp_path / "nested" / "output"
+    sink = CsvSink(str(output_dir))
+
+    sink.write(results["menu-2"])
+
+    lines = (output_dir / "menu-2.csv").read_text().splitlines()
+    assert lines[0] == "text,confidence"
+    assert lines[1:] == [
+        f"{line.text},{line.analysis.category_confidence}"
+        for line in results["menu-2"].categories
+    ]
+
+
+def test_jsonl_sink_appends_one_line_per_menu(results, tmp_path):
+    path = tmp_path / "output" / "categories.jsonl"
+    sink = JsonlSink(str(path))
+    sink.start()
+
+    sink.write(results["menu-1"])
+    sink.write(results["menu-2"])
+
+    menus = [json.loads(line) for line in path.read_text().splitlines()]
+    assert menus == [results["menu-1"].to_json(), results["menu-2"].to_json()]
+    assert menus[1]["file"] == "menu-2"
+    assert menus[1]["lines"] == len(results["menu-2"].menu.lines)
+    assert [category["text"] for category in menus[1]["categories"]] == [
+        line.text for line in results["menu-2"].categories
+    ]
+
+
+def test_jsonl_sink_start_removes_the_previous_run(results, tmp_path):
+    path = tmp_path / "categories.jsonl"
+    path.write_text('{"file": "old"}\n')
+
+    sink = JsonlSink(str(path))
+    # Written without start, the results are appended
+    sink.write(results["menu-1"])
+    assert len(path.read_text().splitlines()) == 2
+
+    sink.start()
+    assert not path.exists()
+    sink.write(results["menu-2"])
+    assert [json.loads(line)["file"] for line in path.read_text().splitlines()] == [
+        "menu-2"
+    ]
+
+
+def test_create_sinks(tmp_path):
+    output_dir = str(tmp_path)
+
+    sinks = create_sinks(["csv", "jsonl", "pdf", "none"], output_dir)
+
+    assert sinks == [
+        CsvSink(output_dir),
+        JsonlSink(os.path.join(output_dir, "categories.jsonl")),
+        PdfSink(output_dir),
+    ]
+    assert create_sinks(["none"], output_dir) == []
+    with pytest.raises(ValueError, match="Unknown output xml"):
+        create_sinks(["csv", "xml"], output_dir)
+
+
+@pytest.mark.parametrize("mode", ["full", "compact", "incremental", "pages"])
+def test_pdf_sink_with_a_source_in_memory(results, tmp_path, mode):
+    source = data("menu-2.pdf")
+    result = attr.evolve(results["menu-2"], source=(source, "upload.pdf"))
+
+    PdfSink(str(tmp_path), mode).write(result)
+
+    written = (tmp_path / "menu-2.pdf").read_bytes()
+    pdf = fitz.Document(stream=written, filetype="pdf")
+    pages = {line.page_index for line in result.categories}
+    assert result.pdf_stats.pages_touched == len(pages)
+    assert pdf.page_count == (len(pages) if mode == "pages" else len(result.menu.pages))
+    if mode == "incremental":
+        # The highlights are appended to the received file instead of rewriting it
+        assert written.startswith(source)
+        assert result.pdf_stats.bytes_copied == len(source)
+        assert result.pdf_stats.bytes_written == len(written) - len(source)
+    else:
+        assert not written.startswith(source)
+        assert result.pdf_stats.bytes_written == len(written)
+
+
+def test_pdf_sink_rejects_an_invalid_source_in_memory(results, tmp_path):
+    result = attr.evolve(results["menu-2"], source=(b"not a pdf", "upload.pdf"))
+
+    with pytest.raises(InvalidSourceError, match="upload.pdf"):
+        PdfSink(str(tmp_path), "incremental").write(result)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_pdf_bytes_sink(results):
+    result = attr.evolve(results["menu-2"], source=(data("menu-2.pdf"), "upload.pdf"))
+
+    PdfBytesSink("pages").write(result)
+
+    pages = {line.page_index for line in result.categories}
+    assert fitz.Document(stream=result.pdf, filetype="pdf").page_count == len(pages)
+    assert result.pdf_stats.bytes_written == len(result.pdf)
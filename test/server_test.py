@@ -0,0 +1,182 @@
+import asyncio
+import os
+from typing import Awaitable, Callable
+
+import fitz
+import pytest
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient, TestServer
+
+from filters import gpt_filter
+from main import process_ocr
+from server import MenuService, create_app
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def data(name: str) -> bytes:
+    with open(os.path.join(DATA_DIR, name), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(autouse=True)
+def without_gpt(monkeypatch):
+    monkeypatch.setattr(gpt_filter, "OPEN_AI_API_KEY", None)
+
+
+def serve(test: Callable[[TestClient], Awaitable], **options):
+    """Runs the test against the service on a local port, the options are passed to the MenuService."""
+
+    async def main():
+        # The service has to be created inside the event loop
+        app = create_app(MenuService(**options) if options else None)
+        async with TestClient(TestServer(app)) as client:
+            return await test(client)
+
+    return asyncio.run(main())
+
+
+def form(ocr: str, source: str = None) -> FormData:
+    form = FormData()
+    form.add_field("ocr", data(ocr), filename=ocr, content_type="application/json")
+    if source:
+        form.add_field("source", data(source), filename=source)
+    return form
+
+
+def expected_categories(name: str):
+    result = process_ocr(os.path.join(DATA_DIR, name))
+    return [line.text for line in result.categories], result
+
+
+def test_process_json():
+    async def test(client):
+        response = await client.post(
+            "/process",
+            data=data("menu-1.json"),
+            headers={"Content-Type": "application/json"},
+        )
+        assert response.status == 200
+        return await response.json()
+
+    body = serve(test, max_concurrency=1)
+
+    texts, result = expected_categories("menu-1.json")
+    assert [category["text"] for category in body["categories"]] == texts
+    assert body["lines"] == len(result.menu.lines)
+    assert set(body["categories"][0]) == {"text", "confidence", "page", "line"}
+
+
+def test_process_multipart_without_pdf():
+    async def test(client):
+        response = await client.post("/process", data=form("menu-2.json", "menu-2.pdf"))
+        assert response.status == 200
+        return await response.json()
+
+    texts, _ = expected_categories("menu-2.json")
+    assert [category["text"] for category in serve(test)["categories"]] == texts
+
+
+@pytest.mark.parametrize(
+    "ocr, source", [("menu-2.json", "menu-2.pdf"), ("menu-3.json", "menu-3.jpg")]
+)
+def test_process_returns_the_highlighted_pdf(ocr, source):
+    async def test(client):
+        response = await client.post("/process?pdf=1", data=form(ocr, source))
+        assert response.status == 200
+        assert response.content_type == "application/pdf"
+        return await response.read()
+
+    pdf = fitz.Document(stream=serve(test), filetype="pdf")
+
+    _, result = expected_categories(ocr)
+    assert pdf.page_count == len(result.menu.pages)
+    highlighted = {line.page_index for line in result.categories}
+    for page in pdf:
+        annotations = len(list(page.annots())) + len(page.get_drawings())
+        assert bool(annotations) == (page.number in highlighted)
+
+
+def test_process_returns_only_the_highlighted_pages():
+    async def test(client):
+        response = await client.post(
+            "/process?pdf=pages", data=form("menu-4.json", "menu-4.pdf")
+        )
+        assert response.status == 200
+        return await response.read()
+
+    pdf = fitz.Document(stream=serve(test), filetype="pdf")
+
+    _, result = expected_categories("menu-4.json")
+    pages = {line.page_index for line in result.categories}
+    assert 0 < pdf.page_count == len(pages) < len(result.menu.pages)
+
+
+OCR_FIELD = ("ocr", "menu-2.json", "menu-2.json")
+
+
+@pytest.mark.parametrize(
+    "path, body, message",
+    [
+        ("/process", b"{not json", "Invalid OCR data"),
+        ("/process", b'{"status": "succeeded"}', "Invalid OCR data"),
+        ("/process?pdf=1", b"{}", "A source file is needed"),
+        ("/process?pdf=1", [OCR_FIELD], "A source file is needed"),
+        ("/process", [("source", "menu-2.pdf", "menu-2.pdf")], "Missing the 'ocr'"),
+        # Fields are given as their name, the filename and the file in the data folder they are read from
+        (
+            "/process?pdf=1",
+            [OCR_FIELD, ("source", "menu-2.pdf", "menu-2.json")],
+            "Invalid source file",
+        ),
+    ],
+)
+def test_bad_requests(path, body, message):
+    async def test(client):
+        nonlocal body
+        if isinstance(body, list):
+            fields = body
+            body = FormData()
+            for name, filename, file in fields:
+                body.add_field(name, data(file), filename=filename)
+        response = await client.post(path, data=body)
+        metrics = await (await client.get("/metrics")).text()
+        return response.status, await response.json(), metrics
+
+    status, response, metrics = serve(test)
+
+    assert status == 400
+    assert message in response["error"]
+    # The mistakes of the client aren't counted as failures of the service
+    assert "menu_failed_total 0\n" in metrics
+
+
+def test_overloaded_service_rejects_requests():
+    async def test(client):
+        response = await client.post("/process", data=data("menu-1.json"))
+        return response.status, response.headers.get("Retry-After")
+
+    assert serve(test, max_pending=0) == (503, "1")
+
+
+def test_health_and_metrics():
+    async def test(client):
+        health = await (await client.get("/health")).json()
+        await client.post("/process", data=data("menu-1.json"))
+        await client.post("/process", data=data("menu-2.json"))
+        response = await client.get("/metrics")
+        return health, response.status, await response.text()
+
+    health, status, metrics = serve(test, max_concurrency=2)
+
+    assert health == {"status": "ok", "in_flight": 0, "pending": 0}
+    assert status == 200
+    lines = metrics.splitlines()
+    assert "# TYPE menu_requests_total counter" in lines
+    assert "menu_requests_total 2" in lines
+    assert "menu_failed_total 0" in lines
+    assert "menu_in_flight 0" in lines
+    # Followed by the timers of the pipeline
+    assert any(
+        line.startswith('menu_load_seconds_count{loader="request"}') for line in lines
+    )
@@ -0,0 +1,100 @@
+import argparse
+import csv
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import train_classifier
+from file_handler import load_ocr_data
+from filters.classifier import FEATURES, LogisticModel
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+MENUS = ["menu-2", "menu-3", "menu-8"]
+
+
+@pytest.fixture
+def directory(tmp_path):
+    for name in MENUS:
+        shutil.copy(os.path.join(DATA_DIR, name + ".json"), tmp_path)
+    return tmp_path
+
+
+def run(command, directory, **options):
+    args = argparse.Namespace(
+        directory=str(directory),
+        labels_dir=str(directory / "labels"),
+        overwrite=False,
+        l2=1.0,
+        model=str(directory / "model.json"),
+    )
+    vars(args).update(options)
+    command(args)
+
+
+def read_labels(path):
+    with open(path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_label_train_and_evaluate(directory):
+    run(train_classifier.label, directory)
+
+    for name in MENUS:
+        menu = load_ocr_data(str(directory / (name + ".json")))
+        rows = read_labels(directory / "labels" / (name + ".csv"))
+        assert [row["text"] for row in rows] == [line.text for line in menu.lines]
+        # Pre-filled with the categories of the hand-tuned filters
+        categories = train_classifier.heuristic_filter().get_possible_categories(
+            menu, train_classifier.CONF_THRESHOLD
+        )
+        assert sum(row["category"] == "1" for row in rows) == len(categories)
+
+    run(train_classifier.train, directory)
+
+    model = LogisticModel.load(str(directory / "model.json"))
+    assert model.features == FEATURES
+    assert np.all(np.isfinite(model.weights))
+
+    run(train_classifier.evaluate, directory)
+
+
+def test_label_keeps_existing_files(directory):
+    path = directory / "labels" / "menu-2.csv"
+    run(train_classifier.label, directory)
+    path.write_text("page,line,text,category\n")
+
+    run(train_classifier.label, directory)
+    assert path.read_text() == "page,line,text,category\n"
+
+    run(train_classifier.label, directory, overwrite=True)
+    assert len(read_labels(path)) > 0
+
+
+def test_labels_that_dont_match_the_menu(directory):
+    run(train_classifier.label, directory)
+    path = directory / "labels" / "menu-2.csv"
+    menu = load_ocr_data(str(directory / "menu-2.json"))
+    rows = read_labels(path)
+
+    assert train_classifier.load_labels(menu, str(path)) is not None
+
+    rows[0]["text"] = "Something else"
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=rows[0].keys())
+        writer.writeheader()
+        writer.writerows(rows)
+    assert train_classifier.load_labels(menu, str(path)) is None
+
+    # Lines without a label
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=rows[0].keys())
+        writer.writeheader()
+        writer.writerows(read_labels(path)[1:])
+    assert train_classifier.load_labels(menu, str(path)) is None
+
+
+def test_train_without_labels(directory):
+    with pytest.raises(SystemExit):
+        run(train_classifier.train, directory)
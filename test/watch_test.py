@@ -0,0 +1,176 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+import conf
+import watch
+from file_handler import SourceIndex
+from filters import gpt_filter
+from output import CsvSink
+from watch import FolderWatcher, PollingNotifier, ProcessedInputs
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+@pytest.fixture(autouse=True)
+def without_gpt(monkeypatch):
+    monkeypatch.setattr(conf, "OPEN_AI_API_KEY", None)
+    monkeypatch.setattr(gpt_filter, "OPEN_AI_API_KEY", None)
+
+
+@pytest.fixture
+def watched(tmp_path):
+    directory = tmp_path / "watched"
+    directory.mkdir()
+    return directory
+
+
+def add(directory, name: str, as_name: str = None):
+    """Moves a copy of a file from the data folder into the directory, the way complete files should arrive."""
+    staging = directory.parent / "staging"
+    staging.mkdir(exist_ok=True)
+    shutil.copy(os.path.join(DATA_DIR, name), staging / (as_name or name))
+    os.replace(staging / (as_name or name), directory / (as_name or name))
+
+
+def make_watcher(directory, **options) -> FolderWatcher:
+    options.setdefault("settle_seconds", 0)
+    options.setdefault("wait_for_source", False)
+    # Every watcher has its own index, the tests don't share the directories of the default one
+    return FolderWatcher(str(directory), sources=SourceIndex(), **options)
+
+
+def names(files) -> list:
+    return [os.path.basename(file.path) for file in files]
+
+
+def test_processed_inputs_are_remembered(tmp_path):
+    path = str(tmp_path / "output" / ".watch_processed")
+    processed = ProcessedInputs(path)
+    processed.add("a")
+    processed.add("b")
+    processed.add("a")
+
+    assert "a" in processed and "c" not in processed
+    with open(path) as f:
+        assert f.read() == "a\nb\n"
+    assert ProcessedInputs(path).keys == {"a", "b"}
+
+
+def test_files_are_queued_once(watched):
+    watcher = make_watcher(watched)
+    add(watched, "menu-1.json")
+    add(watched, "menu-2.pdf")
+
+    assert names(watcher.scan()) == ["menu-1.json"]
+    assert watcher.scan() == []
+
+    add(watched, "menu-2.json")
+    assert names(watcher.scan()) == ["menu-2.json"]
+
+
+def test_inputs_with_the_same_content_are_skipped(watched, tmp_path):
+    state_path = str(tmp_path / ".watch_processed")
+    watcher = make_watcher(watched, state_path=state_path)
+    add(watched, "menu-1.json")
+
+    (file,) = watcher.scan()
+    # Queued but not processed yet, a copy under another name isn't queued again
+    add(watched, "menu-1.json", "copy.json")
+    assert watcher.scan() == []
+
+    watcher.process([file])
+    add(watched, "menu-1.json", "another-copy.json")
+    assert watcher.scan() == []
+
+    # Also after a restart, unless the content changed
+    restarted = make_watcher(watched, state_path=state_path)
+    assert restarted.scan() == []
+    add(watched, "menu-2.json", "menu-1.json")
+    assert names(restarted.scan()) == ["menu-1.json"]
+
+
+def test_failed_inputs_are_not_recorded(watched, tmp_path):
+    state_path = str(tmp_path / ".watch_processed")
+    watcher = make_watcher(watched, state_path=state_path)
+    (watched / "broken.json").write_text('{"status": ')
+
+    watcher.process(watcher.scan())
+
+    assert ProcessedInputs(state_path).keys == set()
+    assert names(make_watcher(watched, state_path=state_path).scan()) == ["broken.json"]
+
+
+def test_the_source_file_is_waited_for(watched):
+    watcher = make_watcher(watched, wait_for_source=True, source_timeout=60)
+    add(watched, "menu-2.json")
+
+    assert watcher.scan() == []
+
+    add(watched, "menu-2.pdf")
+    (file,) = watcher.scan()
+    # The source file is part of the input
+    assert file.key.count(":") == 1
+
+
+def test_files_without_a_source_are_processed_after_the_timeout(watched):
+    watcher = make_watcher(watched, wait_for_source=True, source_timeout=0.2)
+    add(watched, "menu-1.json")
+
+    assert watcher.scan() == []
+    time.sleep(0.25)
+
+    (file,) = watcher.scan()
+    assert ":" not in file.key
+
+
+def test_files_are_processed_once_they_settled(watched):
+    watcher = make_watcher(watched, settle_seconds=60)
+    add(watched, "menu-1.json")
+
+    assert watcher.scan() == []
+    assert str(watched / "menu-1.json") in watcher.first_seen
+
+    # Last written a minute ago
+    old = time.time() - 61
+    os.utime(watched / "menu-1.json", (old, old))
+    assert names(watcher.scan()) == ["menu-1.json"]
+
+
+def test_watch_the_directory(watched, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        watch, "create_notifier", lambda directory, stop: PollingNotifier(stop)
+    )
+    output_dir = tmp_path / "output"
+    state_path = str(tmp_path / ".watch_processed")
+    watcher = make_watcher(
+        watched,
+        sinks=[CsvSink(str(output_dir))],
+        state_path=state_path,
+        poll_interval=0.05,
+    )
+    stop = threading.Event()
+    thread = threading.Thread(target=watcher.run, args=(stop,))
+    thread.start()
+
+    def wait_for(condition):
+        deadline = time.time() + 30
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.05)
+
+    try:
+        add(watched, "menu-1.json")
+        add(watched, "menu-2.json")
+        wait_for(lambda: len(ProcessedInputs(state_path).keys) == 2)
+        add(watched, "menu-1.json", "copy.json")
+        add(watched, "menu-3.json")
+        wait_for(lambda: len(ProcessedInputs(state_path).keys) == 3)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert sorted(os.listdir(output_dir)) == ["menu-1.csv", "menu-2.csv", "menu-3.csv"]